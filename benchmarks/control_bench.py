@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+"""Control plane benchmark for ServiceWall
+
+Runs ServiceWall's entry points against fake_iptc, an in-memory iptc, over
+generated catalogs and realms :
+
+    init          build a ServiceWall, its catalog already compiled
+    start         load the realm's rules
+    reload        reload with nothing changed
+    allow         allow one more service, which reloads
+    disallow      disallow it again
+    lookup        LOOKUPS list_services_by_port calls
+    stop          remove all rules
+
+For each case - a catalog of so many services, a realm allowing so many of
+them - it reports the best time of each step over --rounds, that time plus
+the simulated cost of table commits and refreshes, and the count of table
+operations. With --baseline, it fails if operation counts went up, or if
+times went over the baseline's by more than --tolerance. --save writes the
+results as the new baseline. Operation counts are the same on any machine ;
+times are not, so save a baseline of your own before comparing them.
+
+Usage: %s [--cases small|all] [--rounds N] [--baseline FILE] [--save]
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+from contextlib import redirect_stdout
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, HERE)
+import fake_iptc
+fake_iptc.install()
+
+from servicewall import ipset
+from servicewall import network_helpers
+from servicewall import state
+from servicewall.main import ServiceWall
+
+
+# (services in the catalog, services allowed in the realm) :
+CASES = {
+    "small": ((100, 10), (1000, 100)),
+    "all": ((100, 10), (1000, 10), (1000, 100), (10000, 100), (10000, 1000)),
+}
+STEPS = ("init", "start", "reload", "allow", "disallow", "lookup", "stop")
+LOOKUPS = 1000
+BASELINE_FILE = os.path.join(HERE, "control_baseline.json")
+TOLERANCE = 1.0
+# Times below this many seconds are all noise :
+FLOOR = 0.005
+REALM = "bench"
+
+
+def synthetic_catalog(count, seed=0):
+    """Return a dict of count service definitions, as in services.json."""
+    rng = random.Random(seed)
+    services = {}
+    for number in range(count):
+        ports = {"tcp": [], "udp": []}
+        for _ in range(rng.choice((1, 1, 1, 2, 3, 6))):
+            start = rng.randrange(1, 65000)
+            if rng.random() < 0.2:
+                port = "%i:%i" % (start, start + rng.randrange(1, 100))
+            else:
+                port = str(start)
+            ports[rng.choice(("tcp", "tcp", "udp"))].append(port)
+        title = "service%05i" % number
+        services[title] = {
+            "title": title,
+            "description": "generated service %i" % number,
+            "ports": ports,
+            "categories": "Benchmark;",
+            "reference": "",
+        }
+    return services
+
+
+def make_wall(directory, services, allowed, seed=0):
+    """Write a catalog and realms in directory, and return a ServiceWall
+    class using them.
+    """
+    catalog = synthetic_catalog(services, seed)
+    names = sorted(catalog)
+    rng = random.Random(seed)
+    realm = { name: rng.choice(("local", "global"))
+              for name in rng.sample(names, allowed) }
+    with open(os.path.join(directory, "services.json"), "w") as fd:
+        json.dump(catalog, fd)
+    with open(os.path.join(directory, "realms.json"), "w") as fd:
+        json.dump({ ServiceWall.identifier + ":default": {}, REALM: realm },
+                  fd)
+
+    class BenchWall(ServiceWall):
+        config_file = os.path.join(directory, "config.cfg")
+        realm_defs_dict = os.path.join(directory, "realms.json")
+        service_defs_seed = os.path.join(directory, "services.json")
+        gufw_defs_dir = os.path.join(directory, "gufw") + "/"
+        service_defs_dir = os.path.join(directory, "services") + "/"
+        catalog_file = os.path.join(directory, "services.cat")
+        completion_cache = os.path.join(directory, "completion.json")
+        hits_file = os.path.join(directory, "hits.json")
+        rulesets_dir = os.path.join(directory, "rulesets")
+
+    extra = next(name for name in names if name not in realm)
+    return BenchWall, extra
+
+
+def fake_network():
+    network_helpers.get_realm_id = lambda: REALM
+    network_helpers.get_subnetwork = lambda: "192.168.1.0/255.255.255.0"
+    network_helpers.get_local_networks = lambda: ["192.168.1.0/24"]
+    # No ipset command ; scopes are matched on addresses :
+    ipset.available = lambda: False
+
+
+def run_round(wall_class, extra, ports):
+    """Run all steps once ; return {step: (seconds, simulated, ops)}."""
+    fake_iptc.reset()
+    results = {}
+    state = {}
+
+    def step(name, function):
+        fake_iptc.STATS.clear()
+        start = time.perf_counter()
+        function()
+        seconds = time.perf_counter() - start
+        stats = dict(fake_iptc.STATS)
+        simulated = stats.pop("simulated", 0.0)
+        results[name] = (seconds, simulated, stats)
+
+    def init():
+        state["firewall"] = wall_class()
+
+    def lookup():
+        for port in ports:
+            state["firewall"].list_services_by_port(port)
+
+    with redirect_stdout(io.StringIO()):
+        step("init", init)
+        firewall = state["firewall"]
+        step("start", lambda: firewall.start(should_check_hook=False))
+        step("reload", firewall.reload)
+        step("allow", lambda: firewall.allow_service(extra, scope="local"))
+        step("disallow", lambda: firewall.disallow_service(extra))
+        step("lookup", lookup)
+        step("stop", lambda: firewall.stop(should_check_hook=False))
+    return results
+
+
+def run_case(services, allowed, rounds):
+    """Return {step: {"seconds", "total", "ops"}} for a case, best times
+    over rounds.
+    """
+    rng = random.Random(services)
+    ports = [ str(rng.randrange(1, 65536)) for _ in range(LOOKUPS) ]
+    with tempfile.TemporaryDirectory() as directory:
+        state.LOCK_FILE = os.path.join(directory, "state.lock")
+        state.GENERATION_FILE = os.path.join(directory, "generation")
+        wall_class, extra = make_wall(directory, services, allowed)
+        with redirect_stdout(io.StringIO()):
+            # Compile the catalog once, out of the timings :
+            wall_class()
+        best = {}
+        for _ in range(rounds):
+            for name, (seconds, simulated, ops) in \
+                    run_round(wall_class, extra, ports).items():
+                if name not in best or seconds < best[name]["seconds"]:
+                    best[name] = {
+                        "seconds": seconds,
+                        "total": seconds + simulated,
+                        "ops": ops,
+                    }
+    return best
+
+
+def compare(results, baseline, tolerance):
+    """Return a list of regressions of results against baseline."""
+    regressions = []
+    for case, steps in results.items():
+        for name, result in steps.items():
+            reference = baseline.get(case, {}).get(name)
+            if reference is None:
+                continue
+            for op, count in result["ops"].items():
+                if count > reference["ops"].get(op, 0):
+                    regressions.append("%s %s : %i %s, was %i" % (
+                        case, name, count, op, reference["ops"].get(op, 0)))
+            limit = max(reference["total"] * (1 + tolerance),
+                        reference["total"] + FLOOR)
+            if result["total"] > limit:
+                regressions.append("%s %s : %.4fs, was %.4fs" % (
+                    case, name, result["total"], reference["total"]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="benchmark ServiceWall's control plane")
+    parser.add_argument("--cases", choices=sorted(CASES), default="small",
+                        help="which catalog and realm sizes to run")
+    parser.add_argument("--rounds", type=int, default=3,
+                        help="runs of each case, the best one counts")
+    parser.add_argument("--baseline", default=BASELINE_FILE,
+                        help="results to compare with")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE,
+                        help="how much slower than the baseline is allowed")
+    parser.add_argument("--save", action="store_true",
+                        help="save results as the new baseline")
+    args = parser.parse_args()
+    fake_network()
+
+    results = {}
+    for services, allowed in CASES[args.cases]:
+        case = "%i services, %i allowed" % (services, allowed)
+        results[case] = run_case(services, allowed, args.rounds)
+        print(case)
+        for name in STEPS:
+            result = results[case][name]
+            print("  %-9s %9.4fs %9.4fs with table costs   %s" % (
+                name, result["seconds"], result["total"],
+                " ".join("%s=%i" % op
+                         for op in sorted(result["ops"].items()))))
+
+    if args.save:
+        try:
+            with open(args.baseline) as fd:
+                baseline = json.load(fd)
+        except FileNotFoundError:
+            baseline = {}
+        baseline.update(results)
+        with open(args.baseline, "w") as fd:
+            json.dump(baseline, fd, indent=2, sort_keys=True)
+        print("saved baseline to %s" % args.baseline)
+        return
+    try:
+        with open(args.baseline) as fd:
+            baseline = json.load(fd)
+    except FileNotFoundError:
+        print("no baseline in %s" % args.baseline)
+        return
+    regressions = compare(results, baseline, args.tolerance)
+    if regressions:
+        raise SystemExit("regressions :\n  " + "\n  ".join(regressions))
+    print("no regression against %s" % args.baseline)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,280 @@
+"""In-memory stand-in for python-iptables, for benchmarks
+
+Implements the part of iptc that ServiceWall uses - tables, chains, rules,
+matches and targets - without root nor a kernel. It keeps a kernel copy and a
+working copy of each table, like libiptc's handles, and counts what is done
+to them in STATS :
+
+    refreshes, commits                 whole table reads and writes
+    reads, inserts, appends, deletes   rule operations
+    policies                           policy changes
+
+Committing a table makes the kernel rewrite it whole, so its cost grows with
+its number of rules ; reading it back too. Rather than sleeping, these costs
+are added up in STATS["simulated"], in seconds :
+
+    COMMIT_COST + RULE_COST * rules     for each commit
+    REFRESH_COST + RULE_COST * rules    for each refresh
+
+As in python-iptables, a table with autocommit on is refreshed before each
+read and committed after each change.
+
+Call install() before importing servicewall.
+"""
+
+import sys
+import types
+from collections import Counter
+
+
+# Rough figures of libiptc on a laptop, in seconds :
+COMMIT_COST = 0.002
+REFRESH_COST = 0.0005
+RULE_COST = 0.000002
+
+STATS = Counter()
+
+
+class IPTCError(Exception):
+    pass
+
+
+class Policy():
+
+    def __init__(self, name):
+        self.name = name
+
+
+class Match():
+
+    def __init__(self, rule, name):
+        self.__dict__["rule"] = rule
+        self.__dict__["name"] = name
+        self.__dict__["parameters"] = {}
+
+    def set_parameter(self, parameter, value=None):
+        if isinstance(value, (list, tuple)):
+            value = " ".join(value)
+        self.parameters[parameter.replace("-", "_")] = value
+
+    def __setattr__(self, parameter, value):
+        self.set_parameter(parameter, value)
+
+    def __getattr__(self, parameter):
+        return self.__dict__["parameters"].get(parameter)
+
+    def get_all_parameters(self):
+        return dict(self.parameters)
+
+
+class Target(Match):
+    pass
+
+
+class Rule():
+
+    def __init__(self):
+        self.matches = []
+        self.target = None
+        self.src = "0.0.0.0/0.0.0.0"
+        self.dst = "0.0.0.0/0.0.0.0"
+        self.protocol = "ip"
+        self.in_interface = None
+        self.out_interface = None
+        self.counters = (0, 0)
+        self._key = None
+
+    def create_target(self, name):
+        self.target = Target(self, name)
+        return self.target
+
+    def create_match(self, name):
+        match = Match(self, name)
+        self.matches.append(match)
+        return match
+
+    def add_match(self, match):
+        if match not in self.matches:
+            self.matches.append(match)
+
+    def final_check(self):
+        pass
+
+    def get_counters(self):
+        return self.counters
+
+    def key(self):
+        """What tells apart two rules, as libiptc compares their entries."""
+        if self._key is None:
+            target = self.target
+            self._key = (
+                self.src, self.dst, self.protocol, self.in_interface,
+                self.out_interface,
+                target and (target.name,
+                            tuple(sorted(target.parameters.items()))),
+                tuple((match.name, tuple(sorted(match.parameters.items())))
+                      for match in self.matches))
+        return self._key
+
+    def __eq__(self, other):
+        return self is other or self.key() == other.key()
+
+    def __hash__(self):
+        return hash(self.key())
+
+
+Rule6 = Rule
+
+
+def _copy(rule):
+    copied = Rule()
+    for attribute in ("src", "dst", "protocol", "in_interface",
+                      "out_interface", "counters"):
+        setattr(copied, attribute, getattr(rule, attribute))
+    if rule.target:
+        copied.create_target(rule.target.name).parameters.update(
+            rule.target.parameters)
+    for match in rule.matches:
+        copied.create_match(match.name).parameters.update(match.parameters)
+    return copied
+
+
+class easy():
+
+    @staticmethod
+    def decode_iptc_rule(rule, ipv6=False):
+        return _copy(rule)
+
+    @staticmethod
+    def encode_iptc_rule(rule_dict, ipv6=False):
+        return _copy(rule_dict)
+
+
+class Table():
+    FILTER = "filter"
+    CHAINS = ("INPUT", "FORWARD", "OUTPUT")
+    _cache = {}
+
+    def __new__(cls, name):
+        key = (cls.__name__, name)
+        if key not in Table._cache:
+            table = object.__new__(cls)
+            table.name = name
+            table.autocommit = True
+            table.kernel = { chain: ["ACCEPT", []] for chain in cls.CHAINS }
+            table.work = None
+            table._load()
+            Table._cache[key] = table
+        return Table._cache[key]
+
+    def __init__(self, name):
+        pass
+
+    def _size(self):
+        return sum(len(rules) for _, rules in self.kernel.values())
+
+    def _load(self):
+        self.work = { chain: [policy, list(rules)]
+                      for chain, (policy, rules) in self.kernel.items() }
+
+    def refresh(self):
+        STATS["refreshes"] += 1
+        STATS["simulated"] += REFRESH_COST + RULE_COST * self._size()
+        self._load()
+
+    def commit(self):
+        self.kernel = { chain: [policy, list(rules)]
+                        for chain, (policy, rules) in self.work.items() }
+        STATS["commits"] += 1
+        STATS["simulated"] += COMMIT_COST + RULE_COST * self._size()
+
+    def _before_read(self):
+        if self.autocommit:
+            self.refresh()
+
+    def _after_write(self):
+        if self.autocommit:
+            self.commit()
+
+
+class Table6(Table):
+    pass
+
+
+class Chain():
+
+    def __init__(self, table, name):
+        self.table = table
+        self.name = name
+
+    def _chain(self):
+        return self.table.work[self.name]
+
+    @property
+    def rules(self):
+        self.table._before_read()
+        STATS["reads"] += 1
+        return list(self._chain()[1])
+
+    def insert_rule(self, rule, position=0):
+        STATS["inserts"] += 1
+        self._chain()[1].insert(position, rule)
+        self.table._after_write()
+
+    def append_rule(self, rule):
+        STATS["appends"] += 1
+        self._chain()[1].append(rule)
+        self.table._after_write()
+
+    def delete_rule(self, rule):
+        STATS["deletes"] += 1
+        rules = self._chain()[1]
+        for index, chain_rule in enumerate(rules):
+            if chain_rule == rule:
+                del rules[index]
+                break
+        else:
+            raise IPTCError("can't delete rule : no such rule")
+        self.table._after_write()
+
+    def flush(self):
+        self._chain()[1] = []
+        self.table._after_write()
+
+    def set_policy(self, policy):
+        STATS["policies"] += 1
+        self._chain()[0] = policy
+        self.table._after_write()
+
+    def get_policy(self):
+        self.table._before_read()
+        return Policy(self._chain()[0])
+
+    def get_counters(self):
+        self.table._before_read()
+        return (0, 0)
+
+
+def reset():
+    """Empty all tables and counts."""
+    Table._cache.clear()
+    STATS.clear()
+
+
+def install():
+    """Make `import iptc` and `from iptc.ip4tc import IPTCError` give this
+    module.
+    """
+    module = sys.modules[__name__]
+    sys.modules["iptc"] = module
+    sys.modules["iptc.ip4tc"] = module
+    if "systemd" not in sys.modules:
+        try:
+            import systemd.journal
+        except ImportError:
+            # Logs aren't benchmarked here ; statefulfirewall only needs the
+            # name to import.
+            systemd = types.ModuleType("systemd")
+            systemd.journal = types.ModuleType("systemd.journal")
+            sys.modules["systemd"] = systemd
+            sys.modules["systemd.journal"] = systemd.journal
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+"""Replay benchmark for servicewall.logparser
+
+Parses log lines as fast as it can and reports lines per second. Lines are
+read from a file, one per line - as given by
+
+    journalctl -u servicewall-nflog -o cat > lines.txt
+
+or made up if no file is given. Exits with an error if the rate is below
+--min-rate.
+
+Usage: %s [--lines FILE] [--count N] [--min-rate RATE]
+"""
+
+import sys
+import time
+import random
+import argparse
+from datetime import datetime
+
+sys.path.insert(0, ".")
+from servicewall import logparser
+
+
+MIN_RATE = 200000
+
+
+def synthetic_lines(count, seed=0):
+    """Return count lines in PRINTPKT format, as a port scan would log."""
+    rng = random.Random(seed)
+    lines = []
+    for i in range(count):
+        proto = rng.choice(("TCP", "TCP", "TCP", "UDP", "2"))
+        line = ("Oct 18 10:12:01 host not in allowed services IN=wlan0 OUT= "
+                "MAC=01:00:5e:00:00:fb:4c:cc:6a:12:34:56:08:00 "
+                "SRC=192.168.1.%i DST=192.168.1.3 LEN=60 TOS=00 PREC=0x00 "
+                "TTL=64 ID=%i DF PROTO=%s" % (rng.randrange(1, 255),
+                                              rng.randrange(65536), proto))
+        if proto != "2":
+            line += " SPT=%i DPT=%i" % (rng.randrange(1024, 65536),
+                                        rng.randrange(1, 65536))
+        if proto == "TCP":
+            line += " WINDOW=64240 RES=0x00 SYN URGP=0"
+        lines.append(line)
+    return lines
+
+
+def run(lines, rounds=5):
+    """Return the best rate in lines per second over rounds."""
+    parse = logparser.parse_message
+    log_date = datetime.now()
+    best = 0
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for line in lines:
+            parse(line, log_date)
+        best = max(best, len(lines) / (time.perf_counter() - start))
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark the log parser")
+    parser.add_argument("--lines", help="file of recorded log lines")
+    parser.add_argument("--count", type=int, default=100000,
+                        help="number of synthetic lines")
+    parser.add_argument("--min-rate", type=int, default=MIN_RATE,
+                        help="lines per second to reach")
+    args = parser.parse_args()
+    if args.lines:
+        with open(args.lines) as fd:
+            lines = fd.read().splitlines()
+    else:
+        lines = synthetic_lines(args.count)
+    rate = run(lines)
+    print("logparser : %i lines/s over %i lines" % (rate, len(lines)))
+    if rate < args.min_rate:
+        raise SystemExit("below %i lines/s" % args.min_rate)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,17 +5,118 @@ import os
 import wx.adv
 import wx
 import json
+import time
+import threading
+from datetime import datetime
 import servicewall
+from servicewall import client
+from servicewall.aggregates import Aggregates
+from servicewall.statefulfirewall import StateFulFireWall
 
 
 lib_path = "/usr/lib/servicewall/"
 #lib_path = os.path.dirname(os.path.abspath(__file__)) + "/"
 LOG_LIMIT = 10
+# Ports hit in the last PERIOD seconds are shown :
+PERIOD = 3600
+# Seconds between two checks of the firewall's status :
+STATUS_INTERVAL = 10
 TRAY_TOOLTIP = 'ServiceWall' 
 TRAY_ICON = lib_path + "icon.png"
 TRAY_ICON2 = lib_path + "icon2.png"
 
 
+class TrayState():
+    """What the systray shows, kept in memory and up to date by two worker
+    threads : one follows the journal and counts dropped packets by port,
+    the other polls the firewall's status. on_change gets called on the GUI
+    thread when either changes.
+    """
+
+    def __init__(self, on_change):
+        self.on_change = on_change
+        self.lock = threading.Lock()
+        self.aggregates = Aggregates()
+        self.status = {"enabled": False, "realm_id": None}
+        self.new_logs = 0
+        # Built the first time servicewalld isn't there to ask :
+        self.firewall = None
+        self.notified = False
+        self.stopped = threading.Event()
+
+    def start(self):
+        threading.Thread(target=self.follow_logs, daemon=True).start()
+        threading.Thread(target=self.poll_status, daemon=True).start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def _notify(self):
+        # One CallAfter at a time, however many logs come meanwhile :
+        with self.lock:
+            if self.notified:
+                return
+            self.notified = True
+        wx.CallAfter(self._changed)
+
+    def _changed(self):
+        with self.lock:
+            self.notified = False
+        self.on_change()
+
+    def read_status(self):
+        """Return the firewall's status, from servicewalld if it's running."""
+        try:
+            state = client.call("status")
+        except OSError:
+            # No daemon, or we may not use its socket ; DaemonUnavailable
+            # is an OSError too.
+            if self.firewall is None:
+                self.firewall = servicewall.ServiceWall()
+            else:
+                self.firewall.update_realm()
+            state = {"enabled": self.firewall.is_enabled(),
+                     "realm_id": self.firewall.realm_id}
+        return {"enabled": state["enabled"], "realm_id": state["realm_id"]}
+
+    def poll_status(self):
+        while True:
+            try:
+                status = self.read_status()
+            except Exception as error:
+                # Try again next time ; show what went wrong meanwhile.
+                print("can't read the firewall's status : %s" % error)
+                status = {"enabled": False, "realm_id": "unknown (%s)" %
+                          type(error).__name__}
+            with self.lock:
+                changed = status != self.status
+                self.status = status
+            if changed:
+                self._notify()
+            if self.stopped.wait(STATUS_INTERVAL):
+                return
+
+    def follow_logs(self):
+        # Reading the journal needs no root, nor a whole ServiceWall :
+        for log in StateFulFireWall().follow_logs(period=PERIOD):
+            with self.lock:
+                self.aggregates.add(log)
+                self.new_logs += 1
+            self._notify()
+            if self.stopped.is_set():
+                return
+
+    def snapshot(self):
+        """Return the status, the most hit ports as aggregates.Hits, and how
+        many logs came since the last snapshot.
+        """
+        with self.lock:
+            ports = self.aggregates.top("DPT", limit=LOG_LIMIT, period=PERIOD)
+            new_logs = self.new_logs
+            self.new_logs = 0
+            return dict(self.status), ports, new_logs
+
+
 class TaskBarIcon(wx.adv.TaskBarIcon):
     """A systray icon with a panel showing latest hits
     """
@@ -24,6 +125,24 @@ class TaskBarIcon(wx.adv.TaskBarIcon):
         super(TaskBarIcon, self).__init__()
         self.SetIcon(wx.Icon(wx.IconLocation(TRAY_ICON2)), "ServiceWall")
         self.Bind(wx.adv.EVT_TASKBAR_LEFT_DOWN, self.on_left_down)
+        self.state = TrayState(self.on_state_change)
+        self.state.start()
+        # Logs that came since the popup was last shown :
+        self.unseen = 0
+
+    def on_state_change(self):
+        """Runs on the GUI thread when drops come or the status changes."""
+        with self.state.lock:
+            self.unseen += self.state.new_logs
+            self.state.new_logs = 0
+            enabled = self.state.status["enabled"]
+        if self.unseen:
+            self.SetIcon(wx.Icon(wx.IconLocation(TRAY_ICON)),
+                         "ServiceWall - %i new drops" % self.unseen)
+        else:
+            self.SetIcon(wx.Icon(wx.IconLocation(TRAY_ICON2)),
+                         "ServiceWall - %s" %
+                         ("enabled" if enabled else "disabled"))
 
     def CreatePopupMenu(self):
         """gets automatically called on systray's right-click"""
@@ -37,28 +156,21 @@ class TaskBarIcon(wx.adv.TaskBarIcon):
         r = wx.GetClientDisplayRect()
         position = (r.top, r.right)
         window = wx.PopupTransientWindow(self.frame, flags=wx.BORDER_NONE)
-        fw = servicewall.ServiceWall()
-        yielder = fw.yield_logs(limit=LOG_LIMIT)
+        # Everything is in memory already ; nothing to wait for :
+        state, ports, _ = self.state.snapshot()
+        self.unseen = 0
+        self.on_state_change()
         panel = wx.Panel(window)
         i = 0
         panel_sizer = wx.BoxSizer(wx.HORIZONTAL)
         icons = []
         labels = []
-        logs_by_port = {}
-
-        # First sort logs by port :
-        for log in yielder:
-            if log["DPT"] not in logs_by_port:
-                logs_by_port[log["DPT"]] = [log,]
-            else:
-                logs_by_port[log["DPT"]].append(log)
 
-        # Then display them :
         status_sizer = wx.BoxSizer(wx.VERTICAL)
-        logs_sizer = wx.GridSizer(len(logs_by_port) + 1, 4, 0, 0)
+        logs_sizer = wx.GridSizer(len(ports) + 1, 4, 0, 0)
         status_label = wx.StaticText(panel, label="", style=wx.ALIGN_CENTER)
-        status_details = wx.StaticText(panel, label="\nrealm : %s" % fw.realm_id, style=wx.ALIGN_CENTER)
-        if fw.config["enabled"]:
+        status_details = wx.StaticText(panel, label="\nrealm : %s" % state["realm_id"], style=wx.ALIGN_CENTER)
+        if state["enabled"]:
             status_str = "enabled"
         else:
             status_str = "disabled"
@@ -74,9 +186,12 @@ class TaskBarIcon(wx.adv.TaskBarIcon):
         logs_sizer.Add(wx.StaticText(panel, label='port'), 1, wx.ALIGN_RIGHT, 0)
         logs_sizer.Add(wx.StaticText(panel, label="hits"), 1, wx.ALIGN_RIGHT, 0)
         logs_sizer.Add(wx.StaticText(panel, label="age"), 1, wx.ALIGN_RIGHT, 0)
-        for name, logpile in logs_by_port.items():
-            date = logpile[0]["LOG_DATE"]
-            delta = date.now() - date
+        now = time.time()
+        for hit in ports:
+            # Dates of keys pushed out of the aggregates are lost :
+            last_seen = hit.last_seen or now
+            delta = datetime.fromtimestamp(now) - \
+                datetime.fromtimestamp(last_seen)
             if delta.seconds <= 60:
                 age = str(delta.seconds) + "'"
             else:
@@ -85,8 +200,8 @@ class TaskBarIcon(wx.adv.TaskBarIcon):
             #bitmap = wx.Bitmap(rawbitmap.ConvertToImage().Rescale(40, 40))
             icons.append(wx.StaticBitmap(panel, -1, bitmap))
             labels.append([
-                    wx.StaticText(panel, label="%s" % logpile[0]["DPT"], style=wx.ALIGN_RIGHT),
-                    wx.StaticText(panel, label="%i" % len(logpile)),
+                    wx.StaticText(panel, label="%s" % hit.value, style=wx.ALIGN_RIGHT),
+                    wx.StaticText(panel, label="%i" % hit.hits),
                     wx.StaticText(panel, label="%s" % age)
             ])
             logs_sizer.Add(icons[i], 1, wx.ALL, 0)
@@ -119,6 +234,7 @@ class TaskBarIcon(wx.adv.TaskBarIcon):
         m = menu.GetMenuItems()[event.Id]
 
     def on_exit(self, event):
+        self.state.stop()
         wx.CallAfter(self.Destroy)
         self.frame.Close()
 
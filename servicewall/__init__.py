@@ -1,12 +1,9 @@
 """This is ServiceWall's package definition. See main.py for real content.
 """
 import os
-import pickle
+import json
 #from pkgutil import extend_path
 #__path__ = extend_path(__path__, __name__)
-from servicewall.main import ServiceWall
-# update_service_defs needs to have service_helpers imported
-# to have working pickle in the ServiceWall class.
 from servicewall import service_helpers
 
 
@@ -16,17 +13,44 @@ __all__ = [
     "service_helpers",
     "network_helpers",
     "main",
+    "catalog",
+    "completion",
+    "nftables",
+    "ipset",
+    "nflog",
+    "aggregates",
+    "topk",
+    "logparser",
+    "resolver",
+    "hitrates",
+    "metrics",
+    "ruleset",
+    "dispatcher",
+    "state",
     "statefulfirewall",
     "firewall",
 ]
 
+def __getattr__(name):
+    # Importing ServiceWall pulls iptc and systemd in ; only do it when
+    # servicewall.ServiceWall is asked for, so that light modules like
+    # completion stay quick to import.
+    if name == "ServiceWall":
+        from servicewall.main import ServiceWall
+        return ServiceWall
+    raise AttributeError("module %s has no attribute %s" % (__name__, name))
+
+
 def update_service_defs():
-    service_pickle = "lib/services.p"
+    service_json = "lib/services.json"
     service_defs_dir = "/etc/gufw/app_profiles"
-    service = service_helpers.scan_service_definitions(service_defs_dir)
-    print("writing defs from %s to %s" % (service_defs_dir, service_pickle))
-    if os.path.isfile(service_pickle):
-        raise SystemError("There's already a file named %s" % service_pickle)
-    with open(service_pickle, "wb") as fd:
-        pickle.dump(service, fd)
-
+    services = service_helpers.scan_service_definitions(service_defs_dir)
+    print("writing defs from %s to %s" % (service_defs_dir, service_json))
+    if os.path.isfile(service_json):
+        raise SystemError("There's already a file named %s" % service_json)
+    service_dicts = {}
+    for service_name, service in services.items():
+        service_dicts[service_name] = service._asdict()
+        service_dicts[service_name]["ports"] = service.ports._asdict()
+    with open(service_json, "w") as fd:
+        json.dump(service_dicts, fd, indent=2)
@@ -0,0 +1,183 @@
+"""Live aggregates of dropped packets
+
+Counts logs by (DPT, SRC, PROTO) as they come, so that questions like "which
+ports were hit most in the last 10 minutes" are answered from counters
+instead of rereading the journal.
+
+Counts go into three rings of time buckets :
+
+    60 buckets of a second, 60 of a minute and 24 of an hour
+
+each bucket counting the keys seen during its time in a topk.SpaceSaving of
+bucket_keys counters, so that a scan from many sources can't grow it : past
+that many keys, the least hit ones share counters and counts may be a bit
+high. A query for a period sums the buckets of the finest ring that covers
+it - at most 60 of them, whatever the number of logs. First and last seen
+dates are kept for each key, for up to max_keys keys ; the ones seen least
+recently are dropped first.
+
+Each Hit tells how much its count may be too high from the counters it
+shared, and error_bound how much any count of a period may be off by.
+"""
+
+import math
+import time
+from collections import Counter, OrderedDict, namedtuple
+
+from servicewall import topk
+
+
+KEY_FIELDS = ("DPT", "SRC", "PROTO")
+# (bucket width in seconds, number of buckets) :
+RINGS = ((1, 60), (60, 60), (3600, 24))
+MAX_KEYS = 65536
+BUCKET_KEYS = 1024
+
+
+Hit = namedtuple("Hit", "value hits first_seen last_seen error")
+
+
+class Ring():
+    """size buckets of width seconds, reused as time goes."""
+
+    def __init__(self, width, size, bucket_keys=BUCKET_KEYS):
+        self.width = width
+        self.size = size
+        self.span = width * size
+        self.bucket_keys = bucket_keys
+        self.buckets = [ topk.SpaceSaving(bucket_keys) for _ in range(size) ]
+        self.numbers = [ None ] * size
+
+    def add(self, key, timestamp, hits=1):
+        number = int(timestamp // self.width)
+        slot = number % self.size
+        if self.numbers[slot] != number:
+            if self.numbers[slot] is not None and \
+                    self.numbers[slot] > number:
+                # Older than what this ring still holds.
+                return
+            self.numbers[slot] = number
+            self.buckets[slot] = topk.SpaceSaving(self.bucket_keys)
+        self.buckets[slot].add(key, hits)
+
+    def buckets_since(self, period, now):
+        """Yield the SpaceSavings of buckets covering the last period
+        seconds.
+        """
+        last = int(now // self.width)
+        first = last - min(math.ceil(period / self.width), self.size) + 1
+        for number in range(first, last + 1):
+            slot = number % self.size
+            if self.numbers[slot] == number:
+                yield self.buckets[slot]
+
+
+class Aggregates():
+    """Rolling counts of logs by (DPT, SRC, PROTO).
+
+    An Aggregates is a sink for servicewall.nflog : call it with a log.
+    """
+
+    def __init__(self, rings=RINGS, max_keys=MAX_KEYS,
+                 bucket_keys=BUCKET_KEYS):
+        self.rings = [ Ring(width, size, bucket_keys)
+                       for width, size in rings ]
+        self.max_keys = max_keys
+        # key -> [first seen, last seen], least recently seen first :
+        self.seen = OrderedDict()
+        self.last_date = None
+
+    @property
+    def span(self):
+        """How far back in seconds we can count."""
+        return self.rings[-1].span
+
+    def __call__(self, log):
+        self.add(log)
+
+    def add(self, log):
+        key = tuple(log[field] for field in KEY_FIELDS)
+        timestamp = log["LOG_DATE"].timestamp()
+        for ring in self.rings:
+            ring.add(key, timestamp)
+        if key in self.seen:
+            dates = self.seen[key]
+            dates[0] = min(dates[0], timestamp)
+            dates[1] = max(dates[1], timestamp)
+            self.seen.move_to_end(key)
+        else:
+            self.seen[key] = [timestamp, timestamp]
+            if len(self.seen) > self.max_keys:
+                self.seen.popitem(last=False)
+        if self.last_date is None or log["LOG_DATE"] > self.last_date:
+            self.last_date = log["LOG_DATE"]
+
+    def feed(self, logs):
+        for log in logs:
+            self.add(log)
+
+    def _ring(self, period):
+        """Return the finest ring that covers the last period seconds."""
+        for ring in self.rings:
+            if period <= ring.span:
+                break
+        return ring
+
+    def bucket_width(self, period):
+        """Return the width in seconds of the buckets counting the last
+        period seconds : counts cover that period rounded up to whole
+        buckets.
+        """
+        return self._ring(int(period)).width
+
+    def counts(self, period, now=None):
+        """Return a Counter of hits by key over the last period seconds."""
+        return self._estimates(period, now)[0]
+
+    def error_bound(self, period, now=None):
+        """The most any count over the last period seconds may be off by :
+        the sum of its buckets' error bounds.
+        """
+        if now is None:
+            now = time.time()
+        period = int(period)
+        return sum(bucket.error_bound for bucket in
+                   self._ring(period).buckets_since(period, now))
+
+    def _estimates(self, period, now=None):
+        """Return Counters of hits and errors by key over the last period
+        seconds.
+        """
+        if now is None:
+            now = time.time()
+        period = int(period)
+        counts = Counter()
+        errors = Counter()
+        for bucket in self._ring(period).buckets_since(period, now):
+            for estimate in bucket.top():
+                counts[estimate.value] += estimate.count
+                errors[estimate.value] += estimate.error
+        return counts, errors
+
+    def top(self, criteria, limit=None, period=60, now=None):
+        """Return the most hit values of criteria ("DPT", "SRC" or "PROTO")
+        over the last period seconds, as a list of Hits, most hit first.
+        """
+        field = KEY_FIELDS.index(criteria)
+        hits = Counter()
+        errors = Counter()
+        dates = {}
+        counts, key_errors = self._estimates(period, now)
+        for key, count in counts.items():
+            value = key[field]
+            hits[value] += count
+            errors[value] += key_errors[key]
+            if key in self.seen:
+                first, last = self.seen[key]
+                if value in dates:
+                    first = min(first, dates[value][0])
+                    last = max(last, dates[value][1])
+                dates[value] = (first, last)
+        return [ Hit(value, count, *dates.get(value, (None, None)),
+                     errors[value])
+                 for value, count in hits.most_common(limit) ]
@@ -0,0 +1,320 @@
+"""Compiled service catalog
+
+Service definitions come from several sources : the definitions shipped with
+ServiceWall (services.json, converted from jhansonxi's), those of gufw if it
+is installed, and custom ones in /etc/servicewall/services/. Parsing them all
+on every run is slow, so they get compiled into one binary file that is then
+opened through mmap. Only the services actually looked at get decoded.
+
+The compiled file records the mtime and size of every source file ; when one
+of them changes, is added or is removed, the catalog is compiled again.
+
+Layout of the file (all integers are little-endian) :
+
+    header    magic, version, count and offsets of the following sections
+    manifest  json dict of source path -> [mtime_ns, size]
+    entries   count * (name offset, name length, record offset, record length)
+    sorted    count * entry number, sorted by service name
+    ports     number of ranges, then (proto, start, end, entry number) each
+    blobs     service names, then json records of the services
+"""
+
+import os
+import json
+import mmap
+import struct
+import hashlib
+from collections.abc import MutableMapping
+
+from servicewall import state
+from servicewall.service_helpers import PortDef, ServiceDef
+from servicewall.service_helpers import scan_service_definitions
+from servicewall.service_helpers import parse_port_range
+
+
+CATALOG_FILE = "/var/cache/servicewall/services.cat"
+SEED_FILE = "/usr/lib/servicewall/services.json"
+GUFW_DEFS_DIR = "/etc/gufw/app_profiles/"
+CUSTOM_DEFS_DIR = "/etc/servicewall/services/"
+
+MAGIC = b"SWCAT\x00"
+VERSION = 1
+PROTOCOLS = ("tcp", "udp")
+
+_header = struct.Struct("<6sHIIIII")
+_entry = struct.Struct("<IHII")
+_index = struct.Struct("<I")
+_port_range = struct.Struct("<BIII")
+
+
+def _list_dir(directory):
+    """Return paths of non-hidden files in directory, or [] if it's absent."""
+    try:
+        names = sorted(os.listdir(directory))
+    except FileNotFoundError:
+        return []
+    return [ os.path.join(directory, name) for name in names
+             if not name.startswith(".") ]
+
+
+def _manifest(seed_file, gufw_defs_dir, custom_defs_dir):
+    """Return a dict of source path -> [mtime_ns, size]."""
+    manifest = {}
+    for path in (seed_file,
+                 *_list_dir(gufw_defs_dir),
+                 *_list_dir(custom_defs_dir)):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        manifest[path] = [stat.st_mtime_ns, stat.st_size]
+    return manifest
+
+
+def _service_def(service_dict):
+    service_dict = dict(service_dict)
+    service_dict["ports"] = PortDef(**service_dict["ports"])
+    return ServiceDef(**service_dict)
+
+
+def scan_sources(seed_file, gufw_defs_dir, custom_defs_dir):
+    """Read all service definitions from their sources, in a dict of
+    service name -> ServiceDef.
+    """
+    service_defs = {}
+    try:
+        with open(seed_file) as fd:
+            for service_name, service_dict in json.load(fd).items():
+                service_defs[service_name] = _service_def(service_dict)
+    except FileNotFoundError:
+        print("Warning : no service definitions in %s" % seed_file)
+    if os.path.isdir(gufw_defs_dir):
+        service_defs.update(scan_service_definitions(gufw_defs_dir))
+    for service_file in _list_dir(custom_defs_dir):
+        try:
+            with open(service_file) as fd:
+                sdef = _service_def(json.load(fd))
+                service_defs[sdef.title] = sdef
+        except TypeError as error:
+            print("Warning : ServiceDef." + str(error),
+                  "in " + service_file)
+    return service_defs
+
+
+def _port_ranges(service_def):
+    """Return service_def's ports as {"tcp": [(start, end), ...], "udp":
+    [...]}, leaving out the ones that aren't ports.
+    """
+    ranges = { proto: [] for proto in PROTOCOLS }
+    for proto in PROTOCOLS:
+        for port in getattr(service_def.ports, proto):
+            try:
+                ranges[proto].append(parse_port_range(port))
+            except ValueError:
+                continue
+    return ranges
+
+
+def compile_catalog(service_defs, manifest):
+    """Return the bytes of a catalog holding service_defs."""
+    names = [ service_name.encode() for service_name in service_defs ]
+    records = []
+    port_ranges = []
+    for number, service_def in enumerate(service_defs.values()):
+        service_dict = service_def._asdict()
+        service_dict["ports"] = service_def.ports._asdict()
+        records.append(json.dumps(service_dict).encode())
+        ranges = _port_ranges(service_def)
+        for proto_number, proto in enumerate(PROTOCOLS):
+            for start, end in ranges[proto]:
+                port_ranges.append((proto_number, start, end, number))
+    manifest_blob = json.dumps(manifest, sort_keys=True).encode()
+
+    count = len(names)
+    manifest_offset = _header.size
+    entries_offset = manifest_offset + _index.size + len(manifest_blob)
+    sorted_offset = entries_offset + count * _entry.size
+    ports_offset = sorted_offset + count * _index.size
+    blobs_offset = ports_offset + _index.size + \
+        len(port_ranges) * _port_range.size
+
+    chunks = [
+        _header.pack(MAGIC, VERSION, count, manifest_offset, entries_offset,
+                     sorted_offset, ports_offset),
+        _index.pack(len(manifest_blob)),
+        manifest_blob,
+    ]
+    # Names come first in the blobs, then records :
+    offset = blobs_offset
+    name_offsets = []
+    for name in names:
+        name_offsets.append(offset)
+        offset += len(name)
+    for name_offset, name, record in zip(name_offsets, names, records):
+        chunks.append(_entry.pack(name_offset, len(name),
+                                  offset, len(record)))
+        offset += len(record)
+    chunks.extend(_index.pack(number) for number in
+                  sorted(range(count), key=names.__getitem__))
+    chunks.append(_index.pack(len(port_ranges)))
+    chunks.extend(_port_range.pack(*port_range)
+                  for port_range in port_ranges)
+    chunks.extend(names)
+    chunks.extend(records)
+    return b"".join(chunks)
+
+
+class Catalog(MutableMapping):
+    """A dict of service name -> ServiceDef read from a compiled catalog.
+
+    Services are decoded the first time they are looked up. Services set
+    after loading are kept in memory only, on top of the compiled ones.
+    """
+
+    def __init__(self, data):
+        self._data = data
+        magic, version, self._count, manifest_offset, self._entries_offset, \
+            self._sorted_offset, self._ports_offset = \
+            _header.unpack_from(data, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("not a ServiceWall catalog of version %i"
+                             % VERSION)
+        manifest_size, = _index.unpack_from(data, manifest_offset)
+        start = manifest_offset + _index.size
+        self._manifest_blob = bytes(data[start:start + manifest_size])
+        self.manifest = json.loads(self._manifest_blob)
+        # Changes whenever a source does :
+        self.version = hashlib.sha1(self._manifest_blob).hexdigest()[:16]
+        self._decoded = {}
+        self._overlay = {}
+        self._deleted = set()
+
+    def _entry(self, number):
+        return _entry.unpack_from(self._data,
+                                  self._entries_offset + number * _entry.size)
+
+    def _name_bytes(self, number):
+        name_offset, name_size, _, _ = self._entry(number)
+        return bytes(self._data[name_offset:name_offset + name_size])
+
+    def _name(self, number):
+        return self._name_bytes(number).decode()
+
+    def _find(self, service_name):
+        """Return the entry number of service_name, by bisection over the
+        sorted section, or None.
+        """
+        key = service_name.encode()
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            number, = _index.unpack_from(
+                self._data, self._sorted_offset + middle * _index.size)
+            name = self._name_bytes(number)
+            if name < key:
+                low = middle + 1
+            elif name > key:
+                high = middle
+            else:
+                return number
+        return None
+
+    def __getitem__(self, service_name):
+        if service_name in self._overlay:
+            return self._overlay[service_name]
+        if service_name in self._deleted:
+            raise KeyError(service_name)
+        if service_name not in self._decoded:
+            number = self._find(service_name)
+            if number is None:
+                raise KeyError(service_name)
+            _, _, record_offset, record_size = self._entry(number)
+            self._decoded[service_name] = _service_def(json.loads(
+                self._data[record_offset:record_offset + record_size]))
+        return self._decoded[service_name]
+
+    def __contains__(self, service_name):
+        if service_name in self._overlay:
+            return True
+        if service_name in self._deleted:
+            return False
+        return self._find(service_name) is not None
+
+    def __setitem__(self, service_name, service_def):
+        self._deleted.discard(service_name)
+        self._overlay[service_name] = service_def
+
+    def __delitem__(self, service_name):
+        if service_name not in self:
+            raise KeyError(service_name)
+        self._overlay.pop(service_name, None)
+        self._deleted.add(service_name)
+
+    def _compiled_names(self):
+        for number in range(self._count):
+            yield self._name(number)
+
+    def __iter__(self):
+        for service_name in self._compiled_names():
+            if service_name not in self._deleted:
+                yield service_name
+        for service_name in self._overlay:
+            if self._find(service_name) is None:
+                yield service_name
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def port_ranges(self):
+        """Yield (service name, {"tcp": [(start, end), ...], "udp": [...]})
+        for all services. Those of compiled services are read from the port
+        table without decoding service records.
+        """
+        ranges = {}
+        count, = _index.unpack_from(self._data, self._ports_offset)
+        for i in range(count):
+            proto_number, start, end, number = _port_range.unpack_from(
+                self._data,
+                self._ports_offset + _index.size + i * _port_range.size)
+            ranges.setdefault(number, { proto: [] for proto in PROTOCOLS })
+            ranges[number][PROTOCOLS[proto_number]].append((start, end))
+        for number in range(self._count):
+            service_name = self._name(number)
+            if service_name in self._deleted or \
+                    service_name in self._overlay:
+                continue
+            yield service_name, ranges.get(
+                number, { proto: [] for proto in PROTOCOLS })
+        for service_name, service_def in self._overlay.items():
+            yield service_name, _port_ranges(service_def)
+
+
+def load(catalog_file=CATALOG_FILE,
+         seed_file=SEED_FILE,
+         gufw_defs_dir=GUFW_DEFS_DIR,
+         custom_defs_dir=CUSTOM_DEFS_DIR):
+    """Return a Catalog of all service definitions.
+
+    catalog_file is used as is if its manifest matches the sources ;
+    otherwise the sources are compiled again, and the result is written to
+    catalog_file if we're allowed to.
+    """
+    manifest = _manifest(seed_file, gufw_defs_dir, custom_defs_dir)
+    try:
+        with open(catalog_file, "rb") as fd:
+            data = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        catalog = Catalog(data)
+        if catalog.manifest == manifest:
+            return catalog
+    except (OSError, ValueError, struct.error):
+        # Missing, empty, or from another version - compile it again.
+        pass
+
+    data = compile_catalog(
+        scan_sources(seed_file, gufw_defs_dir, custom_defs_dir), manifest)
+    try:
+        state.atomic_write(catalog_file, data)
+    except OSError:
+        # Probably not root ; use it from memory this time.
+        pass
+    return Catalog(data)
@@ -0,0 +1,67 @@
+"""Client for the ServiceWall daemon
+
+Sends one command to servicewalld over its unix socket, prints what the
+command printed there, and returns its result :
+
+    client.call("allow", service_name="ssh", scope="local")
+
+Raises DaemonUnavailable if no daemon listens, so that callers can fall back
+to running the command themselves. So it does for read-only commands if we
+may not use the socket ; other commands raise PermissionError then.
+"""
+
+import json
+import socket
+
+from servicewall.daemon import SOCKET_PATH, READ_ONLY_COMMANDS
+
+
+class DaemonUnavailable(ConnectionError):
+    pass
+
+
+ERRORS = {
+    "KeyError": KeyError,
+    "SystemError": SystemError,
+    "AssertionError": AssertionError,
+    "PermissionError": PermissionError,
+    "SystemExit": SystemExit,
+}
+
+
+def _refused(command, socket_path):
+    if command in READ_ONLY_COMMANDS:
+        # Reading needs no daemon ; let the caller do it.
+        raise DaemonUnavailable("we may not use %s" % socket_path)
+    raise PermissionError("servicewalld refused us on %s" % socket_path)
+
+
+def call(command, socket_path=SOCKET_PATH, **args):
+    request = json.dumps({"command": command, "args": args}).encode() + b"\n"
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            connection.connect(socket_path)
+        except (FileNotFoundError, ConnectionRefusedError):
+            raise DaemonUnavailable("servicewalld isn't listening on %s"
+                                    % socket_path)
+        except PermissionError:
+            # Not in the socket's group :
+            _refused(command, socket_path)
+        try:
+            connection.sendall(request)
+            with connection.makefile("rb") as fd:
+                line = fd.readline()
+        except (BrokenPipeError, ConnectionResetError):
+            line = b""
+    finally:
+        connection.close()
+    if not line:
+        # The daemon refused us - we aren't in its access group :
+        _refused(command, socket_path)
+    response = json.loads(line)
+    if not response["ok"]:
+        raise ERRORS.get(response["error"], SystemError)(response["message"])
+    if response["output"]:
+        print(response["output"], end="")
+    return response["result"]
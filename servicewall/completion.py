@@ -0,0 +1,89 @@
+"""Cache for braise's argument completion
+
+Completing a service name should not cost a firewall instance, nor network
+queries. ServiceWall writes down what completion needs whenever it changes
+(service names, services allowed per realm, and the realm it runs in), and
+completers only read this small json file.
+"""
+
+import json
+
+from servicewall import state
+
+
+CACHE_FILE = "/var/cache/servicewall/completion.json"
+REALM_DEFS_DICT = "/etc/servicewall/realms.json"
+DEFAULT_REALM = "ServiceWall:default"
+
+
+def write_cache(service_names, realm_defs, realm_id, catalog_version,
+                cache_file=CACHE_FILE):
+    cache = {
+        "generation": state.generation(),
+        "catalog_version": catalog_version,
+        "realm_id": realm_id,
+        "services": list(service_names),
+        "allowed": { realm: list(services)
+                     for realm, services in realm_defs.items() },
+    }
+    try:
+        state.atomic_write(cache_file, json.dumps(cache))
+    except OSError:
+        # Not root - completion will fall back to reading the sources.
+        pass
+
+
+def renew_cache(generation, cache_file=CACHE_FILE):
+    """Mark the cache as still good for the current generation, if it was
+    for generation - after a change of state it doesn't depend on.
+    """
+    cache = read_cache(cache_file, revalidate=False)
+    if cache is None or cache.get("generation") != generation:
+        return
+    cache["generation"] = state.generation()
+    try:
+        state.atomic_write(cache_file, json.dumps(cache))
+    except OSError:
+        pass
+
+
+def read_cache(cache_file=CACHE_FILE, revalidate=True):
+    """Return the cache, or None if it's missing - or if revalidate, older
+    than the state it was written from.
+    """
+    try:
+        with open(cache_file) as fd:
+            cache = json.load(fd)
+    except (OSError, ValueError):
+        return None
+    if revalidate and cache.get("generation") != state.generation():
+        return None
+    return cache
+
+
+def complete_services(prefix, **kwargs):
+    """argcomplete completer for any known service name."""
+    cache = read_cache()
+    if cache:
+        service_names = cache["services"]
+    else:
+        from servicewall import catalog
+        service_names = catalog.load()
+    return [ name for name in service_names if name.startswith(prefix) ]
+
+
+def complete_allowed_services(prefix, **kwargs):
+    """argcomplete completer for services allowed in the last realm
+    ServiceWall ran in, or in the default one.
+    """
+    cache = read_cache()
+    if cache:
+        allowed = cache["allowed"]
+        realm_id = cache["realm_id"]
+    else:
+        with open(REALM_DEFS_DICT) as fd:
+            allowed = json.load(fd)
+        realm_id = None
+    service_names = [ *allowed.get(realm_id, []),
+                      *allowed.get(DEFAULT_REALM, []) ]
+    return [ name for name in service_names if name.startswith(prefix) ]
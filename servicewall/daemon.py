@@ -0,0 +1,331 @@
+"""ServiceWall daemon
+
+Keeps one ServiceWall in memory - service definitions, realm definitions,
+the current realm and the rule index - and serves it on a unix socket, so
+that braise, the network dispatcher's toggler and the systray don't each
+have to build their own.
+
+The protocol is one json request per connection, one line long :
+
+    {"command": "allow", "args": {"service_name": "ssh", "scope": "global"}}
+
+answered by one json line :
+
+    {"ok": true, "output": "what the command printed", "result": ...}
+    {"ok": false, "error": "KeyError", "message": "undefined service : foo."}
+
+The socket belongs to group ACCESS_GROUP. Its members may use read-only
+commands ; commands that change the firewall are for root only. Read-only
+commands don't wait for the others : reading logs doesn't hold a reload back.
+Before any other command, the firewall forgets the rules it knows of and
+rereads state files that other processes changed.
+
+Metrics are exported too if config.cfg asks for it, with the keys
+"metrics_textfile" (a path) and "metrics_address" ("127.0.0.1:9733") ; see
+servicewall.metrics.
+"""
+
+import io
+import os
+import sys
+import grp
+import json
+import signal
+import socket
+import struct
+import threading
+import socketserver
+from contextlib import contextmanager
+
+import servicewall
+from servicewall import metrics
+from servicewall.aggregates import Aggregates
+
+
+SOCKET_PATH = "/run/servicewall/control.sock"
+ACCESS_GROUP = "network"
+READ_ONLY_COMMANDS = ("status", "logs", "top", "metrics")
+# Logs sent when neither a limit nor a period is asked for :
+LOG_LIMIT = 1000
+
+
+class ControlHandler(socketserver.StreamRequestHandler):
+    """Handle one request on the control socket."""
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+            command = request["command"]
+            args = request.get("args", {})
+            if command not in self.server.commands:
+                raise KeyError("unknown command %s" % command)
+            if command not in READ_ONLY_COMMANDS and \
+                    not self.server.peer_is_root(self.connection):
+                raise PermissionError("command %s needs root" % command)
+            response = self.server.run(command, args)
+        except (Exception, SystemExit) as error:
+            # SystemExit is how ServiceWall gives up, as on a missing
+            # dispatcher ; it mustn't take the handler thread down.
+            response = {
+                "ok": False,
+                "error": type(error).__name__,
+                "message": error.args[0] if error.args else str(error),
+            }
+        self.wfile.write(json.dumps(response).encode() + b"\n")
+
+
+class ThreadOutput():
+    """Stands for sys.stdout, so that what a command prints goes to its own
+    request : each thread writes to what it captures into, if anything, or
+    to the real stdout.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def _target(self):
+        return getattr(self.local, "output", None) or self.stream
+
+    def write(self, text):
+        return self._target().write(text)
+
+    def flush(self):
+        self._target().flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+    @contextmanager
+    def capture(self):
+        """Capture what this thread prints in the block into a StringIO."""
+        output = io.StringIO()
+        self.local.output = output
+        try:
+            yield output
+        finally:
+            self.local.output = None
+
+
+class ServiceWallDaemon(socketserver.ThreadingMixIn,
+                        socketserver.UnixStreamServer):
+    """Serve a long-lived ServiceWall on a unix socket."""
+
+    daemon_threads = True
+
+    def __init__(self, socket_path=SOCKET_PATH, access_group=ACCESS_GROUP):
+        self.socket_path = socket_path
+        self.access_group = access_group
+        self.firewall = servicewall.ServiceWall()
+        self.aggregates = Aggregates()
+        # Reads logs for aggregates, keeping its own journal cursor ; it
+        # doesn't touch the firewall once built. Imported here, as the client
+        # imports this module and shouldn't pay for iptc and systemd :
+        from servicewall.statefulfirewall import StateFulFireWall
+        self.log_reader = StateFulFireWall()
+        # Journal cursor of the last log counted in aggregates :
+        self.log_cursor = None
+        # Commands change shared state ; run one at once.
+        self.lock = threading.Lock()
+        # What commands print goes to their own request :
+        if not isinstance(sys.stdout, ThreadOutput):
+            sys.stdout = ThreadOutput(sys.stdout)
+        self.output = sys.stdout
+        # Held while counting logs into aggregates, which may take long :
+        self.log_lock = threading.Lock()
+        self.commands = {
+            "start": self.start,
+            "stop": self.stop,
+            "reload": self.reload,
+            "optimize": self.optimize,
+            "apply": self.apply,
+            "allow": self.allow,
+            "disallow": self.disallow,
+            "status": self.status,
+            "logs": self.logs,
+            "top": self.top,
+            "metrics": self.metrics,
+        }
+        os.makedirs(os.path.dirname(socket_path), exist_ok=True)
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        super().__init__(socket_path, ControlHandler)
+        try:
+            group_id = grp.getgrnam(access_group).gr_gid
+        except KeyError:
+            print("no group %s, only root may use %s" %
+                  (access_group, socket_path))
+            group_id = 0
+        os.chown(socket_path, 0, group_id)
+        os.chmod(socket_path, 0o660)
+
+    def verify_request(self, request, client_address):
+        return self.peer_in_group(request)
+
+    def _peer_credentials(self, connection):
+        credentials = connection.getsockopt(socket.SOL_SOCKET,
+                                            socket.SO_PEERCRED,
+                                            struct.calcsize("3i"))
+        return struct.unpack("3i", credentials)
+
+    def peer_is_root(self, connection):
+        _, uid, _ = self._peer_credentials(connection)
+        return uid == 0
+
+    def peer_in_group(self, connection):
+        """Tell if the peer is root, or has our access group as its primary
+        or one of its supplementary groups.
+        """
+        pid, uid, gid = self._peer_credentials(connection)
+        if uid == 0:
+            return True
+        try:
+            group_id = grp.getgrnam(self.access_group).gr_gid
+        except KeyError:
+            return False
+        if gid == group_id:
+            return True
+        try:
+            with open("/proc/%i/status" % pid) as fd:
+                for line in fd:
+                    if line.startswith("Groups:"):
+                        return group_id in map(int, line.split()[1:])
+        except FileNotFoundError:
+            pass
+        return False
+
+    def run(self, command, args):
+        if command in READ_ONLY_COMMANDS:
+            # These print nothing, and take the locks they need themselves :
+            return {"ok": True,
+                    "output": "",
+                    "result": self.commands[command](**args)}
+        with self.lock:
+            # Rules and files may have changed since the last command :
+            self.firewall.revalidate()
+            with self.output.capture() as output:
+                result = self.commands[command](**args)
+        return {"ok": True, "output": output.getvalue(), "result": result}
+
+    def start(self):
+        self.firewall.start()
+
+    def stop(self):
+        self.firewall.stop()
+
+    def reload(self):
+        # The network, realms.json or custom services may have changed since
+        # the last time :
+        self.firewall.load_service_defs()
+        self.firewall.load_realm_defs()
+        self.firewall.update_realm()
+        self.firewall.reload()
+
+    def optimize(self):
+        self.firewall.optimize()
+
+    def apply(self, realm=None):
+        self.firewall.apply_plan(realm)
+
+    def allow(self, service_name, scope="local", realm=None):
+        self.firewall.allow_service(service_name, scope=scope, realm=realm)
+
+    def disallow(self, service_name, realm=None):
+        self.firewall.disallow_service(service_name, realm=realm)
+
+    def status(self):
+        return {
+            "enabled": self.firewall.is_enabled(),
+            "up": self.firewall.up,
+            "realm_id": self.firewall.realm_id,
+        }
+
+    def logs(self, limit=None, period=None):
+        if not limit and not period:
+            limit = LOG_LIMIT
+        logs = []
+        for log in self.firewall.yield_logs(limit=limit, period=period):
+            log = dict(log)
+            log["LOG_DATE"] = log["LOG_DATE"].timestamp()
+            logs.append(log)
+        return logs
+
+    def update_aggregates(self):
+        """Count the logs that came since the last ones we counted. The
+        first time, that's all logs aggregates span ; main() does it as the
+        daemon starts, outside of the command lock.
+        """
+        with self.log_lock:
+            if self.log_cursor:
+                logs = self.log_reader.yield_logs(cursor=self.log_cursor)
+            else:
+                logs = self.log_reader.yield_logs(period=self.aggregates.span,
+                                                  oldest_first=True)
+            self.aggregates.feed(logs)
+            self.log_cursor = self.log_reader.log_cursor or self.log_cursor
+
+    def top(self, criteria, limit=None, period=60):
+        """Return the most hit values of criteria over the last period
+        seconds, how much counts may be off by, and the width of the
+        buckets that counted them.
+        """
+        self.update_aggregates()
+        with self.log_lock:
+            return {
+                "hits": [ hit._asdict() for hit in self.aggregates.top(
+                    criteria, limit=limit, period=period) ],
+                "error_bound": self.aggregates.error_bound(period),
+                "bucket_width": self.aggregates.bucket_width(period),
+            }
+
+    def metrics(self):
+        self.update_aggregates()
+        # Counters are read from the firewall's tables :
+        with self.lock, self.log_lock:
+            return metrics.collect(self.firewall, self.aggregates).render()
+
+    def render_metrics(self):
+        return self.run("metrics", {})["result"]
+
+    def shutdown_on_signal(self, signum, frame):
+        # shutdown() waits for serve_forever() to return ; don't block it.
+        threading.Thread(target=self.shutdown).start()
+
+
+def main():
+    daemon = ServiceWallDaemon()
+    signal.signal(signal.SIGTERM, daemon.shutdown_on_signal)
+    signal.signal(signal.SIGINT, daemon.shutdown_on_signal)
+    daemon.firewall.start()
+    # Count the logs of the last day in the background :
+    threading.Thread(target=daemon.update_aggregates, daemon=True).start()
+    try:
+        from systemd import daemon as systemd_daemon
+        systemd_daemon.notify("READY=1")
+    except ImportError:
+        pass
+    stopped = threading.Event()
+    http_server = None
+    config = daemon.firewall.config
+    if "metrics_textfile" in config:
+        metrics.serve_textfile(daemon.render_metrics, stopped,
+                               config["metrics_textfile"])
+        print("writing metrics to %s" % config["metrics_textfile"])
+    if "metrics_address" in config:
+        http_server = metrics.serve_http(daemon.render_metrics,
+                                         config["metrics_address"])
+        print("serving metrics on %s" % config["metrics_address"])
+    print("listening on %s" % daemon.socket_path)
+    try:
+        daemon.serve_forever()
+    finally:
+        stopped.set()
+        if http_server:
+            http_server.shutdown()
+        daemon.firewall.stop()
+        daemon.server_close()
+        os.remove(daemon.socket_path)
+
+
+if __name__ == "__main__":
+    main()
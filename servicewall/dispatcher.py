@@ -0,0 +1,112 @@
+"""Network events, coalesced
+
+Network Manager and networkd-dispatcher run the toggler several times for
+one connection - up, dhcp4-change, connectivity-change, routable... Each run
+goes through a Dispatcher, which :
+
+    - takes LOCK_FILE, so that runs don't reload on top of each other ;
+    - waits for events to stop coming for DEBOUNCE seconds, so that one
+      reload covers them all ; runs that queued meanwhile find their event
+      handled already and leave ;
+    - skips the reload if the realm id and the subnetwork are the ones the
+      last reload saw.
+
+Events and the last network state are written in RUN_DIR. DEBOUNCE can be
+set with the "debounce" key of config.cfg .
+"""
+
+import os
+import json
+import time
+import fcntl
+
+from servicewall import network_helpers
+
+
+CONFIG_FILE = "/etc/servicewall/config.cfg"
+RUN_DIR = "/run/servicewall"
+DEBOUNCE = 2.0
+
+
+def read_debounce(config_file=CONFIG_FILE):
+    """Return the debounce delay set in config_file, or DEBOUNCE."""
+    try:
+        with open(config_file) as fd:
+            return float(json.load(fd).get("debounce", DEBOUNCE))
+    except (OSError, ValueError):
+        return DEBOUNCE
+
+
+def network_state():
+    """Return what a reload depends on : [realm id, subnetwork]."""
+    try:
+        return [network_helpers.get_realm_id(),
+                network_helpers.get_subnetwork()]
+    except KeyError:
+        # Offline.
+        return [None, False]
+
+
+class Dispatcher():
+
+    def __init__(self, debounce=DEBOUNCE, run_dir=RUN_DIR):
+        self.debounce = debounce
+        self.lock_file = os.path.join(run_dir, "dispatcher.lock")
+        self.event_file = os.path.join(run_dir, "dispatcher.event")
+        self.state_file = os.path.join(run_dir, "dispatcher.state")
+        os.makedirs(run_dir, exist_ok=True)
+
+    def _write(self, path, content):
+        with open(path + ".tmp", "w") as fd:
+            fd.write(content)
+        os.replace(path + ".tmp", path)
+
+    def _note_event(self):
+        """Record that an event came now, and return its date."""
+        now = time.time()
+        self._write(self.event_file, repr(now))
+        return now
+
+    def _last_event(self):
+        try:
+            with open(self.event_file) as fd:
+                return float(fd.read())
+        except (OSError, ValueError):
+            return 0.0
+
+    def _read_state(self):
+        try:
+            with open(self.state_file) as fd:
+                return json.load(fd)
+        except (OSError, ValueError):
+            return {}
+
+    def handle(self, reload):
+        """Call reload for the event we're run for, unless another run
+        already did or the network didn't change. Returns True if it
+        reloaded.
+        """
+        event = self._note_event()
+        with open(self.lock_file, "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            state = self._read_state()
+            if state.get("handled", 0) >= event:
+                print("event already handled by another run")
+                return False
+            # Let the events of this connection come in :
+            while True:
+                last = self._last_event()
+                remaining = last + self.debounce - time.time()
+                if remaining <= 0:
+                    break
+                time.sleep(remaining)
+            network = network_state()
+            state["handled"] = last
+            if network == state.get("network"):
+                print("realm and subnetwork unchanged, not reloading")
+                self._write(self.state_file, json.dumps(state))
+                return False
+            reload()
+            state["network"] = network
+            self._write(self.state_file, json.dumps(state))
+            return True
@@ -3,9 +3,16 @@
 implements a firewall using python-iptables
 """
 
-from iptc import Rule, Rule6, Chain, Table, Table6
+from collections import namedtuple
+from contextlib import contextmanager
+from iptc import Rule, Rule6, Chain, Table, Table6, easy
 from iptc.ip4tc import IPTCError
 
+# What tells apart two rules opening a port ; see FireWall.get_rule_def .
+RuleDef = namedtuple("RuleDef", "name proto dport src")
+# Counters of a chain : its policy's, and (rule, packets, bytes) for each rule.
+ChainCounters = namedtuple("ChainCounters", "policy packets bytes rules")
+
 
 class FireWall():
     """A simple firewall class
@@ -23,15 +30,21 @@ class FireWall():
     identifier = "ServiceWall"
 
     def __init__(self):
+        # Depth of nested transactions ; only the outermost one commits.
+        self._transaction_depth = 0
+        # identifier -> name -> [ (chain, rule), ... ] ; see self.rule_index
+        self._rule_index = None
         try:
             self._table = Table(Table.FILTER)
             self._table6 = Table6(Table6.FILTER)
         except IPTCError:
-            # user is not root - return silently ; all writing ops will fail
+            # user is not root - return silently ; all writing ops will fail,
+            # but rulesets can still be compiled, see servicewall.ruleset .
+            self.up = False
             return
 
-        # _table.autocommit is True by default.
-        #self._table.autocommit = False
+        # _table.autocommit is True by default ; self.transaction() turns it
+        # off while building a ruleset.
         self.input_chain = Chain(self._table, "INPUT")
         self.forward_chain = Chain(self._table, "FORWARD")
         self.output_chain = Chain(self._table, "OUTPUT")
@@ -43,11 +56,204 @@ class FireWall():
         else:
             self.up = False
 
+    @contextmanager
+    def transaction(self):
+        """Build table modifications in memory and commit them at once.
+
+        Inside this block, rules and policies are only written to the cached
+        tables. On exit, the IPv4 and the IPv6 filter tables are committed
+        exactly once each. If a commit fails, both tables are brought back to
+        the state they had when the transaction began. Transactions can be
+        nested ; only the outermost one commits.
+        """
+        if self._transaction_depth:
+            self._transaction_depth += 1
+            try:
+                yield
+            finally:
+                self._transaction_depth -= 1
+            return
+
+        snapshot = self._snapshot()
+        tables = (self._table, self._table6)
+        for table in tables:
+            table.autocommit = False
+            # Start from the kernel's state, not from a stale handle :
+            table.refresh()
+        self._transaction_depth = 1
+        committed = []
+        try:
+            yield
+            for table in tables:
+                table.commit()
+                committed.append(table)
+        except Exception:
+            # Drop what wasn't committed, and restore what was :
+            for table in tables:
+                table.refresh()
+            # The rule index followed changes that are now gone :
+            self._rule_index = None
+            if committed:
+                print("commit failed, rolling back")
+                self._restore(snapshot)
+            raise
+        finally:
+            self._transaction_depth = 0
+            for table in tables:
+                # Get a fresh handle before turning autocommit back on :
+                table.refresh()
+                table.autocommit = True
+
+    def _chains(self):
+        return (
+            (self.input_chain, False),
+            (self.forward_chain, False),
+            (self.output_chain, False),
+            (self.input_chain6, True),
+            (self.forward_chain6, True),
+            (self.output_chain6, True),
+        )
+
+    def _snapshot(self):
+        """Return policies and rules of our chains, decoded as dicts so that
+        they survive the table handle they were read from.
+        """
+        return [
+            (chain, ipv6, chain.get_policy().name,
+             [ easy.decode_iptc_rule(rule, ipv6) for rule in chain.rules ])
+            for chain, ipv6 in self._chains()
+        ]
+
+    def read_counters(self):
+        """Return ChainCounters of the IPv4 input and forward chains, all read
+        from the same copy of the table.
+        """
+        # With autocommit on, each read would fetch the table again :
+        reading = not self._transaction_depth and self._table.autocommit
+        if reading:
+            self._table.autocommit = False
+            self._table.refresh()
+        try:
+            counters = {}
+            for chain in (self.input_chain, self.forward_chain):
+                packets, bytes_ = chain.get_counters()
+                counters[chain.name] = ChainCounters(
+                    chain.get_policy().name, packets, bytes_,
+                    [ (rule, *rule.get_counters()) for rule in chain.rules ])
+            return counters
+        finally:
+            if reading:
+                self._table.autocommit = True
+
+    def _restore(self, snapshot):
+        """Bring chains back to a state given by self._snapshot()."""
+        for chain, ipv6, policy, rules in snapshot:
+            chain.flush()
+            chain.set_policy(policy)
+            for rule_dict in rules:
+                chain.append_rule(easy.encode_iptc_rule(rule_dict, ipv6))
+        self._table.commit()
+        self._table6.commit()
+
+    @property
+    def rule_index(self):
+        """Index of the tagged rules of the input and forward chains, as
+
+            { identifier: { name: [ (chain, rule), ... ] } }
+
+        It is built from one read of the chains the first time it is needed,
+        then kept in sync by self.insert_rule, self.append_rule and
+        self.delete_rule, so that finding rules by name doesn't reread the
+        table. Rules are in chain order for each name.
+        """
+        if self._rule_index is None:
+            self._rule_index = {}
+            for chain in (self.input_chain, self.forward_chain):
+                for rule in chain.rules:
+                    if self._get_rule_id(rule):
+                        self._index_rule(chain, self._copy_rule(rule))
+        return self._rule_index
+
+    def _copy_rule(self, rule):
+        """Return a copy of a rule read from a chain.
+
+        Rules read from a chain point into the table handle's memory, which
+        is freed when the table gets refreshed ; a copy outlives it.
+        """
+        return easy.encode_iptc_rule(easy.decode_iptc_rule(rule))
+
+    def _index_rule(self, chain, rule, position=None):
+        """Index rule, found at position in chain - at its end if None."""
+        identifier = self._get_rule_id(rule)
+        if not identifier:
+            return
+        name = self._get_rule_name(rule)
+        rules = self.rule_index.setdefault(identifier, {}).setdefault(name, [])
+        if position is None or \
+                not any(rule_chain is chain for rule_chain, _ in rules):
+            rules.append((chain, rule))
+            return
+        # How many rules of this name are above it, in chain order :
+        above = 0
+        if position:
+            for chain_rule in chain.rules[:position]:
+                if self._get_rule_id(chain_rule) == identifier and \
+                        self._get_rule_name(chain_rule) == name:
+                    above += 1
+        index = len(rules)
+        for number, (rule_chain, _) in enumerate(rules):
+            if rule_chain is chain:
+                if not above:
+                    index = number
+                    break
+                above -= 1
+        rules.insert(index, (chain, rule))
+
+    def find_rules(self, name, chain=None, identifier=None):
+        """Return the (chain, rule) tuples of rules named name, optionally
+        only those in chain.
+        """
+        rules = self.rule_index.get(identifier or self.identifier, {}).get(
+            name, [])
+        return [ (rule_chain, rule) for rule_chain, rule in rules
+                 if chain is None or rule_chain is chain ]
+
+    def insert_rule(self, chain, rule, position=0):
+        """Insert rule in chain, and index it."""
+        # Build the index first, or it would read rule from the chain too :
+        self.rule_index
+        chain.insert_rule(rule, position)
+        self._index_rule(chain, rule, position)
+
+    def append_rule(self, chain, rule):
+        """Append rule to chain, and index it."""
+        self.rule_index
+        chain.append_rule(rule)
+        self._index_rule(chain, rule)
+
+    def delete_rule(self, chain, rule):
+        """Delete rule from chain, and from the index."""
+        chain.delete_rule(rule)
+        identifier = self._get_rule_id(rule)
+        if not identifier:
+            return
+        rules = self.rule_index.get(identifier, {}).get(
+            self._get_rule_name(rule), [])
+        for index, (rule_chain, indexed_rule) in enumerate(rules):
+            if rule_chain is chain and indexed_rule == rule:
+                del rules[index]
+                break
+
     def start(self):
         """Start a basic FireWall.
 
         Drops all incoming, accepts only localhost.
         """
+        with self.transaction():
+            self._start()
+        self.up = True
+
+    def _start(self):
         # Drop all incoming, allow outgoing requests.
         print("setting input policy to DROP")
         self.input_chain.set_policy("DROP")
@@ -67,10 +273,7 @@ class FireWall():
             src="127.0.0.1",
             dst="127.0.0.1"
             )
-        self.input_chain.insert_rule(accept_localhost_rule)
-        if not self._table.autocommit:
-            self._table.commit()
-        self.up = True
+        self.insert_rule(self.input_chain, accept_localhost_rule)
 
     def stop(self):
         """Remove rules.
@@ -78,15 +281,16 @@ class FireWall():
         This function removes all rules created by this firewall's instances ;
         it recognizes them by the comment that's inside of them.
         """
+        with self.transaction():
+            self._stop()
+        self.up = False
+
+    def _stop(self):
         print("flushing rules")
         found_rules = 0
-        for rule in self.input_chain.rules:
-            if self._get_rule_id(rule) == self.identifier:
-                self.del_rule(self._get_rule_name(rule), self.input_chain)
-                found_rules += 1
-        for rule in self.forward_chain.rules:
-            if self._get_rule_id(rule) == self.identifier:
-                self.del_rule(self._get_rule_name(rule), self.forward_chain)
+        for rules in self.rule_index.get(self.identifier, {}).values():
+            for chain, rule in list(rules):
+                self.delete_rule(chain, rule)
                 found_rules += 1
         if not found_rules:
             print("no rule found for id %s." % self.identifier)
@@ -94,18 +298,15 @@ class FireWall():
         self.input_chain.set_policy("ACCEPT")
         print("setting forward policy to ACCEPT")
         self.forward_chain.set_policy("ACCEPT")
-        if not self._table.autocommit:
-            self._table.commit()
-        self.up = False
 
     def status(self):
         """print the status of the FireWall. Returns either True or False."""
         # Returns True if a single rule has our identifier tag
-        is_up = False
-        for rule in self.input_chain.rules:
-            if self._get_rule_id(rule) == self.identifier:
-                is_up = True
-        return is_up
+        for rules in self.rule_index.get(self.identifier, {}).values():
+            for chain, _ in rules:
+                if chain is self.input_chain:
+                    return True
+        return False
 
     def create_rule(self, name, target, dst="", dport="", src="", sport="", proto="", siface="", diface=""):
         """create and return a rule (or two if no proto given).
@@ -114,10 +315,12 @@ class FireWall():
         target is a string saying what to do, like
                 "ACCEPT", "DENY", "DROP", "LOG"
         proto (if not defined, is assumed both udp and tcp)
-        src is a realm in the form XXX.XXX.XXX.XXX/YY
+        src is a realm in the form XXX.XXX.XXX.XXX/YY, a range as in
+            "172.16.0.0-172.31.255.255", or an ipset as in "set:name"
         sport is source port. Currently ignored
         dst is a realm in the same form as src
-        dport is destination port
+        dport is destination port, a port range as in "6112:6119", or a
+              comma-separated list of them for a multiport match
         siface is the source interface
         diface is the destination interface
         """
@@ -136,14 +339,23 @@ class FireWall():
         rule.create_target(target)
         if dst:
             rule.dst = dst
-        if dport:
+        if dport and "," in str(dport):
+            # Several ports or ranges, as in "22,80,6112:6119" :
+            multiport_match = rule.create_match("multiport")
+            multiport_match.dports = str(dport)
+            rule.protocol = proto
+        elif dport:
             proto_match = rule.create_match(proto)
             proto_match.dport = str(dport)
             rule.protocol = proto
         if diface:
             rule.in_interface = diface
         if src:
-            if src.count("-"):
+            if src.startswith("set:"):
+                # Source is in an ipset, as in "set:servicewall-local" :
+                set_match = rule.create_match("set")
+                set_match.set_parameter("match-set", [src[4:], "src"])
+            elif src.count("-"):
                 iprange_match = rule.create_match("iprange")
                 iprange_match.src_range = src
                 rule.add_match(iprange_match)
@@ -171,11 +383,10 @@ class FireWall():
         title is the name of the rule. Note that there may be several rules
         under the same name. This should delete the first it finds.
         """
-        for rule in chain.rules:
-            if self._get_rule_name(rule) == name:
-                chain.delete_rule(rule)
-                #print("deleted rule %s" % name)
-                break
+        for rule_chain, rule in self.find_rules(name, chain):
+            self.delete_rule(rule_chain, rule)
+            #print("deleted rule %s" % name)
+            break
 
     def list_rules(self, chain):
         for rule in chain.rules:
@@ -188,6 +399,10 @@ class FireWall():
                     proto = match.name
                 except (KeyError, IndexError):
                     pass
+                if match.name == "multiport" and \
+                        "dports" in match.parameters:
+                    dport = "ports " + match.parameters["dports"]
+                    proto = rule.protocol
             # Then find out source.
             if rule.src == "0.0.0.0/0.0.0.0":
                 src = "any source"
@@ -197,6 +412,29 @@ class FireWall():
                 rule.target.name, self._get_rule_name(rule), proto, dport, src
             )
 
+    def get_rule_def(self, rule):
+        """Return a RuleDef describing a rule that opens a port, or None if
+        this rule isn't ours or doesn't match on a destination port.
+        """
+        if self._get_rule_id(rule) != self.identifier:
+            return None
+        dport = None
+        src = ""
+        for match in rule.matches:
+            if match.name in ("tcp", "udp") and "dport" in match.parameters:
+                dport = match.parameters["dport"]
+            elif match.name == "multiport" and "dports" in match.parameters:
+                dport = match.parameters["dports"]
+            elif match.name == "iprange" and "src_range" in match.parameters:
+                src = match.parameters["src_range"]
+            elif match.name == "set" and "match_set" in match.parameters:
+                src = "set:" + match.parameters["match_set"].split()[0]
+        if dport is None:
+            return None
+        if not src and rule.src != "0.0.0.0/0.0.0.0":
+            src = rule.src
+        return RuleDef(self._get_rule_name(rule), rule.protocol, dport, src)
+
     def _get_rule_name(self, rule):
         for match in rule.matches:
             if match.comment:
@@ -0,0 +1,73 @@
+"""Hit rates of services
+
+The kernel counts packets matching each rule. HitRates turns these counters
+into a rate of hits per second for each service of each realm, decayed
+exponentially so that what was busy last month weighs less than what is busy
+today. Rates are saved in HITS_FILE between runs :
+
+    {realm: {service: {"rate": hits per second, "packets": counter,
+                       "time": date of the counter}}}
+"""
+
+import os
+import json
+import math
+import time
+
+
+HITS_FILE = "/var/cache/servicewall/hits.json"
+# Time in seconds for an old rate to weigh 1/e of what it did :
+DECAY = 3 * 24 * 3600
+
+
+class HitRates():
+
+    def __init__(self, hits_file=HITS_FILE, decay=DECAY):
+        self.hits_file = hits_file
+        self.decay = decay
+        try:
+            with open(hits_file) as fd:
+                self.realms = json.load(fd)
+        except (OSError, ValueError):
+            self.realms = {}
+
+    def update(self, realm, counters, now=None):
+        """Fold counters, a dict of service name -> packets matched by its
+        rules since they were created, into the rates of realm.
+        """
+        if now is None:
+            now = time.time()
+        services = self.realms.setdefault(str(realm), {})
+        for service_name, packets in counters.items():
+            entry = services.get(service_name)
+            if entry is None:
+                # Nothing to compare with yet.
+                services[service_name] = {
+                    "rate": 0.0, "packets": packets, "time": now }
+                continue
+            elapsed = now - entry["time"]
+            if elapsed <= 0:
+                continue
+            hits = packets - entry["packets"]
+            if hits < 0:
+                # The rule was created again since ; its counter restarted.
+                hits = packets
+            weight = 1 - math.exp(-elapsed / self.decay)
+            entry["rate"] += weight * (hits / elapsed - entry["rate"])
+            entry["packets"] = packets
+            entry["time"] = now
+
+    def rate(self, realm, service_name):
+        return self.realms.get(str(realm), {}) \
+            .get(service_name, {}).get("rate", 0.0)
+
+    def save(self):
+        try:
+            os.makedirs(os.path.dirname(self.hits_file), exist_ok=True)
+            temp_file = self.hits_file + ".tmp"
+            with open(temp_file, "w") as fd:
+                json.dump(self.realms, fd)
+            os.replace(temp_file, self.hits_file)
+        except OSError:
+            # Not root ; rates will be computed again.
+            pass
@@ -0,0 +1,78 @@
+"""Kernel ipsets for source scopes
+
+Rules of services allowed from a scope other than "global" match their
+source against a hash:net ipset, one per scope :
+
+    servicewall-local     the networks this machine is connected to
+    servicewall-docker    172.16.0.0/12
+
+Checking a source against a set is one hash lookup, however many networks it
+holds. When the networks of a scope change, only its set is updated - in one
+`ipset restore` batch that fills a new set and swaps it in - while rules stay
+as they are.
+"""
+
+import shutil
+import subprocess
+
+
+SCOPES = ("local", "docker")
+
+
+def _ipset(*args, script=None):
+    try:
+        return subprocess.run(["ipset", *args],
+                              input=script,
+                              capture_output=True,
+                              check=True,
+                              text=True).stdout
+    except FileNotFoundError:
+        raise AssertionError("'ipset' not found in the path, is ipset"
+                             " installed on this machine ?")
+    except subprocess.CalledProcessError as error:
+        raise SystemError("ipset failed : %s" % error.stderr.strip())
+
+
+def available():
+    """Tell if the ipset command is there to manage sets with."""
+    return shutil.which("ipset") is not None
+
+
+class IpSets():
+    """The ipsets holding the source networks of each scope."""
+
+    def __init__(self, identifier):
+        self.identifier = identifier
+
+    def set_name(self, scope):
+        return "%s-%s" % (self.identifier.lower(), scope)
+
+    def update(self, scope, networks):
+        """Make the set of scope hold exactly networks, a list of strings
+        like "192.168.1.0/24".
+        """
+        name = self.set_name(scope)
+        new_name = name + "-new"
+        lines = [
+            "create %s hash:net family inet" % name,
+            "create %s hash:net family inet" % new_name,
+            "flush %s" % new_name,
+            *("add %s %s" % (new_name, network) for network in networks),
+            "swap %s %s" % (new_name, name),
+            "destroy %s" % new_name,
+        ]
+        _ipset("restore", "-exist", script="\n".join(lines) + "\n")
+
+    def members(self, scope):
+        """Return the networks in the set of scope."""
+        output = _ipset("list", self.set_name(scope))
+        _, _, members = output.partition("Members:\n")
+        return members.split()
+
+    def destroy(self):
+        """Remove our sets. Those that rules still use are left in place."""
+        for scope in SCOPES:
+            try:
+                _ipset("destroy", self.set_name(scope))
+            except SystemError:
+                pass
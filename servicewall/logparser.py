@@ -0,0 +1,106 @@
+"""Parser for packet log lines
+
+Turns lines in ulogd's PRINTPKT format - which servicewall.nflog writes too -
+such as
+
+    Oct 18 10:12:01 host not in allowed services IN=wlan0 OUT= MAC=...
+    SRC=192.168.1.12 DST=192.168.1.3 LEN=60 TOS=00 PREC=0x00 TTL=64 ID=5213
+    DF PROTO=TCP SPT=41628 DPT=8080 WINDOW=64240 RES=0x00 SYN URGP=0
+
+into LogRecords. Lines in that exact order are matched by one precompiled
+regex ; others have their KEY=value tokens picked one by one. Only the fields
+in FIELDS are kept, flags like DF or SYN are dropped.
+"""
+
+import re
+import sys
+import socket
+
+
+FIELDS = ("LOG_DATE", "IN", "OUT", "MAC", "SRC", "DST", "LEN", "TTL", "ID",
+          "PROTO", "SPT", "DPT")
+
+# Groups are FIELDS, but LOG_DATE :
+_line = re.compile(r"IN=(\S*) OUT=(\S*) (?:MAC=(\S*) )?SRC=(\S*) DST=(\S*) "
+                   r"LEN=(\S*) .*?TTL=(\S*) ID=(\S*) .*?PROTO=(\S*)"
+                   r"(?: SPT=(\S*) DPT=(\S*))?")
+_token = re.compile(r"([A-Z]+)=(\S*)")
+
+# PROTO is either a name, or a number for protocols ulogd doesn't know :
+PROTOCOLS = { str(number): sys.intern(name[8:].lower())
+              for name, number in vars(socket).items()
+              if name.startswith("IPPROTO") }
+PROTOCOLS.update({ name.upper(): name for name in PROTOCOLS.values() })
+
+
+class LogRecord():
+    """A log of a packet, read like a dict : record["DPT"] ."""
+
+    __slots__ = FIELDS
+
+    def __init__(self, LOG_DATE, IN, OUT, MAC, SRC, DST, LEN, TTL, ID, PROTO,
+                 SPT, DPT):
+        self.LOG_DATE = LOG_DATE
+        self.IN = IN
+        self.OUT = OUT
+        self.MAC = MAC
+        self.SRC = SRC
+        self.DST = DST
+        self.LEN = LEN
+        self.TTL = TTL
+        self.ID = ID
+        self.PROTO = PROTO
+        self.SPT = SPT
+        self.DPT = DPT
+
+    def __getitem__(self, field):
+        try:
+            return getattr(self, field)
+        except AttributeError:
+            raise KeyError(field)
+
+    def __setitem__(self, field, value):
+        setattr(self, field, value)
+
+    def __contains__(self, field):
+        return field in FIELDS
+
+    def __iter__(self):
+        return iter(FIELDS)
+
+    def __repr__(self):
+        return "LogRecord(%s)" % ", ".join(
+            "%s=%r" % (field, getattr(self, field)) for field in FIELDS)
+
+    def keys(self):
+        return FIELDS
+
+    def get(self, field, default=None):
+        return getattr(self, field, default)
+
+
+def parse_message(message, log_date=None):
+    """Return a LogRecord from a log line, or None if it isn't a log of a
+    packet - like conntrack's [NEW] and [DESTROY] lines.
+    """
+    match = _line.search(message)
+    # Ports before PROTO would be missed :
+    if match and (match.group(11) or " DPT=" not in message):
+        IN, OUT, MAC, SRC, DST, LEN, TTL, ID, PROTO, SPT, DPT = match.groups()
+        return LogRecord(log_date, IN, OUT, MAC or "", SRC, DST, LEN, TTL, ID,
+                         PROTOCOLS.get(PROTO) or PROTO.lower(),
+                         SPT or "", DPT or "")
+
+    # Fields in another order, or missing :
+    if "[NEW]" in message or "[DESTROY]" in message:
+        return None
+    fields = dict(_token.findall(message))
+    get = fields.get
+    proto = get("PROTO")
+    if proto is None:
+        return None
+    return LogRecord(log_date, get("IN", ""), get("OUT", ""), get("MAC", ""),
+                     get("SRC", ""), get("DST", ""), get("LEN", ""),
+                     get("TTL", ""), get("ID", ""),
+                     PROTOCOLS.get(proto) or proto.lower(),
+                     get("SPT", ""), get("DPT", ""))
@@ -10,23 +10,28 @@ changes.
 
 """
 
-import pickle
 import json
 import copy
+import bisect
 import os
+import ipaddress
+import time
 import subprocess
 from collections import namedtuple
 
+from servicewall import catalog
+from servicewall import completion
+from servicewall import hitrates
+from servicewall import ipset
 from servicewall import network_helpers
+from servicewall import nftables
+from servicewall import ruleset
+from servicewall import state
 from servicewall import statefulfirewall
+from servicewall.firewall import RuleDef
 
-# from servicewall import service_helpers
-# globals()["PortDef"] = service_helpers.PortDef
-# globals()["ServiceDef"] = service_helpers.ServiceDef
-
-from servicewall.service_helpers import PortDef, ServiceDef
-globals()["PortDef"] = PortDef
-globals()["ServiceDef"] = ServiceDef
+from servicewall.service_helpers import PortIndex, parse_port_range
+from servicewall.service_helpers import compact_ports
 
 
 def _systemctl(arg):
@@ -55,8 +60,9 @@ class ServiceWall(statefulfirewall.StateFulFireWall):
     """ServiceWall - a FireWall in which you can add services on the fly.
 
     This class supersedes StateFulFireWall and adds services and realms.
-    self.service_defs is a dict containing service definitions stored in
-    self.service_defs_pickle, additioned with defs in self.service_defs_dir
+    self.service_defs is a catalog.Catalog, a dict containing service
+    definitions from self.service_defs_seed and gufw's, additioned with defs
+    in self.service_defs_dir, all compiled in self.catalog_file .
     A service def file should be a json definition that is a valid ServiceDef.
     You can get a valid sample with eg
 
@@ -73,8 +79,13 @@ class ServiceWall(statefulfirewall.StateFulFireWall):
     config_file = "/etc/servicewall/config.cfg"
     lib_dir = "/usr/lib/servicewall/"
     realm_defs_dict = "/etc/servicewall/realms.json"
-    service_defs_pickle = "/usr/lib/servicewall/services.p"
-    service_defs_dir = "/etc/servicewall/services/"
+    service_defs_seed = catalog.SEED_FILE
+    gufw_defs_dir = catalog.GUFW_DEFS_DIR
+    service_defs_dir = catalog.CUSTOM_DEFS_DIR
+    catalog_file = catalog.CATALOG_FILE
+    completion_cache = completion.CACHE_FILE
+    hits_file = hitrates.HITS_FILE
+    rulesets_dir = ruleset.CACHE_DIR
     dispatcher_toggler = "toggler"
     dispatchers = {
         "Network Manager": "/etc/NetworkManager/dispatcher.d/",
@@ -83,23 +94,74 @@ class ServiceWall(statefulfirewall.StateFulFireWall):
 
     def __init__(self):
         super().__init__()
+        self.config = self._read_config()
+        # Either "iptables" or "nftables" :
+        self.backend = self.config.get("backend", "iptables")
+        if self.backend == "nftables":
+            self.nftables = nftables.NfTables(self.identifier)
+            self.up = self.nftables.status()
+            self.ipsets = None
+        elif ipset.available():
+            # Sources of scopes live in ipsets that rules match against :
+            self.ipsets = ipset.IpSets(self.identifier)
+        else:
+            self.ipsets = None
+        self.load_realm_defs()
+        # Decayed hit rates of services, ordering their rules :
+        self.hit_rates = hitrates.HitRates(self.hits_file)
+        # How many reloads, and how long they took in seconds :
+        self.reload_stats = {"count": 0, "seconds": 0.0, "last": None}
+        # Compiled scripts of realms, for quick switches between them :
+        self.ruleset_cache = ruleset.RulesetCache(self.rulesets_dir)
+        self.load_service_defs()
+        self.update_realm()
+        # The realm whose rules are loaded ; the completion cache tells the
+        # one we last ran in :
+        self.loaded_realm = None
+        if self.up:
+            # Realms may have changed since, not the one we ran in :
+            cache = completion.read_cache(self.completion_cache,
+                                          revalidate=False)
+            if cache:
+                self.loaded_realm = cache["realm_id"]
+
+    def load_service_defs(self):
+        """Load the catalog of service defs - compiled again only if one of
+        its sources changed, as when a custom service is added - and index
+        the ports of all its services.
+        """
+        self.service_defs = catalog.load(self.catalog_file,
+                                         self.service_defs_seed,
+                                         self.gufw_defs_dir,
+                                         self.service_defs_dir)
+        self.port_index = PortIndex()
+        for service_name, ranges in self.service_defs.port_ranges():
+            self.port_index.add_ranges(service_name, ranges)
+
+    def load_realm_defs(self):
         with open(self.realm_defs_dict, "r") as fd:
             self.realm_defs = json.load(fd)
-        with open(self.service_defs_pickle, "rb") as fd:
-            self.service_defs = pickle.load(fd)
-        for service_file in os.listdir(self.service_defs_dir):
-            if service_file.find('.') == 0:
-                # It's a dotfile, keep going
-                continue
-            try:
-                with open(self.service_defs_dir + service_file) as fd:
-                    service_def = json.load(fd)
-                    service_def["ports"] = PortDef(**service_def["ports"])
-                    sdef = ServiceDef(**service_def)
-                    self.service_defs[sdef.title] = sdef
-            except TypeError as error:
-                print("Warning : ServiceDef." + str(error),
-                      "in " + self.service_defs_dir + service_file)
+        # Generation of the state files we read ; see self.revalidate :
+        self.generation = state.generation()
+
+    def revalidate(self):
+        """Forget what may have changed behind a long-lived instance's back :
+        rules of the chains, and state files if another process changed
+        them since we read them.
+        """
+        if self.backend == "nftables":
+            self.up = self.nftables.status()
+        else:
+            # Read the chains again the next time they're needed :
+            self._rule_index = None
+            self.up = self.status()
+        if state.generation() != self.generation:
+            print("state changed since we read it, reading it again")
+            self.config = self._read_config()
+            self.load_realm_defs()
+
+    def update_realm(self):
+        """Find out which realm we are connected to, and its networks."""
         try:
             self.realm_id = network_helpers.get_realm_id()
             self.online = True
@@ -109,10 +171,24 @@ class ServiceWall(statefulfirewall.StateFulFireWall):
 
         if self.online:
             self.subnetwork = network_helpers.get_subnetwork()
+            if self.config.get("local_scope") == "all_interfaces":
+                # Opted in : docker bridges, VPNs... are local too.
+                self.local_networks = network_helpers.get_local_networks()
+            else:
+                self.local_networks = [
+                    str(ipaddress.IPv4Network(self.subnetwork)) ]
         else:
             self.subnetwork = False
+            self.local_networks = []
 
+    def update_scope_sets(self):
+        """Fill the ipsets of scopes with their current networks. Rules
+        matching on them don't need to change.
+        """
+        for scope in ipset.SCOPES:
+            self.ipsets.update(scope, self._scope_networks(scope))
 
+    @state.serialized
     def start(self, should_check_hook=True, **args):
         """Will load a set of rules from self.realm_defs .
         """
@@ -122,50 +198,334 @@ class ServiceWall(statefulfirewall.StateFulFireWall):
             # If we don't have a realm definition, load "ServiceWall:default"
             self.realm_defs[self.realm_id] = copy.deepcopy(
                 self.realm_defs[self.identifier + ":default"])
-        for service_name, scope in self.realm_defs[self.realm_id].items():
-            self.insert_service_rule(service_name, scope=scope)
-        # Commits the table if relevant, and brings other rules in :
-        super().start(**args)
-
+        if self.backend == "nftables":
+            self.nftables.apply(self.plan(self.realm_id))
+            self.up = True
+            self.loaded_realm = self.realm_id
+            self._update_completion_cache()
+            return
+        if self.ipsets:
+            # Rules can't refer to sets that don't exist yet :
+            self.update_scope_sets()
+        # Build the whole ruleset in memory, and commit it once :
+        with self.transaction():
+            # Each service goes on top of the previous ones, hottest last :
+            for service_name, scope in reversed(
+                    self.service_order(self.realm_id)):
+                self.insert_service_rule(service_name, scope=scope)
+            # Brings other rules in :
+            super().start(**args)
+        self.loaded_realm = self.realm_id
+        print("%i service rules, for %i ports and port ranges" %
+              self.count_service_rules(self.realm_id))
+        self._update_completion_cache()
+
+    @state.serialized
     def stop(self, should_check_hook=True):
         if should_check_hook:
             self._disable_hook()
+        if self.backend == "nftables":
+            self.nftables.flush()
+            self.up = False
+            self.loaded_realm = None
+            return
+        self.record_hits()
         super().stop()
+        self.loaded_realm = None
+        if self.ipsets and not self._transaction_depth:
+            self.ipsets.destroy()
 
+    @state.serialized
     def reload(self):
-        self.stop(should_check_hook=False)
-        self.start(should_check_hook=False)
+        started = time.monotonic()
+        if self.backend == "nftables":
+            # The script replaces the whole table in one atomic batch :
+            self.start(should_check_hook=False)
+        elif self.up and self.loaded_realm not in (None, self.realm_id):
+            # Switching realms : swap our rules for the other realm's in one
+            # restore, its script most likely from the cache.
+            self.apply_plan()
+        elif self.up:
+            # Order services on their latest hit rates :
+            self.record_hits()
+            self.reconcile()
+        else:
+            # Both steps end up in the same commit, so the kernel never sees
+            # the stopped firewall's ACCEPT policies :
+            with self.transaction():
+                self.stop(should_check_hook=False)
+                self.start(should_check_hook=False)
+        duration = time.monotonic() - started
+        self.reload_stats["count"] += 1
+        self.reload_stats["seconds"] += duration
+        self.reload_stats["last"] = duration
         print("%s reloaded" % self.identifier)
 
+    def reconcile(self):
+        """Bring the service rules of the INPUT chain to what the current
+        realm needs, inserting and deleting only the rules that differ.
+
+        Service rules sit in a block right below the RELATED,ESTABLISHED
+        rule. Rules of this block that are still wanted stay in place ; the
+        others are deleted, and missing ones are inserted where a fresh start
+        would have put them. Policies are left untouched. If the chain doesn't
+        look like one we started, it is rebuilt in a single transaction.
+        """
+        if self.realm_id not in self.realm_defs:
+            self.realm_defs[self.realm_id] = copy.deepcopy(
+                self.realm_defs[self.identifier + ":default"])
+        if self.ipsets:
+            self.update_scope_sets()
+        desired = self.realm_rule_defs(self.realm_id)
+
+        with self.transaction():
+            anchor = None
+            current = []
+            for position, rule in enumerate(self.input_chain.rules):
+                rule_def = self.get_rule_def(rule)
+                if rule_def:
+                    current.append((position, rule_def, rule))
+                elif (anchor is None and
+                      self._get_rule_id(rule) == self.identifier and
+                      self._get_rule_name(rule) == "RELATED,ESTABLISHED"):
+                    anchor = position
+            block = range(anchor + 1, anchor + 1 + len(current)) \
+                if anchor is not None else None
+            if block is None or [ p for p, _, _ in current ] != list(block):
+                print("input chain isn't in a known state, rebuilding it")
+                self.stop(should_check_hook=False)
+                self.start(should_check_hook=False)
+                return
+
+            # Keep the longest subsequence of current rules that is in the
+            # desired order, so that the fewest rules move ; desired_slots
+            # maps each RuleDef to its desired indexes, as one may be wanted
+            # more than once.
+            desired_slots = {}
+            for index, rule_def in enumerate(desired):
+                desired_slots.setdefault(rule_def, []).append(index)
+            # Patience sorting : tails[k] is the lowest desired index ending a
+            # subsequence of k + 1 rules, and ends[k] its last link.
+            tails = []
+            ends = []
+            for position, (_, rule_def, _) in enumerate(current):
+                # Highest index first, so that a rule doesn't follow itself :
+                for slot in reversed(desired_slots.get(rule_def, [])):
+                    k = bisect.bisect_left(tails, slot)
+                    link = (slot, position, ends[k - 1] if k else None)
+                    if k == len(tails):
+                        tails.append(slot)
+                        ends.append(link)
+                    else:
+                        tails[k] = slot
+                        ends[k] = link
+            # current position -> desired index, of the rules we keep :
+            kept_at = {}
+            link = ends[-1] if ends else None
+            while link:
+                slot, position, link = link
+                kept_at[position] = slot
+            kept = set(kept_at.values())
+            to_delete = [ rule for position, (_, _, rule) in enumerate(current)
+                          if position not in kept_at ]
+
+            for rule in reversed(to_delete):
+                print("removing rule %s" % self._get_rule_name(rule))
+                self.delete_rule(self.input_chain, rule)
+            # Kept rules now fill the top of the block in desired order, so
+            # inserting missing ones by increasing index puts each in place :
+            for index, rule_def in enumerate(desired):
+                if index in kept:
+                    continue
+                print("adding rule %s" % rule_def.name)
+                self.insert_rule(self.input_chain,
+                                 self._create_service_rule(rule_def),
+                                 anchor + 1 + index)
+        self.loaded_realm = self.realm_id
+        print("%i rules removed, %i added" %
+              (len(to_delete), len(desired) - len(kept)))
+        self._update_completion_cache()
+
+    def _planned_realm(self, realm):
+        if realm is None:
+            realm = self.realm_id
+        if realm not in self.realm_defs:
+            if realm != self.realm_id:
+                raise KeyError("no realm %s in %s" %
+                               (realm, self.realm_defs_dict))
+            # As start would do :
+            self.realm_defs[realm] = copy.deepcopy(
+                self.realm_defs[self.identifier + ":default"])
+        return realm
+
+    def _ruleset_key(self, realm):
+        """Return what realm's scripts depend on, digested : its services in
+        their order, the catalog, the networks and how scopes match them.
+        """
+        return ruleset.cache_key(
+            ruleset.FORMAT,
+            self.identifier,
+            self.backend,
+            realm,
+            self.service_order(realm),
+            self.service_defs.version,
+            self.subnetwork,
+            self.local_networks,
+            bool(self.ipsets))
+
+    def compiled_scripts(self, realm):
+        """Return realm's scripts : [nft script] or [iptables-restore
+        script, ip6tables-restore script]. They're compiled only if the
+        cache doesn't have them.
+        """
+        key = self._ruleset_key(realm)
+        scripts = self.ruleset_cache.get(realm, key)
+        if scripts is not None:
+            return scripts
+        if self.backend == "nftables":
+            scripts = [ self.nftables.render(self.realm_scopes(realm)) ]
+        else:
+            compiled = ruleset.compile_ruleset(self.realm_rule_defs(realm))
+            title = "%s ruleset for realm %s" % (self.identifier, realm)
+            scripts = [
+                ruleset.render(compiled, self.identifier, title=title),
+                ruleset.render(compiled, self.identifier, ipv6=True,
+                               title=title),
+            ]
+        self.ruleset_cache.put(realm, key, scripts)
+        return scripts
+
+    def plan(self, realm=None, ipv6=False):
+        """Return the script that loads realm's ruleset (the current realm's
+        by default) : an nft script, or an iptables-restore one - an
+        ip6tables-restore one if ipv6. Doesn't need root.
+        """
+        scripts = self.compiled_scripts(self._planned_realm(realm))
+        if ipv6 and len(scripts) > 1:
+            return scripts[1]
+        return scripts[0]
+
+    @state.serialized
+    def apply_plan(self, realm=None):
+        """Load realm's ruleset as self.plan renders it, in one bulk restore.
+        Our rules already in the INPUT chain are deleted in the same restore ;
+        rules of other programs stay. Policies - IPv6 has nothing else - are
+        only set if the firewall isn't up : a running one has them already.
+        """
+        realm = self._planned_realm(realm)
+        scripts = self.compiled_scripts(realm)
+        if self.backend == "nftables":
+            self.nftables.apply(scripts[0])
+        else:
+            if self.ipsets:
+                self.update_scope_sets()
+            self.record_hits()
+            deletions = self.rule_deletions()
+            if deletions is None:
+                # Some rule of ours can't be written as a script line ; take
+                # them out with iptc first.
+                print("input chain isn't in a known state, removing our "
+                      "rules first")
+                with self.transaction():
+                    for rules in self.rule_index.get(self.identifier,
+                                                     {}).values():
+                        for chain, rule in list(rules):
+                            self.delete_rule(chain, rule)
+                deletions = []
+            ruleset.restore(ruleset.patch(scripts[0], deletions,
+                                          with_policies=not self.up))
+            if not self.up:
+                ruleset.restore(scripts[1], ipv6=True)
+            # Rules changed behind the index's back :
+            self._rule_index = None
+        self.up = True
+        self.loaded_realm = realm
+        print("%s ruleset for realm %s loaded" % (self.identifier, realm))
+        self._update_completion_cache()
+
+    def rule_deletions(self):
+        """Return the "-D" script lines deleting our rules from the INPUT
+        chain - and the igmp rule StateFulFireWall.start puts right above
+        the log one - or None if one of ours isn't a rule we make.
+        """
+        stateful = ruleset.stateful_rules()
+        deletions = []
+        previous = None
+        for rule in self.input_chain.rules:
+            if self._get_rule_id(rule) == self.identifier:
+                name = self._get_rule_name(rule)
+                rule_def = self.get_rule_def(rule)
+                if rule_def:
+                    plan_rule = ruleset.service_rule(rule_def)
+                elif name in stateful:
+                    plan_rule = stateful[name]
+                else:
+                    return None
+                if name == "log" and previous is not None and \
+                        previous.protocol == "igmp" and \
+                        previous.target.name == "DROP" and \
+                        not previous.matches:
+                    deletions.append(ruleset.render_rule(
+                        ruleset.IGMP_RULE, self.identifier, command="-D"))
+                deletions.append(ruleset.render_rule(
+                    plan_rule, self.identifier, command="-D"))
+            previous = rule
+        return deletions
+
+    @state.serialized
     def enable(self):
         try:
             _enable_in_systemd()
         except AssertionError:
-            with open(self.config_file, 'w+') as fd:
-                fd.write('{ "state": "enabled" }')
+            self.config["state"] = "enabled"
+            self._write_config()
 
+    @state.serialized
     def disable(self):
         try:
             _disable_in_systemd()
         except AssertionError:
-            with open(self.config_file, 'w+') as fd:
-                fd.write('{ "state": "disabled" }')
+            self.config["state"] = "disabled"
+            self._write_config()
 
     def is_enabled(self):
         try:
             status = _systemctl('is-enabled')
         except AssertionError:
-            with open(self.config_file, 'r') as fd:
-                config = json.load(fd)
-                status = config["state"]
+            status = self.config.get("state")
         if status != 'enabled':
             return False
         return True
 
+    def _read_config(self):
+        """Return the dict stored in self.config_file, if any.
+
+        Known keys are "state" ("enabled" or "disabled", used when systemd
+        isn't available), "backend" ("iptables" or "nftables") and
+        "local_scope" ("all_interfaces" for the local scope to cover the
+        networks of all interfaces that are up, not only the subnetwork).
+        """
+        try:
+            with open(self.config_file, 'r') as fd:
+                return json.load(fd)
+        except FileNotFoundError:
+            return {}
+
+    def _write_config(self):
+        generation = state.generation()
+        state.write_state(self.config_file, self.config)
+        # Completion doesn't depend on config.cfg ; its cache is still good :
+        completion.renew_cache(generation, self.completion_cache)
+        # Our own change ; nothing to read again :
+        self.generation = state.generation()
+
+    @state.serialized
     def allow_service(self, service_name, scope="local", realm=None):
         if service_name not in self.service_defs:
             raise KeyError("undefined service : %s." %
                            service_name)
+        # Another process may have changed realms since we read them :
+        self.load_realm_defs()
         if realm is None:
             realm = self.realm_id
         # Create an entry for this realm's id if there weren't any :
@@ -185,40 +545,156 @@ class ServiceWall(statefulfirewall.StateFulFireWall):
         """Open ports for a service hosted on this machine.
 
         service_name should be one of self.service_defs' keys.
-        if src is "local", use self.subnetwork instead.
+        if src is "local", use self.subnetwork (or its ipset) instead.
         """
-        if scope == "local":
-            src = self.subnetwork
-        elif scope == "docker":
-            src = "172.16.0.0-172.31.255.255"
-        else:
-            src = ""
+        if self.find_rules(service_name, self.input_chain):
+            raise KeyError("rule already in input chain")
 
-        for rule in self.input_chain.rules:
-            if super()._get_rule_name(rule) == service_name:
-                raise KeyError("rule already in input chain")
+        print("allowing service %s from %s" %
+              (service_name, self._scope_source(scope) or "anywhere"))
+        for rule_def in self.service_rule_defs(service_name, scope):
+            self.insert_rule(self.input_chain,
+                             self._create_service_rule(rule_def))
+
+    def service_rule_defs(self, service_name, scope="local"):
+        """Return the RuleDefs opening service_name's ports, in the order they
+        get inserted on top of the INPUT chain.
 
+        Ports of each protocol are packed in as few rules as multiport
+        allows.
+        """
+        src = self._scope_source(scope)
         service = self.service_defs[service_name]
-        print("allowing service %s from %s" %
-              (service_name, src or "anywhere"))
-        for port in service.ports.tcp:
-            rule = self.create_rule(service_name,
-                                    "ACCEPT",
-                                    src=src,
-                                    dport=port,
-                                    proto="tcp"
-                                    )
-            self.input_chain.insert_rule(rule)
-        for port in service.ports.udp:
-            rule = self.create_rule(service_name,
-                                    "ACCEPT",
-                                    src=src,
-                                    dport=port,
-                                    proto="udp"
-                                    )
-            self.input_chain.insert_rule(rule)
+        return [
+            *(RuleDef(service_name, "tcp", ports, src)
+              for ports in compact_ports(service.ports.tcp)),
+            *(RuleDef(service_name, "udp", ports, src)
+              for ports in compact_ports(service.ports.udp)),
+        ]
+
+    def realm_rule_defs(self, realm):
+        """Return the RuleDefs of realm's services, in the order they appear
+        in the INPUT chain once started.
+        """
+        rule_defs = []
+        for service_name, scope in reversed(self.service_order(realm)):
+            rule_defs.extend(self.service_rule_defs(service_name, scope))
+        # Each rule gets inserted on top of the previous ones :
+        rule_defs.reverse()
+        return rule_defs
+
+    def service_order(self, realm):
+        """Return realm's (service_name, scope) items in the order their
+        rules appear in the INPUT chain : by decreasing hit rate, and for
+        equal rates - as when nothing was counted yet - the last allowed on
+        top.
+        """
+        services = list(self.realm_defs[realm].items())
+        services.reverse()
+        services.sort(key=lambda service: -self.hit_rates.rate(realm,
+                                                                service[0]))
+        return services
+
+    def read_hit_counters(self):
+        """Return how many packets the rules of each service in the INPUT
+        chain have accepted, as a dict of service name -> packets.
+        """
+        counters = {}
+        for rule, packets, _ in self.read_counters()["INPUT"].rules:
+            rule_def = self.get_rule_def(rule)
+            if rule_def:
+                counters[rule_def.name] = counters.get(rule_def.name, 0) + \
+                    packets
+        return counters
+
+    def record_hits(self):
+        """Fold the counters of service rules into the hit rates of the
+        realm they were loaded for, and save them.
+        """
+        if self.backend != "iptables" or not self.up:
+            return
+        counters = self.read_hit_counters()
+        if not counters:
+            return
+        realm = self.loaded_realm or self.realm_id
+        # If we don't know better, the chain may still hold another realm's
+        # services ; don't credit them to this one :
+        if realm not in self.realm_defs or \
+                not counters.keys() <= self.realm_defs[realm].keys():
+            return
+        self.hit_rates.update(realm, counters)
+        self.hit_rates.save()
+
+    @state.serialized
+    def optimize(self):
+        """Order service rules by their hit rates now rather than at the
+        next reload, and show these rates.
+        """
+        if self.backend != "iptables":
+            print("%s matches ports in sets, there is no rule order to "
+                  "optimize" % self.backend)
+            return
+        if not self.up:
+            raise AssertionError("%s isn't started" % self.identifier)
+        self.reload()
+        for service_name, _ in self.service_order(self.realm_id):
+            print("%10.4f hits/s  %s" %
+                  (self.hit_rates.rate(self.realm_id, service_name),
+                   service_name))
+
+    def count_service_rules(self, realm):
+        """Return how many rules open realm's services, and how many there
+        would be with one rule per port or port range.
+        """
+        port_count = 0
+        for service_name in self.realm_defs[realm]:
+            ports = self.service_defs[service_name].ports
+            port_count += len(ports.tcp) + len(ports.udp)
+        return len(self.realm_rule_defs(realm)), port_count
+
+    def realm_scopes(self, realm):
+        """Return realm's allowed ports grouped by scope, as a list of
+        (scope, networks, {"tcp": ports, "udp": ports}) tuples.
+        """
+        scopes = {}
+        for service_name, scope in self.realm_defs[realm].items():
+            if scope not in scopes:
+                scopes[scope] = {"tcp": [], "udp": []}
+            ports = self.service_defs[service_name].ports
+            scopes[scope]["tcp"].extend(ports.tcp)
+            scopes[scope]["udp"].extend(ports.udp)
+        return [ (scope, self._scope_networks(scope), ports)
+                 for scope, ports in scopes.items() ]
+
+    def _scope_networks(self, scope):
+        """Return the networks a scope allows, [] meaning anywhere."""
+        if scope == "local":
+            return self.local_networks
+        elif scope == "docker":
+            return ["172.16.0.0/12"]
+        return []
 
+    def _scope_source(self, scope):
+        """Return the source of rules for scope, "" meaning anywhere."""
+        if self.ipsets and scope in ipset.SCOPES:
+            return "set:" + self.ipsets.set_name(scope)
+        if scope == "local":
+            return self.subnetwork or ""
+        elif scope == "docker":
+            return "172.16.0.0-172.31.255.255"
+        return ""
+
+    def _create_service_rule(self, rule_def):
+        return self.create_rule(rule_def.name,
+                                "ACCEPT",
+                                src=rule_def.src,
+                                dport=rule_def.dport,
+                                proto=rule_def.proto
+                                )
+
+    @state.serialized
     def disallow_service(self, service_name, realm=None):
+        self.load_realm_defs()
         if realm is None:
             realm = self.realm_id
         # Create an entry for this realm's essid if there weren't any :
@@ -241,35 +717,57 @@ class ServiceWall(statefulfirewall.StateFulFireWall):
     def remove_service_rule(self, service_name):
         """Closes ports for service service_name if they were opened.
         """
-        for rule in self.input_chain.rules:
-            # Call the FireWall's  private _get_rule_name function
-            if super()._get_rule_name(rule) == service_name:
-                self.del_rule(service_name, self.input_chain)
-                #self.input_chain.delete_rule(rule)
+        if self.backend == "nftables":
+            # Its ports sit in the sets of the table ; load the table again,
+            # without them, as allowing does :
+            if self.up:
+                self.nftables.apply(self.plan(self.realm_id))
+            return
+        with self.transaction():
+            for chain, rule in self.find_rules(service_name,
+                                               self.input_chain):
+                self.delete_rule(chain, rule)
 
     def save_rules(self):
-        with open(self.realm_defs_dict, "w") as fd:
-            json.dump(self.realm_defs, fd, indent=2)
+        state.write_state(self.realm_defs_dict, self.realm_defs)
+        self.generation = state.generation()
         print("saved realm defs to config")
+        self.ruleset_cache.invalidate()
+        self._update_completion_cache()
+
+    def _update_completion_cache(self):
+        completion.write_cache(self.service_defs,
+                               self.realm_defs,
+                               self.realm_id,
+                               self.service_defs.version,
+                               self.completion_cache)
 
     def list_services_in(self):
         """Lists services for which we have allowed ports.
         """
         self.list_rules(self.input_chain)
 
+    def services_by_port(self, port):
+        """Return services using port, by protocol, as in
+
+            {"tcp": ["http", ...], "udp": [...]}
+
+        port can be a number, or a range such as "6112:6114" or "6112-6114" ;
+        then services using any port in that range are returned.
+        """
+        start, end = parse_port_range(port)
+        return self.port_index.lookup(start, end)
+
     def list_services_by_port(self, port):
-        services_list = []
-        for service_name, s_tuple in self.service_defs.items():
-            for service_port_range in (*s_tuple.ports.tcp, *s_tuple.ports.udp):
-                # service_port_range is a string containing either a number or
-                # a range, as in "80:88", "120"
-                if service_port_range.isalnum():
-                    if port == service_port_range:
-                        services_list.append(service_name)
-                else:   # it's a range
-                    start, end = service_port_range.split(":")
-                    if port in range(int(start), int(end)+1):
-                        services_list.append(service_name)
+        """Return names of services using port, whatever the protocol."""
+        try:
+            services = self.services_by_port(port)
+        except ValueError:
+            # Not a port - logs of layer 3 packets have empty ones.
+            return []
+        services_list = services["tcp"]
+        services_list.extend(service_name for service_name in services["udp"]
+                             if service_name not in services["tcp"])
         return services_list
 
     def _enable_hook(self):
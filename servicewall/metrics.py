@@ -0,0 +1,196 @@
+"""Metrics of the firewall, for Prometheus
+
+Gathers, in the text format Prometheus scrapes :
+
+    servicewall_up                              1 if our rules are in place
+    servicewall_service_packets_total           accepted by each service's
+    servicewall_service_bytes_total               rules, since they were added
+    servicewall_service_hit_rate                decayed rate, see hitrates
+    servicewall_policy_packets_total            reaching the end of the INPUT
+    servicewall_policy_bytes_total                and FORWARD chains
+    servicewall_logged_packets_per_second       dropped and logged, by port
+    servicewall_reload_duration_seconds         a summary of reloads
+
+Counters of all rules come from one read of the table. servicewalld exposes
+these either in a file for node_exporter's textfile collector, or on a
+localhost-only HTTP endpoint ; see serve_textfile and serve_http.
+"""
+
+import os
+import socket
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+TEXTFILE = "/var/lib/prometheus/node-exporter/servicewall.prom"
+ADDRESS = "127.0.0.1:9733"
+LOCAL_HOSTS = ("127.0.0.1", "::1", "localhost")
+# Seconds between two writes of the textfile :
+INTERVAL = 15
+# Logged packets are averaged over the last LOG_PERIOD seconds :
+LOG_PERIOD = 60
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n") \
+        .replace('"', '\\"')
+
+
+class Metrics():
+    """Samples grouped by metric name, rendered with render()."""
+
+    def __init__(self):
+        # name -> (type, help, [ (suffix, labels dict, value), ... ]) :
+        self.families = {}
+
+    def add(self, name, kind, help_text, value, suffix="", **labels):
+        """Add a sample to the metric name ; suffix tells apart the _sum and
+        _count of a summary.
+        """
+        if name not in self.families:
+            self.families[name] = (kind, help_text, [])
+        self.families[name][2].append((suffix, labels, value))
+
+    def render(self):
+        lines = []
+        for name, (kind, help_text, samples) in self.families.items():
+            lines.append("# HELP %s %s" % (name, help_text))
+            lines.append("# TYPE %s %s" % (name, kind))
+            for suffix, labels, value in samples:
+                name_labels = name + suffix
+                if labels:
+                    name_labels += "{%s}" % ",".join(
+                        '%s="%s"' % (label, _escape(labels[label]))
+                        for label in sorted(labels))
+                lines.append("%s %s" % (name_labels, repr(float(value))))
+        return "\n".join(lines) + "\n"
+
+
+def collect(firewall, aggregates=None):
+    """Return the Metrics of firewall, a ServiceWall, and of the logs
+    counted in aggregates if given.
+    """
+    metrics = Metrics()
+    metrics.add("servicewall_up", "gauge",
+                "Whether ServiceWall rules are in place.",
+                int(bool(firewall.up)))
+    realm = str(firewall.realm_id)
+
+    if firewall.backend == "iptables" and firewall.up:
+        counters = firewall.read_counters()
+        packets = Counter()
+        bytes_ = Counter()
+        for rule, rule_packets, rule_bytes in counters["INPUT"].rules:
+            rule_def = firewall.get_rule_def(rule)
+            if rule_def:
+                packets[rule_def.name] += rule_packets
+                bytes_[rule_def.name] += rule_bytes
+        for service_name in packets:
+            metrics.add("servicewall_service_packets_total", "counter",
+                        "Packets accepted by a service's rules.",
+                        packets[service_name],
+                        service=service_name, realm=realm)
+        for service_name in bytes_:
+            metrics.add("servicewall_service_bytes_total", "counter",
+                        "Bytes accepted by a service's rules.",
+                        bytes_[service_name],
+                        service=service_name, realm=realm)
+        for service_name in packets:
+            metrics.add("servicewall_service_hit_rate", "gauge",
+                        "Decayed rate of packets accepted by a service.",
+                        firewall.hit_rates.rate(firewall.realm_id,
+                                                service_name),
+                        service=service_name, realm=realm)
+        for chain_name, chain in counters.items():
+            metrics.add("servicewall_policy_packets_total", "counter",
+                        "Packets that reached the end of a chain.",
+                        chain.packets, chain=chain_name, policy=chain.policy)
+        for chain_name, chain in counters.items():
+            metrics.add("servicewall_policy_bytes_total", "counter",
+                        "Bytes that reached the end of a chain.",
+                        chain.bytes, chain=chain_name, policy=chain.policy)
+
+    if aggregates is not None:
+        ports = Counter()
+        for (port, _, proto), hits in aggregates.counts(LOG_PERIOD).items():
+            ports[port, proto] += hits
+        for (port, proto), hits in ports.items():
+            metrics.add("servicewall_logged_packets_per_second", "gauge",
+                        "Dropped packets logged, averaged over %i seconds."
+                        % LOG_PERIOD,
+                        hits / LOG_PERIOD, port=port, proto=proto)
+
+    stats = firewall.reload_stats
+    metrics.add("servicewall_reload_duration_seconds", "summary",
+                "Time taken by reloads.", stats["seconds"], suffix="_sum")
+    metrics.add("servicewall_reload_duration_seconds", "summary",
+                "Time taken by reloads.", stats["count"], suffix="_count")
+    return metrics
+
+
+def write_textfile(text, path=TEXTFILE):
+    """Replace path with text in one rename, so node_exporter never reads
+    half a file.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_file = path + ".tmp"
+    with open(temp_file, "w") as fd:
+        fd.write(text)
+    os.replace(temp_file, path)
+
+
+def serve_textfile(render, stopped, path=TEXTFILE, interval=INTERVAL):
+    """Write what render() returns to path every interval seconds, until
+    the threading.Event stopped is set. Runs in a thread of its own.
+    """
+    def loop():
+        while True:
+            try:
+                write_textfile(render(), path)
+            except OSError as error:
+                print("could not write metrics to %s : %s" % (path, error))
+            if stopped.wait(interval):
+                return
+    thread = threading.Thread(target=loop, daemon=True)
+    thread.start()
+    return thread
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """Answer GET /metrics with what the server's render() returns."""
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.server.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes come every few seconds ; don't fill the journal with them.
+        pass
+
+
+class MetricsServer6(ThreadingHTTPServer):
+    address_family = socket.AF_INET6
+
+
+def serve_http(render, address=ADDRESS):
+    """Serve what render() returns on address, "host:port", in a thread of
+    its own. Returns the server ; shut it down with its shutdown().
+    """
+    host, _, port = address.rpartition(":")
+    host = host.strip("[]")
+    if host not in LOCAL_HOSTS:
+        raise AssertionError("metrics are only served on localhost, not on "
+                             "%s" % host)
+    server_class = MetricsServer6 if ":" in host else ThreadingHTTPServer
+    server = server_class((host, int(port)), MetricsHandler)
+    server.render = render
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -1,6 +1,7 @@
 """Useful system calls to ask different things to the wireless controler.
 
-Most of them use fnctl.ioctl to pack and unpack a request.
+Interfaces, addresses and routes are read through rtnetlink, in a
+NetworkSnapshot. Others use fnctl.ioctl to pack and unpack a request.
 
 some insights on packing an address :
 https://pymotw.com/2/socket/addressing.html
@@ -13,66 +14,281 @@ https://docs.python.org/2/library/ctypes.html#arrays
 """
 
 
-import sys
 import socket
 import struct
 import array
 import fcntl
+import ipaddress
+from collections import namedtuple
+
+
+# rtnetlink message types, as in /usr/include/linux/rtnetlink.h :
+RTM_NEWLINK = 16
+RTM_GETLINK = 18
+RTM_NEWADDR = 20
+RTM_GETADDR = 22
+RTM_NEWROUTE = 24
+RTM_GETROUTE = 26
+RTM_NEWNEIGH = 28
+RTM_GETNEIGH = 30
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+NLM_F_REQUEST = 0x1
+NLM_F_DUMP = 0x300
+# Groups we listen to, to know when a snapshot gets stale :
+RTMGRP_LINK = 0x1
+RTMGRP_NEIGH = 0x4
+RTMGRP_IPV4_IFADDR = 0x10
+RTMGRP_IPV4_ROUTE = 0x40
+
+IFLA_ADDRESS = 1
+IFLA_IFNAME = 3
+IFA_ADDRESS = 1
+IFA_LOCAL = 2
+RTA_DST = 1
+RTA_OIF = 4
+RTA_GATEWAY = 5
+RTA_PRIORITY = 6
+RT_TABLE_MAIN = 254
+RTN_UNICAST = 1
+NDA_DST = 1
+NDA_LLADDR = 2
+IFF_UP = 0x1
+IFF_LOOPBACK = 0x8
+
+_nlmsghdr = struct.Struct("=IHHII")
+_rtattr = struct.Struct("=HH")
+_ifinfomsg = struct.Struct("=BxHiII")
+_ifaddrmsg = struct.Struct("=BBBBI")
+_rtmsg = struct.Struct("=BBBBBBBBI")
+_ndmsg = struct.Struct("=BxxxiHBB")
+
+
+Interface = namedtuple("Interface", "index name flags mac addresses")
+Address = namedtuple("Address", "address prefixlen")
+Route = namedtuple("Route", "interface gateway priority")
+
+
+def _rtattributes(data, offset, end):
+    attributes = {}
+    while offset + _rtattr.size <= end:
+        length, attribute_type = _rtattr.unpack_from(data, offset)
+        if length < _rtattr.size:
+            break
+        attributes[attribute_type] = data[offset + _rtattr.size:
+                                          offset + length]
+        offset += (length + 3) & ~3
+    return attributes
 
 
-def get_all_interfaces():
-    """Return a dict of interface names and their IPs.
+def _mac(data):
+    return ":".join("%02x" % byte for byte in data)
 
-    retrieved from http://code.activestate.com/recipes/439093/#c8
+
+def _dump(netlink_socket, message_type, header, sequence):
+    """Send a dump request, and yield (message type, message data, offset of
+    its attributes) for each answer.
     """
-    is_64bits = sys.maxsize > 2**32
-    struct_size = 40 if is_64bits else 32
-    datagram_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    max_possible = 8 # initial value
+    request = _nlmsghdr.pack(_nlmsghdr.size + len(header), message_type,
+                             NLM_F_REQUEST | NLM_F_DUMP, sequence, 0) + header
+    netlink_socket.send(request)
     while True:
-        _bytes = max_possible * struct_size
-        names = array.array('B')
-        for i in range(0, _bytes):
-            names.append(0)
-        outbytes = struct.unpack('iL', fcntl.ioctl(
-            datagram_socket.fileno(),
-            0x8912,  # SIOCGIFCONF
-            struct.pack('iL', _bytes, names.buffer_info()[0])
-        ))[0]
-        if outbytes == _bytes:
-            max_possible *= 2
+        data = netlink_socket.recv(65536)
+        offset = 0
+        while offset + _nlmsghdr.size <= len(data):
+            length, answer_type, _, _, _ = _nlmsghdr.unpack_from(data, offset)
+            if answer_type == NLMSG_DONE:
+                return
+            if answer_type == NLMSG_ERROR:
+                error, = struct.unpack_from("=i", data,
+                                            offset + _nlmsghdr.size)
+                raise OSError(-error, "rtnetlink dump failed")
+            yield answer_type, data[offset:offset + length], _nlmsghdr.size
+            offset += (length + 3) & ~3
+
+
+class NetworkSnapshot():
+    """Interfaces, their IPv4 addresses, the default route and the gateway's
+    MAC address, as read from the kernel in one go through rtnetlink.
+
+    interface is the one carrying the default route - or, offline, the
+    first interface that is up and has an address.
+    """
+
+    def __init__(self):
+        self.interfaces = {}
+        self.routes = []
+        self.neighbours = {}
+        with socket.socket(socket.AF_NETLINK, socket.SOCK_RAW,
+                           socket.NETLINK_ROUTE) as netlink_socket:
+            netlink_socket.bind((0, 0))
+            self._read_links(netlink_socket)
+            self._read_addresses(netlink_socket)
+            self._read_routes(netlink_socket)
+            self._read_neighbours(netlink_socket)
+        self.routes.sort(key=lambda route: route.priority)
+        self.default_route = self.routes[0] if self.routes else None
+        if self.default_route:
+            self.interface = self.interfaces[self.default_route.interface]
         else:
-            break
-    namestr = names.tobytes()
-    ifaces = []
-    for i in range(0, outbytes, struct_size):
-        iface_name = bytes.decode(namestr[i:i+16]).split('\0', 1)[0]
-        iface_addr = socket.inet_ntoa(namestr[i+20:i+24])
-        ifaces.append((iface_name, iface_addr))
-    # We don't care for the loopback interface :
-    for index, iface in enumerate(ifaces):
-        if iface[0] == "lo":
-            del ifaces[index]
-    return ifaces
+            self.interface = next(
+                (interface for interface in self.interfaces.values()
+                 if interface.flags & IFF_UP
+                 and not interface.flags & IFF_LOOPBACK
+                 and interface.addresses), None)
+
+    def _read_links(self, netlink_socket):
+        header = _ifinfomsg.pack(socket.AF_UNSPEC, 0, 0, 0, 0)
+        for message_type, data, offset in _dump(netlink_socket, RTM_GETLINK,
+                                                header, 1):
+            if message_type != RTM_NEWLINK:
+                continue
+            _, _, index, flags, _ = _ifinfomsg.unpack_from(data, offset)
+            attributes = _rtattributes(data, offset + _ifinfomsg.size,
+                                       len(data))
+            name = attributes.get(IFLA_IFNAME, b"").rstrip(b"\0").decode()
+            self.interfaces[index] = Interface(
+                index, name, flags, _mac(attributes.get(IFLA_ADDRESS, b"")),
+                [])
+
+    def _read_addresses(self, netlink_socket):
+        header = _ifaddrmsg.pack(socket.AF_INET, 0, 0, 0, 0)
+        for message_type, data, offset in _dump(netlink_socket, RTM_GETADDR,
+                                                header, 2):
+            if message_type != RTM_NEWADDR:
+                continue
+            family, prefixlen, _, _, index = _ifaddrmsg.unpack_from(data,
+                                                                    offset)
+            attributes = _rtattributes(data, offset + _ifaddrmsg.size,
+                                       len(data))
+            address = attributes.get(IFA_LOCAL) or attributes.get(IFA_ADDRESS)
+            if family == socket.AF_INET and address and \
+                    index in self.interfaces:
+                self.interfaces[index].addresses.append(
+                    Address(socket.inet_ntoa(address), prefixlen))
+
+    def _read_routes(self, netlink_socket):
+        header = _rtmsg.pack(socket.AF_INET, 0, 0, 0, 0, 0, 0, 0, 0)
+        for message_type, data, offset in _dump(netlink_socket, RTM_GETROUTE,
+                                                header, 3):
+            if message_type != RTM_NEWROUTE:
+                continue
+            family, dst_len, _, _, table, _, _, route_type, _ = \
+                _rtmsg.unpack_from(data, offset)
+            if family != socket.AF_INET or dst_len != 0 or \
+                    table != RT_TABLE_MAIN or route_type != RTN_UNICAST:
+                continue
+            attributes = _rtattributes(data, offset + _rtmsg.size, len(data))
+            if RTA_OIF not in attributes:
+                continue
+            index, = struct.unpack("=i", attributes[RTA_OIF])
+            if index not in self.interfaces:
+                continue
+            gateway = attributes.get(RTA_GATEWAY)
+            priority = attributes.get(RTA_PRIORITY)
+            self.routes.append(Route(
+                index,
+                socket.inet_ntoa(gateway) if gateway else None,
+                struct.unpack("=I", priority)[0] if priority else 0))
+
+    def _read_neighbours(self, netlink_socket):
+        header = _ndmsg.pack(socket.AF_INET, 0, 0, 0, 0)
+        for message_type, data, offset in _dump(netlink_socket, RTM_GETNEIGH,
+                                                header, 4):
+            if message_type != RTM_NEWNEIGH:
+                continue
+            attributes = _rtattributes(data, offset + _ndmsg.size, len(data))
+            if NDA_DST in attributes and NDA_LLADDR in attributes:
+                self.neighbours[socket.inet_ntoa(attributes[NDA_DST])] = \
+                    _mac(attributes[NDA_LLADDR])
+
+    @property
+    def gateway(self):
+        """The default gateway's IP address, or None."""
+        if self.default_route:
+            return self.default_route.gateway
+        return None
+
+    @property
+    def gateway_mac(self):
+        """The default gateway's MAC address as in the neighbour table, or
+        None if it isn't there yet.
+        """
+        return self.neighbours.get(self.gateway)
+
+    @property
+    def address(self):
+        """Our IPv4 address and prefix length on self.interface ."""
+        if not self.interface or not self.interface.addresses:
+            raise KeyError("No address found")
+        return self.interface.addresses[0]
+
+
+class _SnapshotCache():
+    """Keep a NetworkSnapshot until the kernel tells of a change in links,
+    addresses, routes or neighbours.
+    """
+
+    def __init__(self):
+        self.snapshot = None
+        self.events = None
+
+    def get(self):
+        if self.events is None:
+            self.events = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW,
+                                        socket.NETLINK_ROUTE)
+            self.events.bind((0, RTMGRP_LINK | RTMGRP_NEIGH |
+                              RTMGRP_IPV4_IFADDR | RTMGRP_IPV4_ROUTE))
+            self.events.setblocking(False)
+        stale = self.snapshot is None
+        while True:
+            try:
+                self.events.recv(65536)
+            except BlockingIOError:
+                break
+            except OSError:
+                # ENOBUFS - we missed events, but we know things changed.
+                pass
+            stale = True
+        if stale:
+            self.snapshot = NetworkSnapshot()
+        return self.snapshot
+
+
+_snapshot_cache = _SnapshotCache()
+
+
+def get_snapshot():
+    """Return a NetworkSnapshot, taken again only if the network changed."""
+    return _snapshot_cache.get()
+
+
+def get_all_interfaces():
+    """Return a list of (interface name, IP), but the loopback interface."""
+    return [ (interface.name, address.address)
+             for interface in get_snapshot().interfaces.values()
+             if not interface.flags & IFF_LOOPBACK
+             for address in interface.addresses ]
 
 
 def get_active_interface():
     """Return the name of the interface serving as gateway.
     """
-    # AF_INET is a flag for ipv4 addressing.
-    #return netifaces.gateways()[netifaces.AF_INET][0][1]
-    return get_all_interfaces()[0][0]
+    interface = get_snapshot().interface
+    if interface is None:
+        raise IndexError("No active interface")
+    return interface.name
 
 
-def get_essid():
+def get_essid(interface=None):
     """Return the ESSID for an interface, or None if we aren't connected.
     """
-    try:
-        interface = get_active_interface()
-    except IndexError:
-        #print("No active interface")
-        return None
-    datagram_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    if interface is None:
+        try:
+            interface = get_active_interface()
+        except IndexError:
+            #print("No active interface")
+            return None
     # The payload for this call is formatted to 32 double hexadecimal ints.
     essid = array.array("b", b"\x00" * 32)
     essid_pointer, essid_length = essid.buffer_info()
@@ -82,15 +298,15 @@ def get_essid():
         interface.ljust(16, "\x00").encode() +
         struct.pack("PHH", essid_pointer, essid_length, 0)
         )
-    try:
-        fcntl.ioctl(
-            datagram_socket.fileno(),
-            0x8b1b,   # SIOCGIWESSID, get essid
-            request
-            )
-    except OSError as error:
-        if error.errno == 95:       # Operation not supported
-            #print("not connected")
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as datagram_socket:
+        try:
+            fcntl.ioctl(
+                datagram_socket.fileno(),
+                0x8b1b,   # SIOCGIWESSID, get essid
+                request
+                )
+        except OSError:
+            # Not a wireless interface, or not connected.
             return None
     name = essid.tobytes().strip(b"\x00").decode()
     if not name:
@@ -99,44 +315,34 @@ def get_essid():
 
 
 def get_realm_id():
-    """Return a unique identifier for the Internet Service Provider
+    """Return a unique identifier for the Internet Service Provider : the
+    ESSID for a wifi network, or else the gateway's MAC address.
     """
-    isp_id = get_essid()
+    snapshot = get_snapshot()
+    if snapshot.interface is None:
+        raise KeyError("No active interface")
+    isp_id = get_essid(snapshot.interface.name)
     if not isp_id:
         # Then the network probably isn't wifi. Check ethernet :
-        import arpreq
-        #isp_id = arpreq.arpreq(get_ip_address(get_active_interface()))
-        isp_id = arpreq.arpreq(get_gateway_address())
+        if not snapshot.gateway:
+            raise KeyError("No gateway found")
+        isp_id = snapshot.gateway_mac
     return isp_id
 
 
 def get_ip_address(ifname):
-    datagram_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    return socket.inet_ntoa(fcntl.ioctl(
-        datagram_socket.fileno(),
-        0x8915,  # SIOCGIFADDR
-        struct.pack("256s", bytes(ifname[:15], "utf-8"))
-    )[20:24])
-
-
-def get_outside_ip_address(ifname):
-    """DOESN'T WORK and I don't know what is this IP it's outputting
-    """
-    datagram_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    return socket.inet_ntoa(fcntl.ioctl(
-        datagram_socket.fileno(),
-        0x8927,  # SIOCGIFHWADDR
-        struct.pack("256s", bytes(ifname[:15], "utf-8"))
-    )[20:24])
+    for interface in get_snapshot().interfaces.values():
+        if interface.name == ifname and interface.addresses:
+            return interface.addresses[0].address
+    raise KeyError("No address for %s" % ifname)
 
 
 def get_netmask(ifname):
-    datagram_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    return socket.inet_ntoa(fcntl.ioctl(
-        datagram_socket.fileno(),
-        0x891b,  # SIOCGIFNETMASK
-        struct.pack("256s", bytes(ifname[:15], "utf-8"))
-    )[20:24])
+    for interface in get_snapshot().interfaces.values():
+        if interface.name == ifname and interface.addresses:
+            return str(ipaddress.IPv4Network(
+                "0.0.0.0/%i" % interface.addresses[0].prefixlen).netmask)
+    raise KeyError("No address for %s" % ifname)
 
 
 def get_subnetwork():
@@ -144,12 +350,25 @@ def get_subnetwork():
 
             "192.168.1.0/255.255.255.0"
     """
-    interface = get_active_interface()
-    address = get_ip_address(interface).split(".")
-    netmask = get_netmask(interface).split(".")
-    subnetwork = [ str(int(int(address_block) * int(netmask_block) / 255))
-                   for address_block, netmask_block in zip(address, netmask) ]
-    return "/".join((".".join(subnetwork), ".".join(netmask)))
+    address = get_snapshot().address
+    network = ipaddress.IPv4Network("%s/%i" % address, strict=False)
+    return "%s/%s" % (network.network_address, network.netmask)
+
+
+def get_local_networks():
+    """Return the networks of all interfaces that are up but the loopback
+    one, as in ["192.168.1.0/24", "10.0.0.0/8"].
+    """
+    networks = []
+    for interface in get_snapshot().interfaces.values():
+        if not interface.flags & IFF_UP or interface.flags & IFF_LOOPBACK:
+            continue
+        for address in interface.addresses:
+            network = str(ipaddress.IPv4Network("%s/%i" % address,
+                                                strict=False))
+            if network not in networks:
+                networks.append(network)
+    return networks
 
 
 def get_essid_mac_address(ifname):
@@ -205,17 +424,11 @@ def get_essid_alt(ifname):
 
 
 def get_gateway_address():
-    """Read the default gateway directly from /proc.
+    """Return the default gateway's IP address.
     """
-    with open("/proc/net/route") as fh:
-        address = None
-        for line in fh:
-            fields = line.strip().split()
-            if fields[1] != '00000000' or not int(fields[3], 16) & 2:
-                continue
-            address = socket.inet_ntoa(struct.pack("<L", int(fields[2], 16)))
-        if not address:
-            raise KeyError("No gateway found")
+    address = get_snapshot().gateway
+    if not address:
+        raise KeyError("No gateway found")
     return address
 
 
@@ -0,0 +1,456 @@
+"""NFLOG reader
+
+Reads packets logged by the firewall's NFLOG rule straight from the kernel,
+through a netfilter netlink socket, and decodes their IP, TCP and UDP headers
+into records - dicts keyed like the lines ulogd's PRINTPKT used to write :
+
+    {"LOG_DATE": datetime, "PREFIX": "not in allowed services",
+     "IN": "wlan0", "OUT": "", "MAC": "...", "SRC": "192.168.1.12",
+     "DST": "192.168.1.3", "LEN": "60", "TTL": "64", "ID": "5213",
+     "PROTO": "TCP", "SPT": "41628", "DPT": "8080", "SYN": "", ...}
+
+Records are handed to sinks, which are callables taking one record ; those
+with a flush() method get it called after each batch, those with a report()
+one when the reader reports. The "nflog_sinks" key of config.cfg chooses
+them among SINKS :
+
+    journal       writes them to journald, where yield_logs() reads them back
+    store         appends them as json lines to STORE_FILE, rotated past
+                  STORE_SIZE bytes
+    aggregates    counts them live, and reports the most hit ports
+
+Only the journal is used by default.
+
+The kernel gathers up to QUEUE_THRESHOLD packets in one netlink message
+before sending it, and we drain the socket without blocking until it's empty,
+so a port scan costs a few reads instead of one per packet. Packets the
+kernel couldn't deliver are counted in NflogReader.stats :
+
+    received    packets decoded into records
+    malformed   packets we couldn't decode
+    lost        gaps in the kernel's sequence numbers
+    overruns    times our socket buffer overflowed (ENOBUFS)
+"""
+
+import os
+import json
+import errno
+import select
+import signal
+import socket
+import struct
+import ipaddress
+from datetime import datetime
+
+from servicewall.aggregates import Aggregates
+
+
+GROUP = 1
+CONFIG_FILE = "/etc/servicewall/config.cfg"
+STORE_FILE = "/var/log/servicewall/drops.jsonl"
+STORE_SIZE = 16 << 20
+
+NETLINK_NETFILTER = 12
+NFNL_SUBSYS_ULOG = 4
+NFULNL_MSG_PACKET = 0
+NFULNL_MSG_CONFIG = 1
+
+NLM_F_REQUEST = 0x1
+NLM_F_ACK = 0x4
+NLMSG_ERROR = 0x2
+
+# Config attributes and commands :
+NFULA_CFG_CMD = 1
+NFULA_CFG_MODE = 2
+NFULA_CFG_NLBUFSIZ = 3
+NFULA_CFG_TIMEOUT = 4
+NFULA_CFG_QTHRESH = 5
+NFULA_CFG_FLAGS = 6
+NFULNL_CFG_CMD_BIND = 1
+NFULNL_CFG_CMD_UNBIND = 2
+NFULNL_CFG_CMD_PF_BIND = 3
+NFULNL_CFG_CMD_PF_UNBIND = 4
+NFULNL_COPY_PACKET = 2
+NFULNL_CFG_F_SEQ = 0x1
+
+# Packet attributes :
+NFULA_TIMESTAMP = 3
+NFULA_IFINDEX_INDEV = 4
+NFULA_IFINDEX_OUTDEV = 5
+NFULA_HWADDR = 8
+NFULA_PAYLOAD = 9
+NFULA_PREFIX = 10
+NFULA_SEQ = 12
+NFULA_HWHEADER = 16
+
+COPY_RANGE = 128            # Enough for IP options and a TCP header.
+QUEUE_THRESHOLD = 64        # Packets per netlink message,
+FLUSH_TIMEOUT = 10          # or whatever came in within 1/100s units.
+KERNEL_BUFFER = 65536       # Size of the kernel's per-group buffer.
+RECEIVE_BUFFER = 4 << 20    # Our socket's buffer.
+
+_nlmsghdr = struct.Struct("=IHHII")
+_nfgenmsg = struct.Struct("=BBH")
+_nfattr = struct.Struct("=HH")
+_timestamp = struct.Struct(">QQ")
+_ipv4 = struct.Struct(">BBHHHBBH4s4s")
+_tcp = struct.Struct(">HHIIBBHHH")
+_udp = struct.Struct(">HHHH")
+
+TCP_FLAGS = ((0x01, "FIN"), (0x02, "SYN"), (0x04, "RST"), (0x08, "PSH"),
+             (0x10, "ACK"), (0x20, "URG"), (0x40, "ECE"), (0x80, "CWR"))
+# Keys written without a value :
+FLAGS = ("DF", *(flag for _, flag in TCP_FLAGS))
+
+
+def _align(length):
+    return (length + 3) & ~3
+
+
+def _attribute(attribute_type, payload):
+    header = _nfattr.pack(_nfattr.size + len(payload), attribute_type)
+    return header + payload + b"\0" * (_align(len(payload)) - len(payload))
+
+
+def _attributes(data, offset, end):
+    """Return a dict of attribute type -> payload."""
+    attributes = {}
+    while offset + _nfattr.size <= end:
+        length, attribute_type = _nfattr.unpack_from(data, offset)
+        if length < _nfattr.size:
+            break
+        # Strip the NLA_F_NESTED and NLA_F_NET_BYTEORDER bits :
+        attributes[attribute_type & 0x3fff] = \
+            bytes(data[offset + _nfattr.size:offset + length])
+        offset += _align(length)
+    return attributes
+
+
+def _interface_name(index, names={}):
+    if index not in names:
+        try:
+            names[index] = socket.if_indextoname(index)
+        except OSError:
+            return str(index)
+    return names[index]
+
+
+def decode_packet(attributes):
+    """Return a record from the attributes of an NFLOG packet message."""
+    record = {}
+    if NFULA_TIMESTAMP in attributes:
+        seconds, microseconds = _timestamp.unpack(attributes[NFULA_TIMESTAMP])
+        record["LOG_DATE"] = datetime.fromtimestamp(
+            seconds + microseconds / 1000000)
+    else:
+        record["LOG_DATE"] = datetime.now()
+    record["PREFIX"] = attributes.get(NFULA_PREFIX, b"").rstrip(b"\0") \
+        .decode(errors="replace")
+    for key, attribute_type in (("IN", NFULA_IFINDEX_INDEV),
+                                ("OUT", NFULA_IFINDEX_OUTDEV)):
+        if attribute_type in attributes:
+            index, = struct.unpack(">I", attributes[attribute_type])
+            record[key] = _interface_name(index)
+        else:
+            record[key] = ""
+    if NFULA_HWHEADER in attributes:
+        mac = attributes[NFULA_HWHEADER]
+    elif NFULA_HWADDR in attributes:
+        length, = struct.unpack_from(">H", attributes[NFULA_HWADDR])
+        mac = attributes[NFULA_HWADDR][4:4 + length]
+    else:
+        mac = b""
+    record["MAC"] = ":".join("%02x" % byte for byte in mac)
+
+    payload = attributes[NFULA_PAYLOAD]
+    version_ihl, tos, length, ip_id, fragment, ttl, proto, _, src, dst = \
+        _ipv4.unpack_from(payload)
+    if version_ihl >> 4 != 4:
+        raise ValueError("not an IPv4 packet")
+    record.update({
+        "SRC": str(ipaddress.IPv4Address(src)),
+        "DST": str(ipaddress.IPv4Address(dst)),
+        "LEN": str(length),
+        "TOS": "%02X" % (tos & 0xfc),
+        "PREC": "0x%02X" % (tos & 0xe0),
+        "TTL": str(ttl),
+        "ID": str(ip_id),
+    })
+    if fragment & 0x4000:
+        record["DF"] = ""
+    offset = (version_ihl & 0x0f) * 4
+    # Only the first fragment carries the transport header :
+    first_fragment = not fragment & 0x1fff
+    if proto == socket.IPPROTO_TCP:
+        record["PROTO"] = "TCP"
+        if first_fragment and len(payload) >= offset + _tcp.size:
+            spt, dpt, seq, ack, _, flags, window, _, urgp = \
+                _tcp.unpack_from(payload, offset)
+            record.update({
+                "SPT": str(spt), "DPT": str(dpt),
+                "SEQ": str(seq), "ACK": str(ack), "WINDOW": str(window),
+            })
+            for bit, flag in TCP_FLAGS:
+                if flags & bit:
+                    record[flag] = ""
+            record["URGP"] = str(urgp)
+    elif proto == socket.IPPROTO_UDP:
+        record["PROTO"] = "UDP"
+        if first_fragment and len(payload) >= offset + _udp.size:
+            spt, dpt, _, _ = _udp.unpack_from(payload, offset)
+            record.update({ "SPT": str(spt), "DPT": str(dpt) })
+    elif proto == socket.IPPROTO_ICMP:
+        record["PROTO"] = "ICMP"
+        if first_fragment and len(payload) >= offset + 2:
+            record["TYPE"] = str(payload[offset])
+            record["CODE"] = str(payload[offset + 1])
+    else:
+        record["PROTO"] = str(proto)
+    record.setdefault("SPT", "")
+    record.setdefault("DPT", "")
+    return record
+
+
+def format_record(record):
+    """Return record as a line in ulogd's PRINTPKT format."""
+    fields = [ record["PREFIX"] ] if record["PREFIX"] else []
+    for key, value in record.items():
+        if key in ("LOG_DATE", "PREFIX"):
+            continue
+        if key in FLAGS:
+            fields.append(key)
+        elif value or key not in ("SPT", "DPT"):
+            fields.append("%s=%s" % (key, value))
+    return " ".join(fields)
+
+
+class JournalSink():
+    """Write records to journald, in PRINTPKT format, along with their
+    fields prefixed with SW_ so that they can be matched on.
+    """
+
+    def __init__(self):
+        from systemd import journal
+        self.journal = journal
+
+    def __call__(self, record):
+        fields = { "SW_" + key: value for key, value in record.items()
+                   if key != "LOG_DATE" and value }
+        self.journal.send(format_record(record),
+                          SYSLOG_IDENTIFIER="servicewall-nflog",
+                          **fields)
+
+
+class StoreSink():
+    """Append records to a file as json lines. Past max_size bytes, the file
+    is moved to path.1 and a new one is started.
+    """
+
+    def __init__(self, path=STORE_FILE, max_size=STORE_SIZE):
+        self.path = path
+        self.max_size = max_size
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.fd = open(path, "a")
+
+    def __call__(self, record):
+        record = dict(record)
+        record["LOG_DATE"] = record["LOG_DATE"].timestamp()
+        self.fd.write(json.dumps(record) + "\n")
+
+    def flush(self):
+        self.fd.flush()
+        if self.fd.tell() > self.max_size:
+            self.fd.close()
+            os.replace(self.path, self.path + ".1")
+            self.fd = open(self.path, "a")
+
+
+class AggregatesSink(Aggregates):
+    """Count records as they come ; report the most hit ports."""
+
+    def report(self):
+        hits = self.top("DPT", limit=5, period=60)
+        print("nflog : most hit ports in the last minute : %s" %
+              (", ".join("%s (%i)" % (hit.value, hit.hits) for hit in hits)
+               or "none"), flush=True)
+
+
+SINKS = {
+    "journal": JournalSink,
+    "store": StoreSink,
+    "aggregates": AggregatesSink,
+}
+
+
+def read_sinks(config_file=CONFIG_FILE):
+    """Return the sinks named in the "nflog_sinks" key of config_file, or
+    a journal one.
+    """
+    try:
+        with open(config_file) as fd:
+            names = json.load(fd).get("nflog_sinks", ["journal"])
+    except (OSError, ValueError):
+        names = ["journal"]
+    try:
+        return [ SINKS[name]() for name in names ]
+    except KeyError as error:
+        raise KeyError("unknown nflog sink %s, try one of %s" %
+                       (error.args[0], ", ".join(SINKS)))
+
+
+class NflogReader():
+    """Bind to an NFLOG group and hand its packets to sinks."""
+
+    def __init__(self, group=GROUP, sinks=()):
+        self.group = group
+        self.sinks = list(sinks)
+        self.stats = { "received": 0, "malformed": 0,
+                       "lost": 0, "overruns": 0 }
+        self._expected_seq = None
+        self._seq = 0
+        self._buffer = bytearray(RECEIVE_BUFFER)
+        self.socket = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW,
+                                    NETLINK_NETFILTER)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                               RECEIVE_BUFFER)
+        try:
+            # Goes past rmem_max if we're root :
+            self.socket.setsockopt(socket.SOL_SOCKET, 33,   # SO_RCVBUFFORCE
+                                   RECEIVE_BUFFER)
+        except OSError:
+            pass
+        self.socket.bind((0, 0))
+
+    def _configure(self, family, res_id, *attributes):
+        self._seq += 1
+        body = _nfgenmsg.pack(family, 0, socket.htons(res_id)) + \
+            b"".join(attributes)
+        message = _nlmsghdr.pack(
+            _nlmsghdr.size + len(body),
+            (NFNL_SUBSYS_ULOG << 8) | NFULNL_MSG_CONFIG,
+            NLM_F_REQUEST | NLM_F_ACK, self._seq, 0) + body
+        self.socket.send(message)
+        answer = self.socket.recv(4096)
+        length, message_type, _, _, _ = _nlmsghdr.unpack_from(answer)
+        if message_type == NLMSG_ERROR:
+            error, = struct.unpack_from("=i", answer, _nlmsghdr.size)
+            if error:
+                raise SystemError("NFLOG configuration failed : %s" %
+                                  os.strerror(-error))
+
+    def _command(self, command):
+        return _attribute(NFULA_CFG_CMD, struct.pack("=B", command))
+
+    def bind(self):
+        """Bind to our group and have the kernel batch its packets."""
+        try:
+            # Kernels older than 3.17 need the protocol family rebound :
+            self._configure(socket.AF_INET, 0,
+                            self._command(NFULNL_CFG_CMD_PF_UNBIND))
+            self._configure(socket.AF_INET, 0,
+                            self._command(NFULNL_CFG_CMD_PF_BIND))
+        except SystemError:
+            pass
+        self._configure(socket.AF_UNSPEC, self.group,
+                        self._command(NFULNL_CFG_CMD_BIND))
+        self._configure(
+            socket.AF_UNSPEC, self.group,
+            _attribute(NFULA_CFG_MODE,
+                       struct.pack(">IBx", COPY_RANGE, NFULNL_COPY_PACKET)),
+            _attribute(NFULA_CFG_NLBUFSIZ, struct.pack(">I", KERNEL_BUFFER)),
+            _attribute(NFULA_CFG_QTHRESH, struct.pack(">I", QUEUE_THRESHOLD)),
+            _attribute(NFULA_CFG_TIMEOUT, struct.pack(">I", FLUSH_TIMEOUT)),
+            _attribute(NFULA_CFG_FLAGS, struct.pack(">H", NFULNL_CFG_F_SEQ)))
+
+    def unbind(self):
+        self._configure(socket.AF_UNSPEC, self.group,
+                        self._command(NFULNL_CFG_CMD_UNBIND))
+
+    def _handle(self, data):
+        """Decode all netlink messages in data, and feed the sinks."""
+        offset = 0
+        while offset + _nlmsghdr.size <= len(data):
+            length, message_type, _, _, _ = _nlmsghdr.unpack_from(data, offset)
+            if length < _nlmsghdr.size:
+                break
+            end = offset + length
+            if message_type == (NFNL_SUBSYS_ULOG << 8) | NFULNL_MSG_PACKET:
+                attributes = _attributes(
+                    data, offset + _nlmsghdr.size + _nfgenmsg.size, end)
+                self._check_seq(attributes)
+                try:
+                    record = decode_packet(attributes)
+                except (KeyError, ValueError, struct.error):
+                    self.stats["malformed"] += 1
+                else:
+                    self.stats["received"] += 1
+                    for sink in self.sinks:
+                        sink(record)
+            offset += _align(length)
+
+    def _check_seq(self, attributes):
+        if NFULA_SEQ not in attributes:
+            return
+        seq, = struct.unpack(">I", attributes[NFULA_SEQ])
+        if self._expected_seq is not None and seq > self._expected_seq:
+            self.stats["lost"] += seq - self._expected_seq
+        self._expected_seq = seq + 1
+
+    def drain(self):
+        """Read all that's waiting on the socket without blocking."""
+        while True:
+            try:
+                size = self.socket.recv_into(self._buffer, 0,
+                                             socket.MSG_DONTWAIT)
+            except BlockingIOError:
+                return
+            except OSError as error:
+                if error.errno == errno.ENOBUFS:
+                    self.stats["overruns"] += 1
+                    continue
+                raise
+            self._handle(memoryview(self._buffer)[:size])
+
+    def run(self):
+        """Read packets until interrupted."""
+        self.bind()
+        poller = select.poll()
+        poller.register(self.socket, select.POLLIN)
+        try:
+            while True:
+                poller.poll()
+                self.drain()
+                self.flush()
+        finally:
+            self.unbind()
+            self.flush()
+
+    def flush(self):
+        for sink in self.sinks:
+            if hasattr(sink, "flush"):
+                sink.flush()
+
+    def report(self):
+        # stdout is a pipe to the journal under systemd, hence block
+        # buffered ; without flushing, reports would only show at exit.
+        print("nflog : %(received)i packets, %(malformed)i malformed, "
+              "%(lost)i lost, %(overruns)i overruns" % self.stats, flush=True)
+        for sink in self.sinks:
+            if hasattr(sink, "report"):
+                sink.report()
+
+
+def main():
+    reader = NflogReader(sinks=read_sinks())
+    signal.signal(signal.SIGUSR1, lambda signum, frame: reader.report())
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        reader.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        reader.report()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+"""nftables backend
+
+Renders ServiceWall's ruleset as a single nft script and loads it with
+`nft -f`, which applies the whole script in one atomic transaction.
+
+Allowed ports aren't spread over one rule per port and protocol ; they live in
+named sets, one per scope and protocol, as in
+
+    set local_tcp { type inet_service; flags interval; elements = { 22, 80 } }
+
+so a packet is checked against all services of a scope with one set lookup.
+"""
+
+import ipaddress
+import subprocess
+
+
+def _nft(*args, script=None):
+    try:
+        return subprocess.run(["nft", *args],
+                              input=script,
+                              capture_output=True,
+                              check=True,
+                              text=True).stdout
+    except FileNotFoundError:
+        raise AssertionError("'nft' not found in the path, is nftables"
+                             " installed on this machine ?")
+    except subprocess.CalledProcessError as error:
+        raise SystemError("nft failed : %s" % error.stderr.strip())
+
+
+def _nft_source(src):
+    """Translate an iptables source into an nft set element :
+
+        "192.168.1.0/255.255.255.0" -> "192.168.1.0/24"
+        "172.16.0.0-172.31.255.255" is kept as is
+    """
+    if "-" in src:
+        return src
+    return str(ipaddress.ip_network(src, strict=False))
+
+
+class NfTables():
+    """ServiceWall's ruleset expressed in an nftables table.
+
+    The table holds its own input, forward and output chains. Stopping the
+    firewall deletes the table as a whole, so nothing else in the ruleset is
+    touched.
+    """
+
+    family = "inet"
+    name = "servicewall"
+
+    def __init__(self, identifier):
+        self.identifier = identifier
+
+    @property
+    def table(self):
+        return "%s %s" % (self.family, self.name)
+
+    def render(self, scopes):
+        """Return the nft script defining the whole table.
+
+        scopes is a list of (scope, sources, ports) tuples, where sources is a
+        list of networks ([] for anywhere) and ports is a dict of lists of
+        port strings, as in {"tcp": ["22", "6112:6114"], "udp": []}.
+        """
+        lines = [
+            # Declaring then deleting the table lets the script run whether or
+            # not it already exists :
+            "table %s" % self.table,
+            "delete table %s" % self.table,
+            "table %s {" % self.table,
+        ]
+        rules = []
+        for scope, sources, ports in scopes:
+            match = ""
+            if sources:
+                lines.extend(self._render_set(
+                    "%s_sources" % scope, "ipv4_addr",
+                    [ _nft_source(src) for src in sources ]))
+                match = "ip saddr @%s_sources " % scope
+            for proto in ("tcp", "udp"):
+                set_name = "%s_%s" % (scope, proto)
+                lines.extend(self._render_set(
+                    set_name,
+                    "inet_service",
+                    [ port.replace(":", "-") for port in ports[proto] ]))
+                rules.append('%s%s dport @%s accept comment "%s:%s"' % (
+                    match, proto, set_name, self.identifier, scope))
+
+        lines.extend([
+            "  chain input {",
+            "    type filter hook input priority 0; policy drop;",
+            # ServiceWall doesn't support IPv6 ; drop it first thing :
+            "    meta nfproto ipv6 drop",
+            '    ct state related,established accept comment "%s:%s"' % (
+                self.identifier, "RELATED,ESTABLISHED"),
+            '    ip saddr 127.0.0.1 ip daddr 127.0.0.1 accept comment "%s:%s"'
+            % (self.identifier, "localhost"),
+            *("    " + rule for rule in rules),
+            '    icmp type echo-request accept comment "%s:icmp"' %
+            self.identifier,
+            "    ip protocol igmp drop",
+            '    limit rate 1/second burst 1 packets log prefix'
+            ' "not in allowed services" group 1 comment "%s:log"' %
+            self.identifier,
+            '    ct state invalid drop comment "%s:INVALID"' %
+            self.identifier,
+            "  }",
+            "  chain forward {",
+            "    type filter hook forward priority 0; policy drop;",
+            "  }",
+            "  chain output {",
+            "    type filter hook output priority 0; policy accept;",
+            "    meta nfproto ipv6 drop",
+            "  }",
+            "}",
+        ])
+        return "\n".join(lines) + "\n"
+
+    def _render_set(self, name, set_type, elements):
+        lines = [
+            "  set %s {" % name,
+            "    type %s; flags interval; auto-merge;" % set_type,
+        ]
+        if elements:
+            lines.append("    elements = { %s }" % ", ".join(elements))
+        lines.append("  }")
+        return lines
+
+    def apply(self, script):
+        """Load a script made by self.render in one atomic batch."""
+        _nft("-f", "-", script=script)
+
+    def flush(self):
+        """Remove our table, and all of its rules and sets along with it."""
+        if self.status():
+            _nft("delete", "table", self.family, self.name)
+        else:
+            print("no table found for id %s." % self.identifier)
+
+    def status(self):
+        """Returns True if our table is loaded."""
+        try:
+            _nft("list", "table", self.family, self.name)
+        except SystemError:
+            return False
+        return True
+
+    def list_rules(self):
+        """Yield the lines of our table, as nft lists them."""
+        yield from _nft("list", "table", self.family, self.name).splitlines()
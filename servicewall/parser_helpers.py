@@ -4,20 +4,51 @@
 """
 
 __all__ = [ "no_arg_provided", "enable", "disable", "start", "stop", "reload",
-            "show_logs", "show_realm", "show_realms", "show_services",
-            "show_service", "status", "allow_service", "disallow_service" ]
+            "optimize", "plan", "show_logs", "show_top", "show_realm",
+            "show_realms", "show_services", "show_service", "show_metrics",
+            "status", "allow_service", "disallow_service" ]
 
 
 import json
 from datetime import datetime
 #import select
 #import putch
-import socket
 import servicewall
+from servicewall import aggregates
+from servicewall import catalog
+from servicewall import client
+from servicewall import completion
+from servicewall import metrics
+from servicewall import resolver
+from servicewall import topk
+from servicewall.service_helpers import PortIndex, parse_port_range
 
 
 DEBUG = False
-firewall = servicewall.ServiceWall()
+_firewall = None
+
+
+def get_firewall():
+    """Return the ServiceWall instance, built the first time a command needs
+    it ; commands that only read definitions don't.
+    """
+    global _firewall
+    if _firewall is None:
+        _firewall = servicewall.ServiceWall()
+    return _firewall
+
+
+def via_daemon(command, **args):
+    """Have servicewalld run command if it's listening, so that it keeps its
+    state in sync. Returns (True, result), or (False, None) if we're on our
+    own.
+    """
+    try:
+        return True, client.call(command, **args)
+    except client.DaemonUnavailable:
+        return False, None
+    except PermissionError as error:
+        raise SystemExit(error.args[0])
 
 
 def prettyprint(obj):
@@ -35,6 +66,7 @@ def print_dict(dictionary, depth=1):
 
 
 def print_service(port):
+    firewall = get_firewall()
     services_list = firewall.list_services_by_port(port)
     if len(services_list) > 1:
         return '%s*' % services_list[0]
@@ -49,33 +81,69 @@ def no_arg_provided(args):
 
 
 def enable(args):
+    firewall = get_firewall()
     firewall.enable()
 
 
 def disable(args):
+    firewall = get_firewall()
     firewall.disable()
 
 
 def start(args):
+    if via_daemon("start")[0]:
+        return
+    firewall = get_firewall()
     firewall.start()
 
 
 def stop(args):
+    if via_daemon("stop")[0]:
+        return
+    firewall = get_firewall()
     firewall.stop()
 
 
 def reload(args):
+    if via_daemon("reload")[0]:
+        return
+    firewall = get_firewall()
     firewall.reload()
 
 
+def optimize(args):
+    if via_daemon("optimize")[0]:
+        return
+    firewall = get_firewall()
+    firewall.optimize()
+
+
+def plan(args):
+    if args.apply:
+        if via_daemon("apply", realm=args.realm)[0]:
+            return
+        get_firewall().apply_plan(args.realm)
+        return
+    # Compiled here ; no need for the daemon nor for root :
+    print(get_firewall().plan(args.realm, ipv6=args.ipv6), end="")
+
+
 def status(args):
-    if firewall.is_enabled():
+    answered, state = via_daemon("status")
+    if not answered:
+        firewall = get_firewall()
+        state = {
+            "enabled": firewall.is_enabled(),
+            "up": firewall.up,
+            "realm_id": firewall.realm_id,
+        }
+    if state["enabled"]:
         print("ServiceWall is enabled")
     else:
         print("ServiceWall is disabled")
-    if firewall.up:
-        if firewall.realm_id:
-            realm_name = firewall.realm_id
+    if state["up"]:
+        if state["realm_id"]:
+            realm_name = state["realm_id"]
         else:
             realm_name = "no network"
         print("and started - using profile for realm %s" % realm_name)
@@ -95,7 +163,14 @@ def allow_service(args):
     else:
         realm = None
     # Make it local by default :
-    firewall.allow_service(args.service_name, scope=scope, realm=realm)
+    try:
+        if via_daemon("allow", service_name=args.service_name,
+                      scope=scope, realm=realm)[0]:
+            return
+        firewall = get_firewall()
+        firewall.allow_service(args.service_name, scope=scope, realm=realm)
+    except KeyError as error:
+        raise SystemExit(error.args[0])
 
 
 def disallow_service(args):
@@ -104,12 +179,24 @@ def disallow_service(args):
         realm = "ServiceWall:default"
     else:
         realm = None
-    firewall.disallow_service(service_name, realm=realm)
+    try:
+        if via_daemon("disallow", service_name=service_name, realm=realm)[0]:
+            return
+        firewall = get_firewall()
+        firewall.disallow_service(service_name, realm=realm)
+    except KeyError as error:
+        raise SystemExit(error.args[0])
 
 
 def show_table(args):
+    firewall = get_firewall()
     print('You are using realm profile : %s' %
           (firewall.realm_id or "ServiceWall:default"))
+    if firewall.backend == "nftables":
+        print('=> nftables table %s <=' % firewall.nftables.table)
+        for line in firewall.nftables.list_rules():
+            print(line)
+        return
     print('=> Input rules <=           : policy %6s' %
           firewall.input_chain.get_policy().name)
     for rule in firewall.list_rules(firewall.input_chain):
@@ -123,6 +210,7 @@ def show_table(args):
 
 
 def show_realm(args):
+    firewall = get_firewall()
     if firewall.realm_id:
         print('This machine is connected to ESSID "%s".' % firewall.realm_id)
     else:
@@ -130,105 +218,174 @@ def show_realm(args):
     #prettyprint(firewall.realm_defs[firewall.realm_id])
 
 
+def show_metrics(args):
+    answered, text = via_daemon("metrics")
+    if not answered:
+        # Without the daemon, there are no log aggregates nor reloads :
+        text = metrics.collect(get_firewall()).render()
+    print(text, end="")
+
+
 def show_realms(args):
-    #print_dict(firewall.realm_defs)
-    prettyprint(firewall.realm_defs)
+    # Not through servicewall.ServiceWall, which imports iptc and systemd :
+    with open(completion.REALM_DEFS_DICT) as fd:
+        realm_defs = json.load(fd)
+    #print_dict(realm_defs)
+    prettyprint(realm_defs)
 
 
 def show_service(args):
-    s = firewall.service_defs[args.service_name]._asdict()
+    try:
+        s = catalog.load()[args.service_name]._asdict()
+    except KeyError:
+        raise SystemExit("unknown service %s - see braise show services"
+                         % args.service_name)
     s["ports"] = s["ports"]._asdict()
     prettyprint(s)
 
 
 def show_services(args):
-    for service in firewall.service_defs:
+    service_defs = catalog.load()
+    for service in service_defs:
         print("%s - %s"
-              % (service, firewall.service_defs[service].description))
+              % (service, service_defs[service].description))
 
 
 def show_port(args):
-    port = args.port_name
-    services_list = firewall.list_services_by_port(port)
-    if services_list:
-        if len(services_list) == 1:
-            print("service using port %s : %s" % (port, services_list[0]))
-        else:
-            print('services using port %s :' % port)
-            #[ print("  - %s" % i) for i in services_list ]
-            prettyprint(services_list)
-    else:
-        print("port %s unknown." % port)
+    port_index = PortIndex()
+    for service_name, ranges in catalog.load().port_ranges():
+        port_index.add_ranges(service_name, ranges)
+    for port in args.port_name:
+        try:
+            services = port_index.lookup(*parse_port_range(port))
+        except ValueError:
+            print("%s is not a port nor a port range." % port)
+            continue
+        if not services["tcp"] and not services["udp"]:
+            print("port %s unknown." % port)
+            continue
+        print("services using port %s :" % port)
+        for proto, services_list in services.items():
+            if services_list:
+                print("  %s : %s" % (proto, ", ".join(services_list)))
 
 
 def show_logs(args):
-    if "period" in args:
+    firewall = get_firewall()
+    follow = getattr(args, "follow", False)
+    if follow:
+        # Show the last minute, then wait for new logs :
+        yielder = firewall.follow_logs(period=getattr(args, "period", 60))
+    elif getattr(args, "new", False):
+        yielder = firewall.yield_new_logs(period=3600)
+    elif "period" in args:
         yielder = firewall.yield_logs(period=args.period)
+    elif "number" in args:
+        yielder = firewall.yield_logs(limit=args.number)
     else:
         yielder = firewall.yield_logs()
-    if "number" in args:
-        limit = int(args.number)
-        i = 0
+
+    if getattr(args, "with_hostnames", False):
+        hostname_resolver = resolver.Resolver()
+        # Don't hold new logs back while following :
+        yielder = hostname_resolver.annotate(
+            yielder, chunk_size=1 if follow else resolver.CHUNK_SIZE)
     else:
-        limit = None
+        hostname_resolver = None
+        yielder = ( (log, None) for log in yielder )
 
     now = datetime.today()
-
-    for log in yielder:
-        if limit:
-            i += 1
-            if i > limit:
-                break
-
-        if "with_hostnames" in args:
-            # If we have a hostname, output it - shortened if longer than :
-            try:
-                hostname = socket.gethostbyaddr(log['SRC'])[0]
-                if len(hostname) > 20:
-                    log['SRC'] = '%s ..%s' % (log['SRC'], hostname[-17:])
-                else:
-                    log['SRC'] = '%s %s' % (log['SRC'], hostname)
-            except socket.herror:
-                pass
-
-        # If we have ports, try to name the associated service :
-        if log['DPT'] or log['SPT']:
-            servicename = print_service(log['DPT'])
+    try:
+        for log, hostname in yielder:
+            if follow:
+                now = datetime.today()
+            print_log(log, now, hostname)
+    finally:
+        if hostname_resolver:
+            hostname_resolver.save()
+
+
+def show_top(args):
+    estimates = None
+    # servicewalld answers for the last day, from its aggregates :
+    if args.capacity is None and args.period <= aggregates.Aggregates().span:
+        answered, top = via_daemon("top", criteria=args.criteria,
+                                   limit=args.number, period=args.period)
+        if answered:
+            estimates = [ topk.Estimate(hit["value"], hit["hits"],
+                                        hit["error"])
+                          for hit in top["hits"] ]
+            bound = top["error_bound"]
+            print("counted by servicewalld in buckets of %i seconds" %
+                  top["bucket_width"])
+    if estimates is None:
+        counter = get_firewall().heavy_hitters(
+            args.criteria, period=args.period,
+            capacity=args.capacity or topk.CAPACITY)
+        estimates = counter.top(args.number)
+        bound = counter.error_bound
+        print("%i logs counted in %i counters" %
+              (counter.total, counter.capacity))
+    print("%8s %8s  %s" % ("hits", "error", args.criteria))
+    for estimate in estimates:
+        value = estimate.value
+        if args.criteria == "DPT" and value:
+            service = print_service(value)
+            if service:
+                value = "%s (%s)" % (value, service)
+        print("%8i %8s  %s" % (estimate.count,
+                               "+%i" % estimate.error if estimate.error
+                               else "", value))
+    if bound:
+        print("counts may be overestimated by up to %i ; no value hit more "
+              "than that is missed" % bound)
+
+
+def print_log(log, now, hostname=None):
+    if hostname:
+        # Output the hostname along - shortened if longer than :
+        if len(hostname) > 20:
+            log['SRC'] = '%s ..%s' % (log['SRC'], hostname[-17:])
+        else:
+            log['SRC'] = '%s %s' % (log['SRC'], hostname)
+
+    # If we have ports, try to name the associated service :
+    if log['DPT'] or log['SPT']:
+        servicename = print_service(log['DPT'])
+        if servicename:
+            service = '> %s (%s/%s)' % (
+                servicename,
+                log['PROTO'],
+                log['DPT']
+            )
+        else:
+            servicename = print_service(log['SPT'])
             if servicename:
-                service = '> %s (%s/%s)' % (
+                service = '>>%s (%s/%s)' % (
                     servicename,
                     log['PROTO'],
-                    log['DPT']
+                    log['SPT']
                 )
             else:
-                servicename = print_service(log['SPT'])
-                if servicename:
-                    service = '>>%s (%s/%s)' % (
-                        servicename,
-                        log['PROTO'],
-                        log['SPT']
-                    )
-                else:
-                    # We have no port, display protocol :
-                    service = '%5s>%5s %-5s' % (
-                        log['SPT'],
-                        log['DPT'],
-                        log['PROTO']
-                    )
-        else:
-            # We have no port, display protocol :
-            service = 'layer3: %s' % log['PROTO']
-
-        age = now - log['LOG_DATE']
-        if age.days:
-            age = str(age).split(',')[0]
-        else:
-            age = str(age).split('.')[0]
-
-        print('%-36s %-16s %17s %-8s' % (
-            log['SRC'],
-            log['DST'],
-            service,
-            age
-        ))
+                # We have no port, display protocol :
+                service = '%5s>%5s %-5s' % (
+                    log['SPT'],
+                    log['DPT'],
+                    log['PROTO']
+                )
+    else:
+        # We have no port, display protocol :
+        service = 'layer3: %s' % log['PROTO']
 
+    age = now - log['LOG_DATE']
+    if age.days:
+        age = str(age).split(',')[0]
+    else:
+        age = str(age).split('.')[0]
+
+    print('%-36s %-16s %17s %-8s' % (
+        log['SRC'],
+        log['DST'],
+        service,
+        age
+    ), flush=True)
@@ -0,0 +1,180 @@
+"""Reverse DNS for logs
+
+Resolving the source of each log line one after the other stalls on every
+slow answer, and asks again for the same scanner. A Resolver looks up each
+address of a batch once, on a few threads, gives up on each lookup that
+takes longer than a timeout from when it started, and remembers answers -
+hostnames for TTL seconds, failures and timeouts for NEGATIVE_TTL seconds -
+in a cache saved to CACHE_FILE, for the next run and the systray to reuse.
+
+If every thread is stuck on a lookup that timed out, addresses whose lookup
+never started are given up on too, without caching anything for them.
+"""
+
+import os
+import json
+import time
+import socket
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+
+CACHE_FILE = "/var/cache/servicewall/hostnames.json"
+TTL = 3600
+NEGATIVE_TTL = 300
+MAX_ENTRIES = 4096
+TIMEOUT = 2.0
+WORKERS = 8
+CHUNK_SIZE = 64
+
+
+def _lookup(address):
+    try:
+        return socket.gethostbyaddr(address)[0]
+    except (socket.herror, socket.gaierror, UnicodeError):
+        return None
+
+
+class Resolver():
+    """Resolve addresses to hostnames, concurrently and through a cache."""
+
+    def __init__(self, cache_file=CACHE_FILE, timeout=TIMEOUT,
+                 workers=WORKERS):
+        self.cache_file = cache_file
+        self.timeout = timeout
+        self.workers = workers
+        # address -> [hostname or None, expiry date], least recent first :
+        self.cache = OrderedDict()
+        self.changed = False
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.cache_file) as fd:
+                entries = json.load(fd)
+        except (OSError, ValueError):
+            return
+        now = time.time()
+        for address, (hostname, expiry) in entries.items():
+            if expiry > now:
+                self.cache[address] = [hostname, expiry]
+
+    def save(self):
+        """Write the cache down if it changed, if we're allowed to."""
+        if not self.changed:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)
+            temp_file = self.cache_file + ".tmp"
+            with open(temp_file, "w") as fd:
+                json.dump(self.cache, fd)
+            os.replace(temp_file, self.cache_file)
+            self.changed = False
+        except OSError:
+            pass
+
+    def cached(self, address):
+        """Return (True, hostname or None) if address is in the cache, or
+        (False, None).
+        """
+        entry = self.cache.get(address)
+        if entry is None:
+            return False, None
+        if entry[1] < time.time():
+            del self.cache[address]
+            return False, None
+        self.cache.move_to_end(address)
+        return True, entry[0]
+
+    def _remember(self, address, hostname):
+        ttl = TTL if hostname else NEGATIVE_TTL
+        self.cache[address] = [hostname, time.time() + ttl]
+        self.cache.move_to_end(address)
+        while len(self.cache) > MAX_ENTRIES:
+            self.cache.popitem(last=False)
+        self.changed = True
+
+    def resolve(self, addresses):
+        """Return a dict of address -> hostname, or None if it has none or
+        took too long to answer.
+        """
+        hostnames = {}
+        missing = []
+        for address in addresses:
+            if address in hostnames or address in missing:
+                continue
+            found, hostname = self.cached(address)
+            if found:
+                hostnames[address] = hostname
+            else:
+                missing.append(address)
+        if not missing:
+            return hostnames
+
+        workers = min(self.workers, len(missing))
+        executor = ThreadPoolExecutor(max_workers=workers)
+        # address -> when its lookup started :
+        started = {}
+
+        def timed_lookup(address):
+            started[address] = time.monotonic()
+            return _lookup(address)
+
+        futures = { executor.submit(timed_lookup, address): address
+                    for address in missing }
+        pending = set(futures)
+        # Lookups that timed out but still hold a thread :
+        stuck = set()
+        try:
+            while pending:
+                deadlines = [ started[futures[future]] + self.timeout
+                              for future in pending
+                              if futures[future] in started ]
+                if deadlines:
+                    timeout = max(0, min(deadlines) - time.monotonic())
+                else:
+                    timeout = self.timeout
+                done, pending = wait(pending, timeout=timeout,
+                                     return_when=FIRST_COMPLETED)
+                for future in done:
+                    address = futures[future]
+                    hostnames[address] = future.result()
+                    self._remember(address, hostnames[address])
+                now = time.monotonic()
+                for future in list(pending):
+                    address = futures[future]
+                    if address in started and \
+                            now - started[address] >= self.timeout:
+                        # Don't wait again on this one :
+                        hostnames[address] = None
+                        self._remember(address, None)
+                        pending.discard(future)
+                        stuck.add(future)
+                stuck = { future for future in stuck if not future.done() }
+                if pending and len(stuck) >= workers:
+                    # No thread left to start the others.
+                    for future in pending:
+                        future.cancel()
+                        hostnames[futures[future]] = None
+                    break
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+        return hostnames
+
+    def annotate(self, logs, chunk_size=CHUNK_SIZE):
+        """Yield (log, hostname of its SRC) for logs, in their order. Logs
+        are resolved chunk_size at a time.
+        """
+        chunk = []
+        for log in logs:
+            chunk.append(log)
+            if len(chunk) >= chunk_size:
+                yield from self._annotate_chunk(chunk)
+                chunk = []
+        if chunk:
+            yield from self._annotate_chunk(chunk)
+
+    def _annotate_chunk(self, chunk):
+        hostnames = self.resolve([ log["SRC"] for log in chunk ])
+        for log in chunk:
+            yield log, hostnames.get(log["SRC"])
@@ -0,0 +1,244 @@
+"""Rulesets compiled ahead of time
+
+FireWall builds its rules as live iptc objects, which takes root. Here, the
+same ruleset - the stateful rules of StateFulFireWall.start around the
+service rules of a realm - is compiled into plain PlanRules instead, then
+rendered as an iptables-restore script :
+
+    *filter
+    :INPUT DROP
+    ...
+    -I INPUT 1 -s 127.0.0.1/32 -d 127.0.0.1/32 -m comment --comment ...
+    ...
+    -A INPUT -p icmp -m icmp --icmp-type 8 -m comment --comment ...
+    COMMIT
+
+As StateFulFireWall.start does, rules go on top of the INPUT chain or at its
+end, around rules of other programs ; nothing gets flushed. The same inputs
+always render the same bytes, so scripts can be cached and diffed.
+
+restore() loads a script with iptables-restore --noflush, in one commit.
+To load one over a running firewall, patch() has it delete our rules first
+and leaves policies - and their counters - alone.
+
+A RulesetCache keeps the scripts of each realm in CACHE_DIR, under a key
+telling what they were compiled from, so that switching to a realm seen
+before costs one file read instead of a compilation.
+"""
+
+import os
+import json
+import hashlib
+import ipaddress
+import subprocess
+from collections import namedtuple
+
+from servicewall import state
+
+
+CACHE_DIR = "/var/cache/servicewall/rulesets"
+# Bumped when render() changes, so that cached scripts get compiled again :
+FORMAT = 2
+LOG_PREFIX = "not in allowed services"
+LOG_GROUP = "1"
+
+# A rule of the INPUT chain. Empty fields don't match on anything :
+PlanRule = namedtuple("PlanRule",
+                      "name target proto src dst dport ctstate icmp_type "
+                      "limit log_group log_prefix",
+                      defaults=("",) * 10)
+# Policies as (chain, policy) tuples, rules going on top of the INPUT chain
+# and rules going at its end :
+Ruleset = namedtuple("Ruleset", "policies policies6 head tail")
+
+POLICIES = (("INPUT", "DROP"), ("FORWARD", "DROP"), ("OUTPUT", "ACCEPT"))
+# IPv6 isn't supported ; it's shut off :
+POLICIES6 = (("INPUT", "DROP"), ("FORWARD", "DROP"), ("OUTPUT", "DROP"))
+IGMP_RULE = PlanRule(None, "DROP", proto="igmp")
+
+
+def compile_ruleset(service_rule_defs):
+    """Return the Ruleset of a started firewall, whose service rules are
+    service_rule_defs - RuleDefs in the order they appear in the chain.
+    """
+    head = [
+        PlanRule("localhost", "ACCEPT", src="127.0.0.1", dst="127.0.0.1"),
+        PlanRule("RELATED,ESTABLISHED", "ACCEPT",
+                 ctstate="RELATED,ESTABLISHED"),
+        *(service_rule(rule_def) for rule_def in service_rule_defs),
+    ]
+    tail = [
+        PlanRule("icmp", "ACCEPT", proto="icmp", icmp_type="8"),
+        # Untagged, as StateFulFireWall.start makes it :
+        IGMP_RULE,
+        PlanRule("log", "NFLOG", limit="1/s", log_group=LOG_GROUP,
+                 log_prefix=LOG_PREFIX),
+        PlanRule("INVALID", "DROP", ctstate="INVALID"),
+    ]
+    return Ruleset(POLICIES, POLICIES6, head, tail)
+
+
+def service_rule(rule_def):
+    """Return the PlanRule of a RuleDef."""
+    return PlanRule(rule_def.name, "ACCEPT", proto=rule_def.proto,
+                    src=rule_def.src, dport=rule_def.dport)
+
+
+def stateful_rules():
+    """Return the rules of a started firewall that aren't service rules, by
+    name.
+    """
+    ruleset = compile_ruleset(())
+    return { rule.name: rule for rule in ruleset.head + ruleset.tail
+             if rule.name }
+
+
+def _quote(text):
+    return '"%s"' % text.replace("\\", "\\\\").replace('"', '\\"')
+
+
+def _address(address):
+    """Write an address or network the way iptables-save does."""
+    return ipaddress.ip_network(address, strict=False).with_prefixlen
+
+
+def render_rule(rule, identifier, chain="INPUT", command="-A"):
+    """Return an iptables-restore line appending rule to chain, its matches
+    in the order FireWall.create_rule adds them. command may also be "-D",
+    or "-I" followed by a position, as in "-I 3".
+    """
+    command, *position = command.split()
+    words = [command, chain, *position]
+    if rule.src and not rule.src.startswith("set:") and "-" not in rule.src:
+        words.extend(["-s", _address(rule.src)])
+    if rule.dst:
+        words.extend(["-d", _address(rule.dst)])
+    if rule.proto:
+        words.extend(["-p", rule.proto])
+    if rule.dport and "," in rule.dport:
+        words.extend(["-m", "multiport", "--dports", rule.dport])
+    elif rule.dport:
+        words.extend(["-m", rule.proto, "--dport", rule.dport])
+    if rule.src.startswith("set:"):
+        words.extend(["-m", "set", "--match-set", rule.src[4:], "src"])
+    elif "-" in rule.src:
+        words.extend(["-m", "iprange", "--src-range", rule.src])
+    if rule.icmp_type:
+        words.extend(["-m", "icmp", "--icmp-type", rule.icmp_type])
+    if rule.ctstate:
+        words.extend(["-m", "conntrack", "--ctstate", rule.ctstate])
+    if rule.name:
+        words.extend(["-m", "comment", "--comment",
+                      _quote("%s:%s" % (identifier, rule.name))])
+    if rule.limit:
+        words.extend(["-m", "limit", "--limit", rule.limit,
+                      "--limit-burst", "1"])
+    words.extend(["-j", rule.target])
+    if rule.log_prefix:
+        words.extend(["--nflog-prefix", _quote(rule.log_prefix)])
+    if rule.log_group:
+        words.extend(["--nflog-group", rule.log_group])
+    return " ".join(words)
+
+
+def render(ruleset, identifier, ipv6=False, title=None):
+    """Return the iptables-restore script of ruleset, or the ip6tables-restore
+    one if ipv6. It loads over a chain that has none of our rules.
+    """
+    lines = []
+    if title:
+        lines.append("# %s" % title)
+    lines.append("*filter")
+    policies = ruleset.policies6 if ipv6 else ruleset.policies
+    lines.extend(":%s %s" % policy for policy in policies)
+    if not ipv6:
+        lines.extend(render_rule(rule, identifier, command="-I %i" % position)
+                     for position, rule in enumerate(ruleset.head, 1))
+        lines.extend(render_rule(rule, identifier) for rule in ruleset.tail)
+    lines.append("COMMIT")
+    return "\n".join(lines) + "\n"
+
+
+def patch(script, deletions=(), with_policies=True):
+    """Return script, deleting the rules of deletions - "-D" lines of
+    render_rule - before it adds its own. Without with_policies, its policy
+    lines are left out : setting a policy resets its counters.
+    """
+    lines = []
+    for line in script.splitlines():
+        if line.startswith(":") and not with_policies:
+            continue
+        lines.append(line)
+        if line == "*filter":
+            lines.extend(deletions)
+    return "\n".join(lines) + "\n"
+
+
+def restore(script, ipv6=False):
+    """Load a script made by render() in one commit, leaving chains it
+    doesn't flush as they are.
+    """
+    command = "ip6tables-restore" if ipv6 else "iptables-restore"
+    try:
+        subprocess.run([command, "--noflush"],
+                       input=script,
+                       capture_output=True,
+                       check=True,
+                       text=True)
+    except FileNotFoundError:
+        raise AssertionError("'%s' not found in the path, is iptables"
+                             " installed on this machine ?" % command)
+    except subprocess.CalledProcessError as error:
+        raise SystemError("%s failed : %s" % (command, error.stderr.strip()))
+
+
+def cache_key(*sources):
+    """Return a digest of sources, json-serializable values that a ruleset
+    was compiled from.
+    """
+    return hashlib.sha256(json.dumps(sources).encode()).hexdigest()
+
+
+class RulesetCache():
+    """Compiled scripts of realms, one file per realm."""
+
+    def __init__(self, cache_dir=CACHE_DIR):
+        self.cache_dir = cache_dir
+
+    def _path(self, realm):
+        # Realm ids are ESSIDs, which may hold any character :
+        name = hashlib.sha1(str(realm).encode()).hexdigest()[:16]
+        return os.path.join(self.cache_dir, name + ".json")
+
+    def get(self, realm, key):
+        """Return the scripts of realm if they were compiled under key, or
+        None.
+        """
+        try:
+            with open(self._path(realm)) as fd:
+                entry = json.load(fd)
+        except (OSError, ValueError):
+            return None
+        if entry.get("key") != key:
+            return None
+        return entry["scripts"]
+
+    def put(self, realm, key, scripts):
+        try:
+            state.atomic_write(self._path(realm), json.dumps(
+                {"realm": realm, "key": key, "scripts": scripts}))
+        except OSError:
+            # Not root ; compile again next time.
+            pass
+
+    def invalidate(self):
+        """Forget the scripts of all realms."""
+        try:
+            names = os.listdir(self.cache_dir)
+        except OSError:
+            return
+        for name in names:
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except OSError:
+                pass
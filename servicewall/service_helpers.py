@@ -1,6 +1,7 @@
 """Helper functions to convert from ufw/gufw service defs to ServiceWall's
 """
 from os import scandir
+from bisect import bisect_right
 from collections import namedtuple
 
 PortDef = namedtuple("PortDef", "udp tcp")
@@ -95,3 +96,158 @@ def scan_service_definitions(definitions_dir):
 
     return services
 
+
+
+def parse_port_range(port):
+    """Return a (start, end) tuple for a port string as found in PortDef,
+    like "80" or "6112:6114". "6112-6114" is accepted as well.
+    """
+    start, _, end = str(port).replace("-", ":").partition(":")
+    return int(start), int(end or start)
+
+
+MULTIPORT_SLOTS = 15
+
+
+def compact_ports(ports, slots=MULTIPORT_SLOTS):
+    """Merge ports and ranges that overlap or touch, and pack them in groups
+    fitting one multiport match : at most slots ports, a range counting as
+    two. Return a list of port strings, each a single port or range as in
+    "6112:6119", or a comma-separated list of them as in "22,80,6112:6119".
+
+    Port strings that don't parse are kept as they are, in their own group.
+    """
+    ranges = []
+    groups = []
+    for port in ports:
+        try:
+            ranges.append(parse_port_range(port))
+        except ValueError:
+            groups.append(str(port))
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    group = []
+    used = 0
+    for start, end in merged:
+        cost = 1 if start == end else 2
+        if used + cost > slots:
+            groups.append(",".join(group))
+            group = []
+            used = 0
+        group.append(str(start) if start == end else "%i:%i" % (start, end))
+        used += cost
+    if group:
+        groups.append(",".join(group))
+    return groups
+
+
+class PortIndex():
+    """Find which services use a port in O(log n).
+
+    For each protocol, the port ranges of all services are cut into
+    elementary segments that don't overlap. boundaries[proto] is the sorted
+    list of segment starts, and segments[proto][i] is the tuple of services
+    covering ports boundaries[proto][i] to boundaries[proto][i+1] - 1. A
+    lookup is then one bisection per protocol.
+
+    Services come out in the order they were added. The index is rebuilt
+    lazily after add() or remove().
+    """
+
+    protocols = ("tcp", "udp")
+
+    def __init__(self, service_defs=None):
+        # Per protocol, a dict of service name -> list of (start, end) :
+        self._ranges = { proto: {} for proto in self.protocols }
+        self._order = {}
+        self.boundaries = {}
+        self.segments = {}
+        self._dirty = True
+        if service_defs:
+            for service_name, service_def in service_defs.items():
+                self.add(service_name, service_def)
+
+    def add(self, service_name, service_def):
+        """Index service_def's ports, replacing those of a service that had
+        the same name.
+        """
+        ranges = { proto: [] for proto in self.protocols }
+        for proto in self.protocols:
+            for port in getattr(service_def.ports, proto):
+                try:
+                    ranges[proto].append(parse_port_range(port))
+                except ValueError:
+                    print("  WARNING : ignoring port %s of %s" %
+                          (port, service_name))
+        self.add_ranges(service_name, ranges)
+
+    def add_ranges(self, service_name, ranges):
+        """Index a service from already parsed ranges, given as
+        {"tcp": [(start, end), ...], "udp": [...]}.
+        """
+        self.remove(service_name)
+        self._order[service_name] = len(self._order)
+        for proto in self.protocols:
+            self._ranges[proto][service_name] = list(ranges[proto])
+        self._dirty = True
+
+    def remove(self, service_name):
+        if service_name in self._order:
+            del self._order[service_name]
+            for proto in self.protocols:
+                del self._ranges[proto][service_name]
+            self._dirty = True
+
+    def _build(self):
+        for proto in self.protocols:
+            starts = []
+            ends = []
+            for service_name, ranges in self._ranges[proto].items():
+                for start, end in ranges:
+                    starts.append((start, service_name))
+                    # A range stops covering ports at end + 1 :
+                    ends.append((end + 1, service_name))
+            starts.sort()
+            ends.sort()
+            boundaries = sorted({ port for port, _ in starts + ends })
+            segments = []
+            active = {}
+            i = j = 0
+            # Sweep boundaries, updating the count of ranges each service
+            # has over the current segment :
+            for boundary in boundaries:
+                while j < len(ends) and ends[j][0] == boundary:
+                    active[ends[j][1]] -= 1
+                    if not active[ends[j][1]]:
+                        del active[ends[j][1]]
+                    j += 1
+                while i < len(starts) and starts[i][0] == boundary:
+                    active[starts[i][1]] = active.get(starts[i][1], 0) + 1
+                    i += 1
+                segments.append(tuple(sorted(active, key=self._order.get)))
+            self.boundaries[proto] = boundaries
+            self.segments[proto] = segments
+        self._dirty = False
+
+    def lookup(self, start, end=None):
+        """Return services using any port from start to end (or just start),
+        as a dict like {"tcp": [service, ...], "udp": [...]}.
+        """
+        if end is None:
+            end = start
+        if self._dirty:
+            self._build()
+        found = {}
+        for proto in self.protocols:
+            boundaries = self.boundaries[proto]
+            first = max(bisect_right(boundaries, start) - 1, 0)
+            last = bisect_right(boundaries, end) - 1
+            services = set()
+            for segment in self.segments[proto][first:last + 1]:
+                services.update(segment)
+            found[proto] = sorted(services, key=self._order.get)
+        return found
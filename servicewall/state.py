@@ -0,0 +1,134 @@
+"""Shared state, safely
+
+braise, the toggler, servicewalld and systemd's ExecReload may all change
+the firewall and its files at the same time. This module gives them :
+
+    locked()          an inter-process lock, held around every change of the
+                      firewall or of its state files ; a process may take it
+                      again while it holds it. serialized decorates methods
+                      to run with it
+    atomic_write()    writes a file to a temporary one, syncs it to disk and
+                      renames it over the old one, so readers see either the
+                      old or the new file - never half of one, nor one with
+                      other permissions
+    write_state()     the same for state files (realms.json, config.cfg), and
+                      bumps the generation
+    generation()      a counter bumped on each change of state ; readers that
+                      keep a copy of the state can tell if it's still good
+                      without parsing it again
+"""
+
+import os
+import json
+import stat
+import fcntl
+import tempfile
+import functools
+import threading
+from contextlib import contextmanager
+
+
+LOCK_FILE = "/run/servicewall/state.lock"
+GENERATION_FILE = "/var/lib/servicewall/generation"
+
+_lock = threading.RLock()
+_depth = 0
+_lock_fd = None
+
+
+def _open_lock(lock_file):
+    try:
+        os.makedirs(os.path.dirname(lock_file), exist_ok=True)
+        return open(lock_file, "a")
+    except PermissionError:
+        # Not root ; we can't change anything anyway.
+        return None
+
+
+@contextmanager
+def locked():
+    """Hold the state lock for the duration of the block."""
+    global _depth, _lock_fd
+    with _lock:
+        if _depth == 0:
+            _lock_fd = _open_lock(LOCK_FILE)
+            if _lock_fd:
+                fcntl.flock(_lock_fd, fcntl.LOCK_EX)
+        _depth += 1
+        try:
+            yield
+        finally:
+            _depth -= 1
+            if _depth == 0 and _lock_fd:
+                # Closing the file releases the lock :
+                _lock_fd.close()
+                _lock_fd = None
+
+
+def serialized(method):
+    """Decorate a method so that it runs with the state lock held."""
+    @functools.wraps(method)
+    def locked_method(*args, **kwargs):
+        with locked():
+            return method(*args, **kwargs)
+    return locked_method
+
+
+def atomic_write(path, data):
+    """Replace path with data, str or bytes, in one rename. The new file
+    keeps the mode of the old one - 0644 if there was none.
+    """
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    try:
+        mode = stat.S_IMODE(os.stat(path).st_mode)
+    except FileNotFoundError:
+        mode = 0o644
+    # A temporary file of our own, as writers that don't hold the state
+    # lock - the catalog, caches - may write the same path at once :
+    temp_fd, temp_file = tempfile.mkstemp(
+        dir=directory, prefix=os.path.basename(path) + ".", suffix=".tmp")
+    try:
+        with open(temp_fd, "wb" if isinstance(data, bytes) else "w") as fd:
+            os.fchmod(fd.fileno(), mode)
+            fd.write(data)
+            fd.flush()
+            os.fsync(fd.fileno())
+        os.replace(temp_file, path)
+    except BaseException:
+        try:
+            os.remove(temp_file)
+        except OSError:
+            pass
+        raise
+    # Make the rename itself durable :
+    directory_fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(directory_fd)
+    finally:
+        os.close(directory_fd)
+
+
+def generation():
+    """Return the generation of the state, 0 if it never changed."""
+    try:
+        with open(GENERATION_FILE) as fd:
+            return int(fd.read())
+    except (OSError, ValueError):
+        return 0
+
+
+def bump_generation():
+    with locked():
+        try:
+            atomic_write(GENERATION_FILE, str(generation() + 1))
+        except OSError:
+            # Not root ; readers won't know, but we couldn't write either.
+            pass
+
+
+def write_state(path, obj):
+    """Write obj as json to path, a state file, and bump the generation."""
+    with locked():
+        atomic_write(path, json.dumps(obj, indent=2))
+        bump_generation()
@@ -5,11 +5,13 @@ Uses simple guidelines given in
 and implements them in a FireWall class, using reasonable defaults.
 """
 
-from datetime import datetime
-import socket
+import os
+from datetime import datetime, timedelta
 from systemd import journal
 from iptc import Rule
 from servicewall import firewall
+from servicewall import logparser
+from servicewall import topk
 
 
 class StateFulFireWall(firewall.FireWall):
@@ -19,43 +21,45 @@ class StateFulFireWall(firewall.FireWall):
     - log anything that is dropped
     - drop invalid packets
     """
-    protobynumber = { num: name[8:].lower()
-                      for name, num in vars(socket).items()
-                      if name.startswith("IPPROTO")
-                      }
+    # Where yield_new_logs remembers the last log it read :
+    log_cursor_file = "/var/cache/servicewall/logs.cursor"
+    log_cursor = None
 
     def start(self, **args):
-        print("adding rule icmp")
-        rule = Rule()
-        rule.create_target("ACCEPT")
-        rule.protocol = "icmp"
-        icmp_match = rule.create_match("icmp")
-        icmp_match.set_parameter("icmp-type", "8")
-        comment_match = rule.create_match("comment")
-        comment_match.comment = self.identifier + ":icmp"
-        self.input_chain.append_rule(rule)
-
-        # Top rule should be to allow related, established connections.
-        related_rule = self.create_conntrack_rule("ACCEPT",
-                                                  "ctstate",
-                                                  "RELATED,ESTABLISHED")
-        self.input_chain.insert_rule(related_rule)
-
-        # Drop igmp packets before logging.
-        drop_igmp_rule = Rule()
-        drop_igmp_rule.create_target("DROP")
-        drop_igmp_rule.protocol = "igmp"
-        self.input_chain.append_rule(drop_igmp_rule)
-        # Log all that is refused in INPUT chain.
-        log_rule = self.create_log_rule("not in allowed services", group="1")
-        self.input_chain.append_rule(log_rule)
-
-        # Drop invalid packets - as diagnosed by the conntrack processor.
-        # Note that this rule is useless because packets would be dropped anyway.
-        invalid_rule = self.create_conntrack_rule("DROP", "ctstate", "INVALID")
-        self.input_chain.append_rule(invalid_rule)
-
-        super().start(**args)   # commits the table if relevant
+        # Build the stateful rules and the base ones in a single transaction ;
+        # tables get committed when the outermost transaction ends.
+        with self.transaction():
+            print("adding rule icmp")
+            rule = Rule()
+            rule.create_target("ACCEPT")
+            rule.protocol = "icmp"
+            icmp_match = rule.create_match("icmp")
+            icmp_match.set_parameter("icmp-type", "8")
+            comment_match = rule.create_match("comment")
+            comment_match.comment = self.identifier + ":icmp"
+            self.append_rule(self.input_chain, rule)
+
+            # Top rule should be to allow related, established connections.
+            related_rule = self.create_conntrack_rule("ACCEPT",
+                                                      "ctstate",
+                                                      "RELATED,ESTABLISHED")
+            self.insert_rule(self.input_chain, related_rule)
+
+            # Drop igmp packets before logging.
+            drop_igmp_rule = Rule()
+            drop_igmp_rule.create_target("DROP")
+            drop_igmp_rule.protocol = "igmp"
+            self.append_rule(self.input_chain, drop_igmp_rule)
+            # Log all that is refused in INPUT chain.
+            log_rule = self.create_log_rule("not in allowed services", group="1")
+            self.append_rule(self.input_chain, log_rule)
+
+            # Drop invalid packets - as diagnosed by the conntrack processor.
+            # Note that this rule is useless because packets would be dropped anyway.
+            invalid_rule = self.create_conntrack_rule("DROP", "ctstate", "INVALID")
+            self.append_rule(self.input_chain, invalid_rule)
+
+            super().start(**args)
 
     def create_conntrack_rule(self, target, param_key, param_value):
         """creates a connection tracking rule, for example :
@@ -78,7 +82,7 @@ class StateFulFireWall(firewall.FireWall):
 
         All arguments should be strings !
         The comment size is limited to 64 characters as a whole.
-        The nflog_group is the one you will have to select in ulogd.
+        The nflog_group is the one servicewall.nflog listens to.
         """
         log_rule = self.create_rule("log", "NFLOG", dst, dport, src, sport,
                                     proto, iface)
@@ -92,82 +96,148 @@ class StateFulFireWall(firewall.FireWall):
         return log_rule
 
 
-    def yield_logs(self, limit=None, period=None):
-        """get logs we implemented in iptables from journald
-
-        limit [int] is the max number of logs to yield
-        period [int] is the age in seconds of the oldest log to yield
-        """
+    def _log_reader(self):
+        """Return a journal reader matching our logs."""
         reader = journal.Reader()
         #reader.log_level(journal.LOG_WARNING)
         # That would be for LOG match :
         #reader.add_match(SYSLOG_IDENTIFIER="kernel")
-        # That is for ulog systemd service associated to ulog.socket :
+        # That is for our NFLOG reader - and for ulogd's logs, as it used to
+        # write them to servicewall-logs.service :
+        reader.add_match(_SYSTEMD_UNIT="servicewall-nflog.service")
         reader.add_match(_SYSTEMD_UNIT="servicewall-logs.service")
-        now = datetime.now()
-        hostname = socket.gethostname()
-        #p = select.poll()
-        #p.register(reader, reader.get_events())
-        #p.poll()
-        reader.seek_tail()
+        return reader
+
+    def _parse_log(self, log):
+        """Return a LogRecord of a journal entry, or None if it isn't a log
+        of a packet.
+        """
+        if "MESSAGE" not in log:
+            return None
+        return logparser.parse_message(log["MESSAGE"],
+                                       log["__REALTIME_TIMESTAMP"])
+
+    def _read_forward(self, reader, limit=None):
+        """Yield logs from reader's position on, oldest first, and keep the
+        cursor of the last one read in self.log_cursor .
+        """
+        count = 0
+        while not limit or count < limit:
+            log = reader.get_next()
+            if not log:
+                break
+            self.log_cursor = log["__CURSOR"]
+            message_dict = self._parse_log(log)
+            if message_dict:
+                count += 1
+                yield message_dict
+
+    def yield_logs(self, limit=None, period=None, cursor=None,
+                   oldest_first=False):
+        """get logs we implemented in iptables from journald
+
+        limit [int] is the max number of logs to yield
+        period [int] is the age in seconds of the oldest log to yield
+        cursor [str] is a journal cursor ; only logs after it are yielded
+        oldest_first [bool] : with a period and no limit, seek to its start
+                     and read forward, for callers that don't care about the
+                     order or want it oldest first
+
+        Given a cursor, or a period with oldest_first, the journal is read
+        forward and logs come oldest first. Otherwise it is read backward from
+        its tail, and logs come latest first.
+        """
+        reader = self._log_reader()
         if limit:
             limit = int(limit)
-            i = 1
         if period:
             period = int(period)
-        while True:
+
+        if cursor:
+            reader.seek_cursor(cursor)
+            # Seeking puts us on the cursor's entry ; skip it :
+            log = reader.get_next()
+            if log and not reader.test_cursor(cursor):
+                reader.get_previous()
+            yield from self._read_forward(reader, limit)
+            return
+        if period and oldest_first and not limit:
+            reader.seek_realtime(datetime.now() - timedelta(seconds=period))
+            yield from self._read_forward(reader)
+            return
+
+        now = datetime.now()
+        reader.seek_tail()
+        count = 0
+        while not limit or count < limit:
             log = reader.get_previous()
-            if "MESSAGE" not in log:
-                continue
+            if not log:
+                # We reached the head of the journal.
+                break
             # Quit if log older than period :
             if period:
                 age = now - log["__REALTIME_TIMESTAMP"]
                 if int(age.total_seconds()) > period:
                     break
-            message_dict = {}
-            # Get rid of the trailing date and hostname :
-            try:
-                message = log["MESSAGE"].split(hostname)[-1].strip()
-            except IndexError:
-                print("!! error :")
-                print(log["MESSAGE"])
-
-            # If message begins with "[NEW] "or "[DESTROY]", then it is a
-            # conntrack info log - skip.
-            if message.startswith("[NEW]") or message.startswith("[DESTROY]"):
-                continue
-
-            # Only count the logs that make it here :
-            if limit:
-                if i < limit:
-                    i += 1
-                else:
-                    break
+            message_dict = self._parse_log(log)
+            if message_dict:
+                count += 1
+                yield message_dict
 
-            message_dict["LOG_DATE"] = log["__REALTIME_TIMESTAMP"]
-            for item in message.split():
-                if item.count("="):
-                    key, value = item.split("=")
-                    message_dict[key] = value
-                else:
-                    message_dict[item] = ""
-
-            if 'DPT' not in message_dict:
-                message_dict['DPT'] = ''
-            if 'SPT' not in message_dict:
-                message_dict['SPT'] = ''
-            if message_dict['PROTO'].isnumeric():
-                message_dict['PROTO'] = self.protobynumber[
-                        int(message_dict['PROTO'])]
+    def yield_new_logs(self, period=None):
+        """Yield logs that came since the last call, oldest first, and save
+        where we stopped in self.log_cursor_file . The first time, start
+        period seconds ago - or at the head of the journal.
+        """
+        try:
+            with open(self.log_cursor_file) as fd:
+                cursor = fd.read().strip()
+        except FileNotFoundError:
+            cursor = None
+        self.log_cursor = cursor
+        try:
+            if cursor:
+                yield from self.yield_logs(cursor=cursor)
+            elif period:
+                yield from self.yield_logs(period=period, oldest_first=True)
             else:
-                message_dict['PROTO'] = message_dict['PROTO'].lower()
+                reader = self._log_reader()
+                reader.seek_head()
+                yield from self._read_forward(reader)
+        finally:
+            if self.log_cursor and self.log_cursor != cursor:
+                try:
+                    os.makedirs(os.path.dirname(self.log_cursor_file),
+                                exist_ok=True)
+                    with open(self.log_cursor_file, "w") as fd:
+                        fd.write(self.log_cursor)
+                except OSError:
+                    # Not root ; we'll start over from there next time.
+                    pass
 
-            yield message_dict
+    def follow_logs(self, period=None):
+        """Yield logs as they come, blocking in between, forever. Logs of the
+        last period seconds are yielded first.
+        """
+        reader = self._log_reader()
+        if period:
+            reader.seek_realtime(datetime.now() - timedelta(seconds=int(period)))
+        else:
+            reader.seek_tail()
+            # seek_tail lands after the last entry ; step back on it so that
+            # get_next returns the next one to come :
+            reader.get_previous()
+        while True:
+            yield from self._read_forward(reader)
+            # Sleeps until journald signals new entries :
+            reader.wait()
 
     def filter_logs_by(self, criteria, limit=None, period=None):
         """output logs sorted by a log variable, like "DPT" or "SRC"
 
         note that limit applies to the criteria (like sort nth first SRC hosts)
+
+        This keeps every log ; for long periods, see heavy_hitters.
         """
         yielder = self.yield_logs(period=period)
         logs = {}
@@ -190,3 +260,14 @@ class StateFulFireWall(firewall.FireWall):
                 logs[log[criteria]].append(log)
         return logs
 
+    def heavy_hitters(self, criteria, period=None, capacity=topk.CAPACITY):
+        """Return a topk.SpaceSaving of the values of a log variable, like
+        "DPT" or "SRC", over the last period seconds.
+
+        Logs are counted as they are read, so memory stays the same whatever
+        the period.
+        """
+        counter = topk.SpaceSaving(capacity)
+        for log in self.yield_logs(period=period, oldest_first=True):
+            counter.add(log[criteria])
+        return counter
@@ -0,0 +1,93 @@
+"""Heavy hitters of long log windows, in fixed memory
+
+Counting every source that hit a public host over a few days takes as much
+memory as there are sources. Space-Saving counts at most capacity values
+instead : when a new value comes and all counters are taken, it takes over
+the counter of the least hit value, keeping its count as a possible error.
+For n logs counted, each Estimate is such that :
+
+    count - error <= true count <= count,    error <= n / capacity
+
+and any value hit more than n / capacity times is sure to be counted. So a
+capacity of 1000 lists everything above 0.1% of the logs.
+
+The least hit counter is found with a heap of (count, order, value) entries.
+Entries go stale as counts grow ; stale ones are skipped when popped, and the
+heap is rebuilt when it grows past a few times capacity.
+"""
+
+import heapq
+import itertools
+from collections import namedtuple
+
+
+CAPACITY = 1000
+
+Estimate = namedtuple("Estimate", "value count error")
+
+
+class SpaceSaving():
+    """The capacity most hit values of a stream, with their counts."""
+
+    def __init__(self, capacity=CAPACITY):
+        if capacity < 1:
+            raise AssertionError("capacity must be at least 1, not %s" %
+                                 capacity)
+        self.capacity = capacity
+        # value -> [count, error] :
+        self.counters = {}
+        self.heap = []
+        # Breaks ties in the heap, as values may not compare - None and str :
+        self.order = itertools.count()
+        # Number of hits counted :
+        self.total = 0
+
+    def __call__(self, value):
+        self.add(value)
+
+    def add(self, value, hits=1):
+        self.total += hits
+        counter = self.counters.get(value)
+        if counter is None:
+            if len(self.counters) < self.capacity:
+                counter = self.counters[value] = [0, 0]
+            else:
+                least_count, least = self._pop_least()
+                del self.counters[least]
+                counter = self.counters[value] = [least_count, least_count]
+        counter[0] += hits
+        heapq.heappush(self.heap, (counter[0], next(self.order), value))
+        if len(self.heap) > 4 * self.capacity:
+            self.heap = [ (count, next(self.order), value)
+                          for value, (count, _) in self.counters.items() ]
+            heapq.heapify(self.heap)
+
+    def _pop_least(self):
+        while True:
+            count, _, value = heapq.heappop(self.heap)
+            counter = self.counters.get(value)
+            if counter is not None and counter[0] == count:
+                return count, value
+
+    def feed(self, values):
+        for value in values:
+            self.add(value)
+
+    @property
+    def error_bound(self):
+        """The most any count overestimates by."""
+        if len(self.counters) < self.capacity:
+            # Nothing was evicted ; counts are exact.
+            return 0
+        return self.total // self.capacity
+
+    def counts(self):
+        """Return a dict of value -> count."""
+        return { value: count for value, (count, _) in self.counters.items() }
+
+    def top(self, limit=None):
+        """Return the most hit values as Estimates, most hit first."""
+        estimates = [ Estimate(value, count, error) for value, (count, error)
+                      in self.counters.items() ]
+        estimates.sort(key=lambda estimate: estimate.count, reverse=True)
+        return estimates[:limit]
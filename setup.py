@@ -59,7 +59,6 @@ setuptools.setup(
     ],
     install_requires=[
         "argparse",
-        "arpreq",
         "python-iptables",
         "python-systemd",
     ],
@@ -68,17 +67,15 @@ setuptools.setup(
     },
     scripts=[
         "servicewall/braise",
+        "servicewall/servicewalld",
     ],
     data_files=[
         ("/etc/systemd/system", [
-            "etc/systemd/servicewall-ulogd.service",
-            "etc/systemd/servicewall-logs.service",
-            "etc/systemd/servicewall-logs.socket",
+            "etc/systemd/servicewall-nflog.service",
             "etc/systemd/servicewall.service",
         ]),
         ("/etc/servicewall/", [
             "etc/servicewall/realms.json",
-            "etc/servicewall/ulogd.conf",
         ]),
         ("/etc/servicewall/services", [
             "etc/servicewall/services/.keepme",
@@ -88,7 +85,7 @@ setuptools.setup(
         ]),
         ("lib/servicewall/", [
             "lib/systray.py",
-            "lib/services.p",
+            "lib/services.json",
             "lib/toggler",
             "lib/icon.png",
             "lib/icon2.png",